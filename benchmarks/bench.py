@@ -0,0 +1,293 @@
+"""
+Throughput benchmarks of constructing, consuming, emitting and sizing fields.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench --output results.json
+    python -m benchmarks.bench --compare results.json
+
+The results (records and bytes per second for each case and operation) are
+saved as JSON, which can be compared between commits.
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import timeit
+
+from nibbles import fields
+
+
+# A benchmark case is a factory creating a (populated) instance of a field, the
+# instance is emitted to get the data which is consumed.
+CASES = []
+
+
+def case(name):
+    """Register a factory as a benchmark case."""
+    def decorator(factory):
+        CASES.append((name, factory))
+        return factory
+    return decorator
+
+
+# Every StructField.
+STRUCT_FIELDS = [
+    ('char', fields.CharField, b'c'),
+    ('byte', fields.ByteField, -5),
+    ('unsigned_byte', fields.UnsignedByteField, 5),
+    ('bool', fields.BoolField, True),
+    ('short', fields.ShortField, -1000),
+    ('unsigned_short', fields.UnsignedShortField, 1000),
+    ('integer', fields.IntegerField, -100000),
+    ('unsigned_integer', fields.UnsignedIntegerField, 100000),
+    ('long', fields.LongField, -100000),
+    ('unsigned_long', fields.UnsignedLongField, 100000),
+    ('long_long', fields.LongLongField, -10 ** 12),
+    ('unsigned_long_long', fields.UnsignedLongLongField, 10 ** 12),
+    ('float', fields.FloatField, 1.5),
+    ('double', fields.DoubleField, 1.5),
+]
+
+for _name, _field_class, _value in STRUCT_FIELDS:
+    case('struct.' + _name)(
+        lambda field_class=_field_class, value=_value: field_class(value))
+
+case('struct.string')(lambda: fields.StringField(length=16, value=b'x' * 16))
+
+case('string.cstring')(lambda: fields.CStringField(b'x' * 32))
+case('string.cstring_long')(lambda: fields.CStringField(b'x' * 64 * 1024))
+case('string.pstring')(lambda: fields.PStringField(b'x' * 32))
+case('string.terminated')(
+    lambda: fields.TerminatedField(b'x' * 32, terminator=b'\r\n'))
+
+
+class Flat(fields.Field):
+    """A small header of fixed-width fields."""
+    version = fields.UnsignedByteField()
+    flags = fields.UnsignedByteField()
+    length = fields.UnsignedShortField()
+    sequence = fields.UnsignedIntegerField()
+    timestamp = fields.UnsignedLongLongField()
+    value = fields.DoubleField()
+
+
+@case('model.flat')
+def flat():
+    return Flat(version=1, flags=2, length=3, sequence=4, timestamp=5,
+                value=6.0)
+
+
+# A wide model: 64 fixed-width and 16 string fields.
+Wide = type('Wide', (fields.Field,), dict(
+    [('i%d' % i, fields.UnsignedIntegerField(i)) for i in range(64)] +
+    [('s%d' % i, fields.CStringField(b'x' * i)) for i in range(16)]
+))
+
+
+@case('model.wide')
+def wide():
+    return Wide()
+
+
+class Struct(fields.Field):
+    code = fields.ByteField()
+    description = fields.CStringField()
+
+
+class ComplexStruct(fields.Field):
+    a = fields.ByteField()
+    s = Struct()
+    b = fields.ByteField()
+
+
+@case('model.complex')
+def complex_struct():
+    s = ComplexStruct(a=1, b=17)
+    s.s.code.value = 1
+    s.s.description.value = b'abcdf'
+    return s
+
+
+class Deep0(fields.Field):
+    a = fields.ByteField()
+    b = fields.CStringField(b'abc')
+
+
+# Nested 5 levels deep, with 2 children at each level.
+_deep = Deep0
+for _level in range(1, 6):
+    _deep = type('Deep%d' % _level, (fields.Field,), {
+        'header': fields.UnsignedShortField(_level),
+        'left': _deep(),
+        'right': _deep(),
+    })
+Deep = _deep
+
+
+@case('model.deep')
+def deep():
+    return Deep()
+
+
+@case('repeated.list')
+def repeated():
+    f = fields.RepeatedField(Struct())
+    f.consume(b''.join(Struct(code=i, description=b'abc').emit()
+                       for i in range(100)))
+    return f
+
+
+class TypeLengthValue(fields.Field):
+    type = fields.ByteField()
+    length = fields.UnsignedShortField()
+    value = fields.DependentField(fields.StringField,
+                                  dep_kwargs={'length': 'length'})
+
+
+@case('dependent.tlv')
+def tlv():
+    return TypeLengthValue().consume(b'\x01\x00\x20' + b'x' * 32)
+
+
+class Message(fields.Field):
+    type = fields.UnsignedByteField()
+    payload = fields.ChoiceField('type', dict(
+        [(i, Struct) for i in range(0, 32, 2)] +
+        [(i, Flat) for i in range(1, 32, 2)]))
+
+
+@case('choice.message')
+def message():
+    return Message(type=31).consume(b'\x1f' + flat().emit())
+
+
+def _time(func, min_time):
+    """The best time of a single call of func, in seconds."""
+    timer = timeit.Timer(func)
+
+    # Find a number of calls taking at least min_time.
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    return min(timer.repeat(3, number)) / number
+
+
+def run_case(factory, min_time):
+    """Benchmark the operations of a case, returns the results per operation."""
+    field = factory()
+    data = field.emit()
+    size = len(data)
+
+    # Construct fields like the factory does (without consuming data).
+    prototype = factory()
+    if isinstance(prototype, fields.Field) and prototype.fields:
+        construct = prototype.__class__
+    else:
+        construct = factory
+
+    consumer = factory()
+    operations = [
+        ('construct', construct),
+        ('consume', lambda: consumer.consume(data)),
+        ('consume_from', lambda: consumer.consume_from(data)),
+        ('emit', field.emit),
+        ('size', field.size),
+    ]
+
+    results = {}
+    for name, func in operations:
+        seconds = _time(func, min_time)
+        results[name] = {
+            'records_per_sec': 1 / seconds,
+            'bytes_per_sec': size / seconds,
+        }
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(pattern=None, min_time=0.1):
+    results = {}
+    for name, factory in CASES:
+        if pattern and pattern not in name:
+            continue
+
+        results[name] = run_case(factory, min_time)
+        print('%-28s %s' % (name, '  '.join(
+            '%s: %10.0f/s' % (op, r['records_per_sec'])
+            for op, r in sorted(results[name].items()))))
+
+    return {
+        'commit': _commit(),
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """
+    Print the change of records per second against baseline, returns the
+    number of regressions (slower by more than threshold).
+
+    """
+    regressions = 0
+    for name, ops in sorted(current['results'].items()):
+        for op, result in sorted(ops.items()):
+            try:
+                before = baseline['results'][name][op]['records_per_sec']
+            except KeyError:
+                continue
+
+            ratio = result['records_per_sec'] / before
+            marker = ''
+            if ratio < 1 - threshold:
+                marker = '  REGRESSION'
+                regressions += 1
+            print('%-28s %-14s %6.2fx%s' % (name, op, ratio, marker))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--compare', help="compare against saved results")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="the slowdown reported as a regression")
+    parser.add_argument('--filter', help="only run cases containing this")
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help="the minimum time of each measurement (seconds)")
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.min_time)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
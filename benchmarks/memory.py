@@ -0,0 +1,93 @@
+"""
+The memory held per decoded record, as Field objects and as records of values
+(consume(data, values=True)).
+
+Run from the root of the repository:
+
+    python -m benchmarks.memory
+
+The size of a record is the size of all the objects it references (see
+_total_size), shared objects (e.g. small integers or the format strings shared
+by the fields of all records) are only counted once for all the records.
+
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+import types
+
+from benchmarks.bench import Flat, TypeLengthValue, Wide
+
+
+def _total_size(roots):
+    """
+    The total size (in bytes) of roots and of the objects they reference
+    (through their attributes or items), each object is counted once. Classes,
+    modules and functions aren't counted.
+
+    """
+    skipped = (type, types.ModuleType, types.FunctionType,
+               types.BuiltinFunctionType)
+    seen = set()
+    total = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, skipped):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+
+    return total
+
+
+# The records measured: the name and a factory of a populated instance.
+MODELS = [
+    ('flat (6 fixed-width fields)',
+     lambda: Flat(version=1, flags=2, length=3, sequence=4, timestamp=5,
+                  value=6.0)),
+    ('tlv (dependent string)',
+     lambda: TypeLengthValue().consume(b'\x01\x00\x20' + b'x' * 32)),
+    ('wide (64 integers, 16 strings)', Wide),
+]
+
+
+def measure(factory, count):
+    """The bytes per record as Field objects and as records of values."""
+    data = factory().emit()
+    field_class = factory().__class__
+
+    objects = [field_class().consume(data) for _ in range(count)]
+    values = [field_class().consume(data, values=True) for _ in range(count)]
+
+    return (_total_size([objects]) / float(count),
+            _total_size([values]) / float(count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=10000,
+                        help="the number of records measured")
+    args = parser.parse_args(argv)
+
+    print('%-32s %14s %14s %8s' % ('model', 'objects (B)', 'values (B)',
+                                   'ratio'))
+    for name, factory in MODELS:
+        objects, values = measure(factory, args.count)
+        print('%-32s %14.0f %14.0f %7.1fx' % (name, objects, values,
+                                              objects / values))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import os
+
+if os.environ.get('NIBBLES_PROFILE'):
+    from nibbles import profiling
+    profiling._profile_from_environment()
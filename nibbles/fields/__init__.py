@@ -1,3 +1,4 @@
 from nibbles.fields.base import *
 from nibbles.fields.ctypes import *
 from nibbles.fields.repeated import *
+from nibbles.fields.compressed import *
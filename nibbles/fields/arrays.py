@@ -0,0 +1,103 @@
+"""
+Support for decoding runs of fixed-size models into NumPy structured arrays.
+
+NumPy is optional, it is only needed when a RepeatedField is created with
+as_array=True.
+
+"""
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from nibbles.fields.base import _StructRun, BIG_ENDIAN, NETWORK_ENDIAN
+
+# The NumPy type for each struct format character, using the standard sizes.
+_DTYPE_CODES = {
+    b'c': 'S1',
+    b'b': 'i1',
+    b'B': 'u1',
+    b'?': '?',
+    b'h': 'i2',
+    b'H': 'u2',
+    b'i': 'i4',
+    b'I': 'u4',
+    b'l': 'i4',
+    b'L': 'u4',
+    b'q': 'i8',
+    b'Q': 'u8',
+    b'f': 'f4',
+    b'd': 'f8',
+}
+
+# A struct format for a single value, e.g. b'h' or b'10s'.
+_FORMAT_RE = re.compile(br'^(\d*)(.)$')
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("NumPy is required to decode fields as arrays")
+
+
+def _dtype_code(format_string, endian):
+    """Convert the struct format of a single value to a NumPy type string."""
+    match = _FORMAT_RE.match(format_string)
+    if match is None:
+        raise TypeError("Unsupported format for arrays: %s" % format_string)
+    count, char = match.groups()
+
+    if char == b's':
+        return 'S%d' % int(count or 1)
+    if count and int(count) != 1 or char not in _DTYPE_CODES:
+        raise TypeError("Unsupported format for arrays: %s" % format_string)
+
+    # NumPy has no notion of network order, which is big-endian.
+    if endian == NETWORK_ENDIAN:
+        endian = BIG_ENDIAN
+    return endian + _DTYPE_CODES[char]
+
+
+def dtype_for(field, endian):
+    """
+    Build a NumPy structured dtype matching the layout of a fixed-size field
+    (e.g. a model made only of StructFields and other such models).
+
+    endian is the Endianess the field would inherit from its parent, fields
+    which declare their own Endianess keep it.
+
+    Raises TypeError if the field doesn't have a fixed layout.
+
+    """
+    _require_numpy()
+    return numpy.dtype(_dtype_spec(field, endian))
+
+
+def _dtype_spec(field, endian):
+    if field._endian is not None:
+        endian = field._endian
+
+    # A single value.
+    format_string = field._struct_format()
+    if format_string is not None:
+        return _dtype_code(format_string, endian)
+
+    if not field._plan:
+        raise TypeError("%s does not have a fixed layout" %
+                        field.__class__.__name__)
+
+    spec = []
+    for step in field._plan:
+        if step.__class__ is _StructRun:
+            if step.bits is not None:
+                raise TypeError("%s has BitFields, which NumPy can't represent"
+                                % field.__class__.__name__)
+            for fieldname in step.names:
+                child = field.fields[fieldname]
+                spec.append((fieldname,
+                             _dtype_code(child._struct_format(), endian)))
+        else:
+            spec.append((step, _dtype_spec(field.fields[step], endian)))
+
+    return spec
@@ -1,17 +1,114 @@
 from collections import OrderedDict
 from copy import deepcopy
+from operator import itemgetter
+import struct
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+from nibbles.exceptions import NotEnoughDataException
 
+__all__ = [
+    'BaseField', 'Field', 'MetaField', 'Parser', 'Projection', 'Values',
+    'set_validation', 'NotEnoughDataException',
+    'NATIVE_ENDIAN', 'BIG_ENDIAN', 'LITTLE_ENDIAN', 'NETWORK_ENDIAN',
+    'ENDIANS', 'DEFAULT_ENDIAN',
+    'STRICT_VALIDATION', 'TRUSTED_VALIDATION', 'NO_VALIDATION', 'VALIDATIONS',
+    'DEFAULT_VALIDATION',
+    'DEFAULT_CHUNK_SIZE', 'DEFAULT_SEGMENT_THRESHOLD',
+]
 
-def _filelike(f):
-    """Ensure f is a filelike object."""
-    if isinstance(f, type("")):
-        return StringIO(f)
-    return f
+
+# Objects which are consumed directly as a buffer (via consume_from) instead of
+# being read as a filelike. Anything supporting the buffer protocol (e.g. mmap)
+# can be given to consume_from directly.
+_BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+
+def _tobytes(buf, start, end):
+    """Return the bytes of buf[start:end] for any buffer type."""
+    chunk = buf[start:end]
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    if not isinstance(chunk, bytes):
+        return bytes(chunk)
+    return chunk
+
+
+# The amount of data searched at once for buffers without a find method.
+_FIND_CHUNK_SIZE = 4096
+
+
+class _Parts(list):
+    """A filelike which collects the written data, to be joined at once."""
+    write = list.append
+
+
+# The size from which written data is kept as its own segment by
+# emit_segments, smaller writes are copied together.
+DEFAULT_SEGMENT_THRESHOLD = 1024
+
+
+class _Segments(list):
+    """
+    A filelike which collects the written data as a list of segments: data of
+    at least threshold bytes is kept as is (without copying it) and smaller
+    writes in between are copied together into a single segment.
+
+    """
+
+    def __init__(self, threshold):
+        super(_Segments, self).__init__()
+        self.threshold = threshold
+        self._small = None
+
+    def write(self, data):
+        if len(data) < self.threshold:
+            if self._small is None:
+                self._small = bytearray()
+                self.append(self._small)
+            self._small += data
+            return
+
+        self._small = None
+        self.append(data)
+
+
+def _write(buf, offset, data):
+    """
+    Write data into buf at offset, without growing buf. Returns the offset
+    just after the written data.
+
+    """
+    end = offset + len(data)
+    if end > len(buf):
+        raise ValueError(
+            "Not enough space in buffer, expected: %d, got: %d" %
+            (len(data), len(buf) - offset))
+    buf[offset:end] = data
+    return end
+
+
+def _find(buf, sub, start=0):
+    """
+    Return the lowest index of sub in buf at or after start, or -1 if sub is
+    not found.
+
+    """
+    try:
+        return buf.find(sub, start)
+    except AttributeError:
+        pass
+
+    # Buffers without find (i.e. memoryview) are searched in chunks, the
+    # chunks overlap by len(sub) - 1 so matches across the boundary are found.
+    end = len(buf)
+    while start < end:
+        stop = min(start + _FIND_CHUNK_SIZE, end)
+        index = _tobytes(buf, start, stop).find(sub)
+        if index != -1:
+            return start + index
+        if stop == end:
+            break
+        start = stop - len(sub) + 1
+    return -1
 
 NATIVE_ENDIAN = "="
 BIG_ENDIAN = ">"
@@ -22,6 +119,381 @@ ENDIANS = (NATIVE_ENDIAN, BIG_ENDIAN, LITTLE_ENDIAN, NETWORK_ENDIAN,)
 
 DEFAULT_ENDIAN = NETWORK_ENDIAN
 
+# The validation policies of consumed values: every value is checked, only
+# values which aren't already constrained by struct are checked (e.g. the range
+# of an integer is, the checks of a custom field aren't) or none is checked.
+# Values assigned to fields are always checked.
+STRICT_VALIDATION = 'strict'
+TRUSTED_VALIDATION = 'trusted'
+NO_VALIDATION = 'off'
+
+VALIDATIONS = (STRICT_VALIDATION, TRUSTED_VALIDATION, NO_VALIDATION,)
+
+DEFAULT_VALIDATION = TRUSTED_VALIDATION
+
+
+# Compiled struct.Struct objects, keyed by their full format string (including
+# the Endianess).
+_structs = {}
+
+
+def _get_struct(format_string):
+    """Return a (cached) compiled struct.Struct for format_string."""
+    try:
+        return _structs[format_string]
+    except KeyError:
+        s = _structs[format_string] = struct.Struct(format_string)
+        return s
+
+
+# The amount of data read at once when iterating over records in a stream.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_records(prototype, f, chunk_size=DEFAULT_CHUNK_SIZE, parent=None):
+    """
+    Yield copies of prototype consumed one after another from the filelike f,
+    until the end of f.
+
+    The data is read in chunks of chunk_size into a buffer which only holds
+    the data of the record(s) currently being consumed.
+
+    """
+    buf = bytearray()
+    offset = 0
+    eof = False
+
+    while True:
+        if offset < len(buf):
+            record = prototype._clone()
+            record.parent = parent
+            try:
+                record, end = record.consume_from(buf, offset)
+            except NotEnoughDataException:
+                if eof:
+                    raise
+            else:
+                # A record ending exactly at the end of the buffer might have
+                # continued (e.g. a RepeatedField), unless there's no more data.
+                if end < len(buf) or eof:
+                    yield record
+                    offset = end
+                    continue
+
+        elif eof:
+            return
+
+        # Drop the consumed data and read some more.
+        if offset:
+            del buf[:offset]
+            offset = 0
+
+        chunk = f.read(chunk_size)
+        if chunk:
+            buf += chunk
+        else:
+            eof = True
+
+
+def _seekable(f):
+    """Whether the position of the filelike f can be changed."""
+    try:
+        return f.seekable()
+    except AttributeError:
+        pass
+
+    # Python 2 files.
+    try:
+        f.tell()
+    except (AttributeError, IOError, ValueError):
+        return False
+    return True
+
+
+def _read_until(f, terminator):
+    """
+    Read the filelike f up to and including terminator, returns the data
+    before terminator.
+
+    The data is searched in chunks, without reading past the terminator: the
+    chunks are peeked at if possible, otherwise the position is moved back to
+    just after the terminator. Only other streams are read byte by byte.
+
+    """
+    data = bytearray()
+
+    peek = getattr(f, 'peek', None)
+    if peek is not None:
+        while True:
+            chunk = peek(_FIND_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            start = len(data)
+            data += chunk
+            index = data.find(terminator, max(0, start - len(terminator) + 1))
+            if index != -1:
+                f.read(index + len(terminator) - start)
+                return bytes(data[:index])
+            f.read(len(chunk))
+
+    elif _seekable(f):
+        while True:
+            chunk = f.read(_FIND_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            start = len(data)
+            data += chunk
+            index = data.find(terminator, max(0, start - len(terminator) + 1))
+            if index != -1:
+                # Move back to just after the terminator.
+                f.seek(index + len(terminator) - len(data), 1)
+                return bytes(data[:index])
+
+    else:
+        while True:
+            char = f.read(1)
+            if not char:
+                break
+
+            data += char
+            if data.endswith(terminator):
+                return bytes(data[:-len(terminator)])
+
+    raise NotEnoughDataException("End of string not reached")
+
+
+class _StructRun(object):
+    """
+    A run of consecutive fixed-width fields which are packed and unpacked
+    together by a single struct.Struct.
+
+    Each value of the struct (a slot) is either the name of a field, or a group
+    of BitFields packed into a word: a tuple of the (fieldname, shift, mask) of
+    each BitField.
+
+    Only the format string is known when the class is created, the Endianess is
+    resolved at run-time (it can be inherited from a parent).
+
+    unchecked are the validation policies under which the unpacked values can
+    be stored in all the fields without being checked (see _unchecked).
+
+    """
+
+    def __init__(self, slots, formats, unchecked=frozenset()):
+        self.slots = tuple(slots)
+        self.formats = tuple(formats)
+        self.format_string = b''.join(formats)
+        self.unchecked = unchecked
+
+        # The size doesn't depend on the Endianess, all of ENDIANS use the
+        # standard sizes without alignment.
+        self.size = struct.calcsize(DEFAULT_ENDIAN + self.format_string)
+
+        # The name, offset and (for BitFields) the word format string, shift
+        # and mask of each field in the run.
+        names = []
+        offsets = []
+        bits = []
+        offset = 0
+        for slot, format_string in zip(slots, formats):
+            if isinstance(slot, tuple):
+                for fieldname, shift, mask in slot:
+                    names.append(fieldname)
+                    offsets.append(offset)
+                    bits.append((format_string, shift, mask))
+            else:
+                names.append(slot)
+                offsets.append(offset)
+                bits.append(None)
+            offset += struct.calcsize(DEFAULT_ENDIAN + format_string)
+        self.names = tuple(names)
+        self.offsets = tuple(offsets)
+
+        # None unless the run has BitFields, the values of the struct then
+        # need to be split into (and joined from) the values of the fields.
+        self.bits = None
+        if any(isinstance(slot, tuple) for slot in slots):
+            self.bits = tuple(bits)
+
+        # The index and length of each string slot (e.g. a StringField), which
+        # emit_segments can write without packing it.
+        self.strings = tuple(
+            (index, struct.calcsize(DEFAULT_ENDIAN + format_string))
+            for index, (slot, format_string) in enumerate(zip(slots, formats))
+            if not isinstance(slot, tuple) and format_string.endswith(b's'))
+
+    def struct(self, endian):
+        return _get_struct(endian + self.format_string)
+
+    def pack_segments(self, endian, values, threshold):
+        """
+        Pack the values of the struct into a list of parts, the values of
+        string slots of at least threshold bytes (and of their full length) are
+        parts of their own instead of being copied.
+
+        """
+        parts = []
+        start = 0
+        for index, length in self.strings:
+            value = values[index]
+            if length < threshold or len(value) != length:
+                continue
+            if start < index:
+                parts.append(_get_struct(
+                    endian + b''.join(self.formats[start:index])).pack(
+                        *values[start:index]))
+            parts.append(value)
+            start = index + 1
+
+        if start < len(self.slots):
+            parts.append(_get_struct(
+                endian + b''.join(self.formats[start:])).pack(*values[start:]))
+        return parts
+
+    def split(self, values):
+        """The value of each field from the values of the struct."""
+        result = []
+        for slot, value in zip(self.slots, values):
+            if isinstance(slot, tuple):
+                result.extend((value >> shift) & mask for _, shift, mask in slot)
+            else:
+                result.append(value)
+        return result
+
+    def join(self, values):
+        """The values of the struct from the value of each field."""
+        values = iter(values)
+        result = []
+        for slot in self.slots:
+            if isinstance(slot, tuple):
+                word = 0
+                for _, shift, mask in slot:
+                    word |= (next(values) & mask) << shift
+                result.append(word)
+            else:
+                result.append(next(values))
+        return result
+
+
+# The format string of the words BitFields are packed into, by size in bits.
+_WORD_FORMATS = {8: b'B', 16: b'H', 32: b'I', 64: b'Q'}
+
+
+def _bit_group(group):
+    """
+    Pack a group of (fieldname, bits) into a word, most significant bit first.
+    Returns the slot and the format string of the word.
+
+    """
+    total = sum(bits for _, bits in group)
+    if total not in _WORD_FORMATS:
+        raise TypeError(
+            "BitFields must add up to 8, 16, 32 or 64 bits, got: %d (%s)" %
+            (total, ", ".join(fieldname for fieldname, _ in group)))
+
+    slot = []
+    shift = total
+    for fieldname, bits in group:
+        shift -= bits
+        slot.append((fieldname, shift, (1 << bits) - 1))
+    return tuple(slot), _WORD_FORMATS[total]
+
+
+def _slots(fields):
+    """
+    Yield the slot and format string of each field, the format string is None
+    for fields which handle themselves. Consecutive BitFields are grouped into
+    a single slot.
+
+    """
+    group = []
+    for fieldname, field in fields.items():
+        if field._bits is not None:
+            group.append((fieldname, field._bits))
+            continue
+
+        if group:
+            yield _bit_group(group)
+            group = []
+
+        # Fields which declare their own Endianess can't be merged.
+        format_string = field._struct_format()
+        if field._endian is not None:
+            format_string = None
+        yield fieldname, format_string
+
+    if group:
+        yield _bit_group(group)
+
+
+def _static_plan_size(plan, fields):
+    """
+    The size of the data of a plan of fields if it's fixed, otherwise None.
+
+    """
+    size = 0
+    for step in plan:
+        if step.__class__ is _StructRun:
+            size += step.size
+        else:
+            field_size = fields[step]._static_size()
+            if field_size is None:
+                return None
+            size += field_size
+
+    return size
+
+
+def _unchecked_run(slots, fields):
+    """
+    The validation policies under which the values of a run of slots can be
+    stored without being checked, those of all the fields.
+
+    """
+    unchecked = frozenset(VALIDATIONS)
+    for slot in slots:
+        if not isinstance(slot, tuple):
+            slot = [(slot, None, None)]
+        for fieldname, _, _ in slot:
+            unchecked &= fields[fieldname]._unchecked
+    return unchecked
+
+
+def _build_plan(fields, merge=True):
+    """
+    Compile an ordered mapping of fields into a parse plan: a list of steps,
+    each step is either a _StructRun or the name of a field which handles
+    itself.
+
+    If merge is False, each fixed-width field handles itself instead of being
+    merged with its neighbours (only groups of BitFields are still a run).
+
+    """
+    plan = []
+    slots = []
+    formats = []
+    for slot, format_string in _slots(fields):
+        if format_string is not None and (merge or isinstance(slot, tuple)):
+            slots.append(slot)
+            formats.append(format_string)
+            if merge:
+                continue
+
+        if slots:
+            plan.append(_StructRun(slots, formats,
+                                   _unchecked_run(slots, fields)))
+            slots = []
+            formats = []
+        if format_string is None or not isinstance(slot, tuple):
+            plan.append(slot)
+
+    if slots:
+        plan.append(_StructRun(slots, formats, _unchecked_run(slots, fields)))
+
+    return plan
+
 
 class BaseField(object):
     """
@@ -59,11 +531,12 @@ class BaseField(object):
         self.endian = endian
 
         # For each field:
-        #   1. Make a copy so instances of Field don't touch each other.
+        #   1. Make a copy of the prototype declared on the class so instances
+        #      of Field don't touch each other.
         #   2. Ensure it can find it's parent.
         self.fields = OrderedDict()
         for fieldname, field in self.base_fields.items():
-            field = deepcopy(field)
+            field = field._clone()
 
             # Let the field know who it belongs to.
             field.parent = self
@@ -71,6 +544,9 @@ class BaseField(object):
             self.fields[fieldname] = field
             setattr(self, fieldname, field)
 
+        # For now, the parent is unknown.
+        self.parent = None
+
         # Now set those values, if in kwargs.
         for fieldname, value in kwargs.items():
             if fieldname in self.fields:
@@ -78,53 +554,806 @@ class BaseField(object):
             else:
                 raise TypeError("Unknown field: %s" % fieldname)
 
-        # For now, the parent is unknown.
-        self.parent = None
+    def _clone(self):
+        """
+        Return a new instance which is a copy of this one, used to instantiate
+        the fields declared on a class from their prototypes.
+
+        This is much cheaper than a deepcopy: attributes are copied shallowly
+        (values are expected to be immutable) and only the child fields are
+        recursively cloned. Instances of classes which may have mutable state
+        (see _shallow_clone) are deep-copied instead.
+
+        """
+        cls = self.__class__
+        if not cls._shallow_clone:
+            # Copy this field and its descendants, not its parent.
+            return deepcopy(self, {id(self.parent): None})
+
+        new = cls.__new__(cls)
+        attrs = new.__dict__
+        attrs.update(self.__dict__)
+        attrs['parent'] = None
+
+        if self.fields:
+            fields = attrs['fields'] = OrderedDict()
+            for fieldname, field in self.fields.items():
+                field = field._clone()
+                field.parent = new
+                fields[fieldname] = attrs[fieldname] = field
+
+        return new
 
     # The number of bytes represented by this field, -1 denotes a variable
     # length.
     def size(self, value=None):
+        if self._fixed_size is not None:
+            return self._fixed_size
+        if self._span is not None:
+            return self._span[2] - self._span[1]
+        if self._size_cache is not None:
+            return self._size_cache
+
         sz = 0
         # Combine the length of any children.
-        for fieldname, field in self.fields.items():
-            # Get the value and then ask the field the size.
-            sz += getattr(self, fieldname).size()
+        for step in self._plan:
+            if step.__class__ is _StructRun:
+                sz += step.size
+            else:
+                # Get the value and then ask the field the size.
+                sz += getattr(self, step).size()
 
+        if self._memoize_size:
+            self._size_cache = sz
         return sz
 
-    def consume(self, data):
+    def _static_size(self):
+        """
+        The number of bytes represented by this field if it is the same for
+        any value (i.e. the field has a fixed size), otherwise None.
+
+        """
+        if self._fixed_size is not None:
+            return self._fixed_size
+        if not self.fields:
+            # A leaf that doesn't know its size, e.g. a subclass consuming
+            # its own data.
+            return None
+        return _static_plan_size(self._plan, self.fields)
+
+    # The size of every instance of a class with fields, if it's fixed. This is
+    # computed once by MetaField.
+    _fixed_size = None
+
+    # The size of a variable-size Field, computed the last time its size was
+    # asked for. It's dropped (up to the root) when a value changes, see
+    # _changed.
+    _size_cache = None
+
+    # Whether the size of this Field can be memoized: the values of all the
+    # descendants must be modified through their value property (e.g. unlike
+    # the list of a RepeatedField, which can be modified in place).
+    _memoize_size = True
+
+    # Whether to generate the consume and emit methods of this class from the
+    # plan, instead of interpreting the plan for every record (see codegen).
+    generate_code = False
+
+    # The validation policy of the values consumed by this class (one of
+    # VALIDATIONS): the values of the runs of its fields, or its own value. The
+    # default of all classes is changed with set_validation.
+    validation = DEFAULT_VALIDATION
+
+    # The validation policies under which a consumed value can be stored
+    # without its value property (nor its checks), see StructField.
+    _unchecked = frozenset()
+
+    # Whether the attributes of the instances can be shared by their clones,
+    # see _clone. Classes defining __init__ can set their own attributes, they
+    # are deep-copied unless they also define _clone or set this.
+    _shallow_clone = True
+
+    # Whether this field needs the values of its siblings (via the parent) to
+    # be consumed, e.g. a DependentField.
+    _depends_on_parent = False
+
+    # Whether the boundaries of the children can be found without decoding
+    # them, i.e. none of the children depend on their siblings.
+    _skippable = True
+
+    def _skip(self, buf, offset=0):
+        """
+        Return the offset just after this field in buf, without decoding the
+        field where possible (e.g. fixed-width fields are jumped over and only
+        the terminator of a C-string is searched for).
+
+        """
+        if not self.fields:
+            # A leaf without its own _skip (e.g. a subclass consuming its own
+            # data) can only be measured by consuming it.
+            return self._clone().consume_from(buf, offset)[1]
+
+        if not self._skippable:
+            return self._skip_dependent(buf, offset)
+
+        for step in self._plan:
+            if step.__class__ is not _StructRun:
+                offset = getattr(self, step)._skip(buf, offset)
+                continue
+
+            if len(buf) - offset < step.size:
+                raise NotEnoughDataException(
+                    "Not enough data for %s, expected: %d, got: %d" %
+                    (", ".join(step.names), step.size, len(buf) - offset))
+            offset += step.size
+
+        return offset
+
+    def _skip_dependent(self, buf, offset):
+        """
+        _skip for a field with children depending on their siblings: only the
+        siblings they reference are consumed (into clones) and the children
+        depending on them are measured, the other children are skipped.
+
+        """
+        needed = set()
+        dependent = []
+        for fieldname, field in self.fields.items():
+            if field._depends_on_parent:
+                references = field._references()
+                if references is None or not set(references) <= set(
+                        self.fields):
+                    # The references aren't known (or aren't fields).
+                    return self._clone().consume_from(buf, offset)[1]
+                needed.update(references)
+                dependent.append(fieldname)
+
+        # A stand-in for this field (the parent of the dependent children)
+        # with clones of only the children consumed or created, the others
+        # are shared (and only skipped).
+        cls = self.__class__
+        new = cls.__new__(cls)
+        attrs = new.__dict__
+        attrs.update(self.__dict__)
+        attrs['parent'] = None
+        attrs['_endian'] = self.endian
+
+        # Runs are consumed at once, into all their fields.
+        cloned = needed.union(dependent)
+        for step in self._plan:
+            if step.__class__ is _StructRun and needed.intersection(
+                    step.names):
+                cloned.update(step.names)
+        for fieldname in cloned:
+            field = self.fields[fieldname]._clone()
+            field.parent = new
+            attrs[fieldname] = field
+
+        endian = new.endian
+        for step in self._plan:
+            if step.__class__ is _StructRun:
+                if needed.intersection(step.names):
+                    offset = new._consume_step(step, buf, offset, endian)
+                    continue
+                if len(buf) - offset < step.size:
+                    raise NotEnoughDataException(
+                        "Not enough data for %s, expected: %d, got: %d" %
+                        (", ".join(step.names), step.size, len(buf) - offset))
+                offset += step.size
+            elif step in needed:
+                offset = getattr(new, step).consume_from(buf, offset)[1]
+            else:
+                offset = getattr(new, step)._skip(buf, offset)
+
+        return offset
+
+    def _references(self):
+        """
+        The names of the siblings (declared on the parent) whose values this
+        field needs to be consumed, None if they aren't known. Only used for
+        fields depending on their parent.
+
+        """
+        return None
+
+    def consume(self, data, lazy=False, values=False, only=None):
         """
         A factory method, it takes data and returns an instance of this Field
         object.
 
+        See consume_from for lazy, which requires data to be a buffer, and for
+        values and only. Fields are only skipped in buffers, a filelike is
+        consumed entirely.
+
         """
-        data = _filelike(data)
+        if isinstance(data, _BUFFER_TYPES):
+            return self.consume_from(data, lazy=lazy, values=values,
+                                     only=only)[0]
+        if lazy:
+            raise TypeError("Only buffers can be consumed lazily")
+        if only is not None:
+            self.consume(data)
+            if values:
+                return self._projection(only)._values_of(self)
+            return self
+        if values:
+            return self.consume(data).as_values()
 
-        # Ask each field to consume bytes and add it as a property (in order).
-        for fieldname, field in self.fields.items():
-            raw = getattr(self, fieldname).consume(data)
+        endian = self.endian
+
+        # Ask each field to consume bytes and add it as a property (in order),
+        # runs of fixed-width fields are read and unpacked at once.
+        for step in self._plan:
+            if step.__class__ is not _StructRun:
+                getattr(self, step).consume(data)
+                continue
+
+            s = step.struct(endian)
+            raw = data.read(s.size)
+            if len(raw) < s.size:
+                raise NotEnoughDataException(
+                    "Not enough data for %s, expected: %d, got: %d" %
+                    (", ".join(step.names), s.size, len(raw)))
+
+            self._store(step, s.unpack(raw))
 
         return self
 
+    def consume_from(self, buf, offset=0, lazy=False, values=False,
+                     only=None):
+        """
+        Consume this Field directly out of buf starting at offset, without
+        copying the data into a filelike first.
+
+        buf can be any object supporting the buffer protocol (e.g. bytes,
+        bytearray, memoryview or mmap).
+
+        If lazy is True, only the boundaries of the fields are found and each
+        value is decoded the first time it is accessed. Until a value is
+        modified, the original data is emitted as is. buf must not be modified
+        while this Field is in use.
+
+        If values is True, a compact record of the values is returned instead
+        of this Field object (see as_values). Where possible the values are
+        decoded straight into the record, without updating this Field.
+
+        If only is given (a list of field names, or a Projection), only those
+        fields are consumed and the others are skipped (see projection).
+
+        Returns a tuple of this Field object and the offset just after the
+        consumed data.
+
+        """
+        if only is not None:
+            if lazy:
+                raise TypeError("Projections can't be consumed lazily")
+            return self._consume_projection(self._projection(only), buf,
+                                            offset, values)
+        if values:
+            if lazy:
+                raise TypeError("Values can't be consumed lazily")
+            return self._consume_values(buf, offset)
+        if lazy:
+            if self.parent is not None:
+                self.parent._changed()
+            return self, self._consume_lazy(buf, offset)
+
+        endian = self.endian
+
+        for step in self._plan:
+            offset = self._consume_step(step, buf, offset, endian)
+
+        return self, offset
+
+    def _consume_step(self, step, buf, offset, endian):
+        """
+        Consume a single step of the plan from buf at offset, returns the offset
+        just after the consumed data.
+
+        """
+        if step.__class__ is not _StructRun:
+            return getattr(self, step).consume_from(buf, offset)[1]
+
+        self._store(step, self._unpack(step, buf, offset, endian))
+
+        return offset + step.size
+
+    def _unpack(self, step, buf, offset, endian):
+        """Unpack the struct of a run from buf at offset."""
+        s = step.struct(endian)
+        if len(buf) - offset < s.size:
+            raise NotEnoughDataException(
+                "Not enough data for %s, expected: %d, got: %d" %
+                (", ".join(step.names), s.size, len(buf) - offset))
+
+        return s.unpack_from(buf, offset)
+
+    def _consume_values(self, buf, offset):
+        """
+        Consume a record of the values from buf at offset, returns the record
+        and the offset just after the consumed data.
+
+        """
+        # Fields without children are converted once consumed, as are fields
+        # depending on their siblings (which need them to be consumed).
+        if not self.fields or not self._skippable:
+            self, offset = self.consume_from(buf, offset)
+            return self.as_values(), offset
+
+        endian = self.endian
+        validation = self.validation
+
+        values = []
+        for step in self._plan:
+            if step.__class__ is not _StructRun:
+                value, offset = getattr(self, step)._consume_values(buf, offset)
+                values.append(value)
+                continue
+
+            unpacked = self._unpack(step, buf, offset, endian)
+            offset += step.size
+
+            # Values which need to be checked go through the fields.
+            if validation not in step.unchecked:
+                self._store(step, unpacked)
+                values.extend(getattr(self, fieldname).value
+                              for fieldname in step.names)
+            elif step.bits is not None:
+                values.extend(step.split(unpacked))
+            else:
+                values.extend(unpacked)
+
+        return tuple.__new__(self.values_class(), values), offset
+
+    def _projection(self, only):
+        """The Projection of this class only is (or selects)."""
+        if not isinstance(only, Projection):
+            return self.projection(only)
+        if only.field_class is not self.__class__:
+            raise TypeError("The projection is of %s, not %s" % (
+                only.field_class.__name__, self.__class__.__name__))
+        return only
+
+    def _consume_projection(self, projection, buf, offset, values):
+        """
+        Consume the fields selected by projection from buf at offset, returns
+        this Field (or a record of the selected values) and the offset just
+        after the whole data of this Field.
+
+        """
+        if projection.steps is None:
+            self, offset = self.consume_from(buf, offset)
+            if values:
+                return projection._values_of(self), offset
+            return self, offset
+
+        endian = self.endian
+        validation = self.validation
+
+        result = []
+        for step in projection.steps:
+            kind = step[0]
+            if kind is _SKIP:
+                _, size, fieldnames = step
+                if len(buf) - offset < size:
+                    raise NotEnoughDataException(
+                        "Not enough data for %s, expected: %d, got: %d" %
+                        (", ".join(fieldnames), size, len(buf) - offset))
+                offset += size
+
+            elif kind is _SKIP_FIELD:
+                offset = getattr(self, step[1])._skip(buf, offset)
+
+            elif kind is _RUN:
+                run = step[1]
+                unpacked = self._unpack(run, buf, offset, endian)
+                offset += run.size
+
+                if not values or validation not in run.unchecked:
+                    self._store(run, unpacked)
+                    if values:
+                        result.extend(getattr(self, fieldname).value
+                                      for fieldname in run.names)
+                elif run.bits is not None:
+                    result.extend(run.split(unpacked))
+                else:
+                    result.extend(unpacked)
+
+            elif kind is _FIELD:
+                field = getattr(self, step[1])
+                if values:
+                    value, offset = field._consume_values(buf, offset)
+                    result.append(value)
+                else:
+                    offset = field.consume_from(buf, offset)[1]
+
+            else:
+                value, offset = getattr(self, step[1])._consume_projection(
+                    step[2], buf, offset, values)
+                result.append(value)
+
+        if values:
+            return tuple.__new__(projection.values_class, result), offset
+        return self, offset
+
+    def _store(self, step, values):
+        """
+        Store the values unpacked for a run in its fields, they're only checked
+        if the validation policy requires it.
+
+        """
+        if step.bits is not None:
+            values = step.split(values)
+
+        if self.validation not in step.unchecked:
+            for fieldname, value in zip(step.names, values):
+                getattr(self, fieldname).value = value
+            return
+
+        # Inline the value setters, without the checks.
+        for fieldname, value in zip(step.names, values):
+            field = getattr(self, fieldname)
+            field._value = value
+            if field._pending is not None:
+                field._pending = None
+        if self._span is not None:
+            self._changed()
+
+    # The buffer and offset of the data of a lazily consumed value which hasn't
+    # been decoded yet.
+    _pending = None
+
+    # The buffer, start and end of the data of a lazily consumed Field, until
+    # it is modified.
+    _span = None
+
+    def _consume_lazy(self, buf, offset):
+        """
+        Lazily consume this Field from buf at offset, returns the offset just
+        after the consumed data.
+
+        """
+        # Fields without children decode their value when it is accessed.
+        if not self.fields:
+            end = self._skip(buf, offset)
+            self._pending = (buf, offset)
+            return end
+
+        self._changed()
+        start = offset
+
+        for step in self._plan:
+            if step.__class__ is not _StructRun:
+                offset = getattr(self, step)._consume_lazy(buf, offset)
+                continue
+
+            if len(buf) - offset < step.size:
+                raise NotEnoughDataException(
+                    "Not enough data for %s, expected: %d, got: %d" %
+                    (", ".join(step.names), step.size, len(buf) - offset))
+
+            if step.bits is None:
+                for fieldname, field_offset in zip(step.names, step.offsets):
+                    getattr(self, fieldname)._pending = (buf, offset + field_offset)
+            else:
+                # BitFields also need the format of their word, the shift and
+                # the mask.
+                for fieldname, field_offset, bits in zip(
+                        step.names, step.offsets, step.bits):
+                    pending = (buf, offset + field_offset)
+                    if bits is not None:
+                        pending += bits
+                    getattr(self, fieldname)._pending = pending
+            offset += step.size
+
+        # The original data is only kept if all the changes of the values are
+        # noticed, unlike e.g. those of the list of a RepeatedField.
+        if self._memoize_size:
+            self._span = (buf, start, offset)
+
+        return offset
+
+    def _resolve(self):
+        """Decode the value of a lazily consumed field."""
+        buf, offset = self._pending
+        self._pending = None
+
+        # Decoding isn't a modification, keep the original data of the parents.
+        spans = []
+        field = self.parent
+        while field is not None:
+            if field._span is not None:
+                spans.append((field, field._span))
+            field = field.parent
+
+        self.consume_from(buf, offset)
+
+        for field, span in spans:
+            field._span = span
+
+    def _changed(self):
+        """
+        Called when a value of this Field (or one of its children) is modified,
+        drops the original data of lazily consumed Fields and the memoized
+        sizes up to the root.
+
+        """
+        # Fields consumed as a whole (e.g. a RepeatedField) don't keep the
+        # original data of their children, so all the ancestors are visited.
+        field = self
+        while field is not None:
+            field._span = None
+            field._size_cache = None
+            field = field.parent
+
+    def as_values(self):
+        """
+        The values of this Field as a compact record (see values_class), or
+        the value of a field without children. Child fields are converted
+        recursively (e.g. a list of fields into a list of records).
+
+        """
+        if not self.fields:
+            return _as_values(self.value)
+
+        return tuple.__new__(self.values_class(), [
+            getattr(self, fieldname).as_values() for fieldname in self.fields])
+
+    @classmethod
+    def values_class(cls):
+        """
+        The class of the records of the values of this Field (see Values),
+        created once per class.
+
+        """
+        values_class = cls.__dict__.get('_values_class')
+        if values_class is None:
+            values_class = cls._values_class = _values_class(
+                cls.__name__ + 'Values', cls, cls.base_fields)
+        return values_class
+
+    @classmethod
+    def projection(cls, only):
+        """
+        Compile the selection of the fields only (a list of names) into a
+        Projection, which is cached. The names of the fields of a child are
+        prefixed by the name of the child and a dot, e.g. 'header.timestamp'.
+
+        Consuming a projection (e.g. consume(data, only=[...])) decodes only
+        the selected fields: runs of fixed-width fields which aren't selected
+        are jumped over and the boundaries of other fields are found without
+        decoding them (see _skip). The offset just after the whole data is
+        still returned, the fields which aren't selected keep their values.
+
+        """
+        projections = cls.__dict__.get('_projections')
+        if projections is None:
+            projections = cls._projections = {}
+
+        key = frozenset(only)
+        projection = projections.get(key)
+        if projection is None:
+            projection = projections[key] = Projection(cls, only)
+        return projection
+
+    @classmethod
+    def iter_records(cls, f, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        """
+        A generator which lazily yields instances of this Field consumed one
+        after another from the filelike f, until the end of f.
+
+        The data is read in chunks of chunk_size bytes and only the data of the
+        current record is kept, so streams of any size can be consumed with a
+        bounded amount of memory. kwargs are passed to the constructor.
+
+        """
+        return _iter_records(cls(**kwargs), f, chunk_size)
+
+    @classmethod
+    def parser(cls, values=False, **kwargs):
+        """
+        A Parser of this Field which can be shared by threads, see Parser.
+        kwargs are passed to the constructor.
+
+        """
+        return Parser(cls, values, **kwargs)
+
+    @classmethod
+    def _batch_run(cls):
+        """
+        The run of all the fields of this class, for classes made only of
+        fixed-width fields (which can be merged) and otherwise a TypeError.
+
+        """
+        plan = cls._merged_plan
+        if len(plan) != 1 or plan[0].__class__ is not _StructRun:
+            raise TypeError(
+                "%s is not made only of fixed-width fields" % cls.__name__)
+        return plan[0]
+
+    @classmethod
+    def unpack_many(cls, buf, endian=DEFAULT_ENDIAN):
+        """
+        Decode all the records of this Field in buf at once, returns a list of
+        tuples of the values of the fields (in order) of each record.
+
+        Only Fields made of fixed-width fields (e.g. StructFields) can be
+        unpacked, with a single struct for all the records (the fields must not
+        declare their own Endianess). buf can be any object supporting the
+        buffer protocol, it must be made only of whole records.
+
+        """
+        step = cls._batch_run()
+        s = step.struct(endian)
+
+        if len(buf) % s.size:
+            raise ValueError(
+                "Data is not made of %d byte records (%d bytes left)" %
+                (s.size, len(buf) % s.size))
+
+        try:
+            records = list(s.iter_unpack(buf))
+        except AttributeError:
+            # Python 2 doesn't have iter_unpack.
+            unpack_from = s.unpack_from
+            records = [unpack_from(buf, offset)
+                       for offset in range(0, len(buf), s.size)]
+
+        if step.bits is not None:
+            split = step.split
+            records = [tuple(split(values)) for values in records]
+        return records
+
+    @classmethod
+    def pack_many(cls, records, endian=DEFAULT_ENDIAN):
+        """
+        Encode an iterable of tuples of the values of the fields (in order, as
+        returned by unpack_many) of records of this Field, returns a bytearray.
+
+        The output is allocated once and each record is packed into it, see
+        unpack_many for the Fields which can be packed.
+
+        """
+        step = cls._batch_run()
+        s = step.struct(endian)
+
+        records = list(records)
+        buf = bytearray(s.size * len(records))
+        pack_into = s.pack_into
+        if step.bits is not None:
+            join = step.join
+            records = [join(values) for values in records]
+
+        offset = 0
+        for values in records:
+            pack_into(buf, offset, *values)
+            offset += s.size
+
+        return buf
+
     def emit(self):
         """
         Returns the serialization of this data to a string. This is a little
         odd, that you have to pass the value into itself.
 
-        TODO Optionally accept a filelike to write to.
+        See emit_into and emit_to to serialize into an existing buffer or
+        straight to a filelike.
         """
+        if self._span is not None:
+            buf, start, end = self._span
+            return _tobytes(buf, start, end)
 
-        # Ask each field to consume bytes and add it as a property (in order).
-        res = b''
-        for fieldname, field in self.fields.items():
-            # Get the value and then ask the field to emit it.
-            res += getattr(self, fieldname).emit()
+        parts = _Parts()
+        self.emit_to(parts)
+        return b''.join(parts)
+
+    def emit_segments(self, threshold=DEFAULT_SEGMENT_THRESHOLD):
+        """
+        Returns the serialization of this data as a list of buffers (e.g. for
+        os.writev or socket.sendmsg, see nibbles.segments), without copying
+        large values into the serialization.
+
+        Values of at least threshold bytes (e.g. the payload of a StringField
+        or CStringField) are segments of their own, referencing the value
+        itself. The data in between (e.g. packed headers) is copied together.
+        An unmodified lazily consumed Field is a view of the consumed buffer.
+
+        """
+        if self._span is not None:
+            buf, start, end = self._span
+            try:
+                return [memoryview(buf)[start:end]]
+            except TypeError:
+                # Python 2 can't view some buffers (e.g. mmap).
+                return [_tobytes(buf, start, end)]
+
+        segments = _Segments(threshold)
+        self.emit_to(segments)
+        return list(segments)
+
+    def emit_into(self, buf, offset=0):
+        """
+        Serialize this data into a writable buffer (e.g. a bytearray or
+        memoryview) starting at offset, the buffer must have at least size()
+        bytes available.
+
+        Returns the offset just after the written data.
+
+        """
+        if self._span is not None:
+            src, start, end = self._span
+            return _write(buf, offset, _tobytes(src, start, end))
+
+        endian = self.endian
+
+        # Ask each field to emit bytes (in order), runs of fixed-width fields
+        # are packed at once.
+        for step in self._plan:
+            if step.__class__ is not _StructRun:
+                offset = getattr(self, step).emit_into(buf, offset)
+                continue
+
+            s = step.struct(endian)
+            if len(buf) - offset < s.size:
+                raise ValueError(
+                    "Not enough space in buffer for %s, expected: %d, got: %d" %
+                    (", ".join(step.names), s.size, len(buf) - offset))
+            values = [getattr(self, fieldname).value for fieldname in step.names]
+            if step.bits is not None:
+                values = step.join(values)
+            s.pack_into(buf, offset, *values)
+            offset += s.size
+
+        return offset
+
+    def emit_to(self, f):
+        """
+        Serialize this data straight to a filelike (anything with a write
+        method), without building the full serialization in memory.
+
+        """
+        if self._span is not None:
+            buf, start, end = self._span
+            f.write(_tobytes(buf, start, end))
+            return
+
+        endian = self.endian
+
+        for step in self._plan:
+            if step.__class__ is not _StructRun:
+                getattr(self, step).emit_to(f)
+                continue
+
+            values = [getattr(self, fieldname).value for fieldname in step.names]
+            if step.bits is not None:
+                values = step.join(values)
+            if step.strings and f.__class__ is _Segments:
+                for part in step.pack_segments(endian, values, f.threshold):
+                    f.write(part)
+                continue
+            f.write(step.struct(endian).pack(*values))
+
+    def _struct_format(self):
+        """
+        The struct format string (without Endianess) of this field if it maps
+        to exactly one value of a struct, otherwise None.
 
-        return res
+        Fields which return a format string can be merged with their neighbours
+        into a single struct.Struct by the parse plan.
+
+        """
+        return None
 
     # The Endianess of the data, by default this inherits from the parent.
     _endian = None
 
+    # The name this field is declared with on its parent's class, if any.
+    _name = None
+
+    # The number of bits of a field which is packed with its neighbours into a
+    # word (i.e. a BitField), otherwise None.
+    _bits = None
+
     @property
     def endian(self):
         if self._endian is None:
@@ -148,6 +1377,8 @@ class BaseField(object):
     @property
     def value(self):
         """Return a Python value for this field."""
+        if self._pending is not None:
+            self._resolve()
         return self._value
 
     @value.setter
@@ -155,6 +1386,12 @@ class BaseField(object):
         """Store a Python value for this field."""
         self._value = value
 
+        if self._pending is not None:
+            self._pending = None
+        parent = self.parent
+        if parent is not None:
+            parent._changed()
+
     def __call__(self):
         """Shorthand for get_value."""
         return self.value
@@ -170,6 +1407,244 @@ class BaseField(object):
         return s
 
 
+class Values(tuple):
+    """
+    The base of the compact records of the values of a Field class (see
+    BaseField.values_class): a tuple of the values of the fields, in order,
+    which are also accessed by name. A record takes much less memory than the
+    Field object it was decoded into.
+
+    """
+    __slots__ = ()
+
+    # The names of the fields and the Field class.
+    _fields = ()
+    _field_class = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (fieldname, value)
+            for fieldname, value in zip(self._fields, self)))
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self))
+
+
+class Parser(object):
+    """
+    Consume records of a Field class from any number of threads at once.
+
+    Consuming modifies the Field, so a Field can't be shared by threads. A
+    Parser holds a prototype which is never modified: each call consumes a new
+    copy of it (cheaper than constructing or deep copying a Field) and returns
+    it, or a record of the values if values is True (see BaseField.as_values).
+
+    kwargs are passed to the constructor of field_class.
+
+    """
+
+    def __init__(self, field_class, values=False, **kwargs):
+        self.field_class = field_class
+        self.values = values
+        self._prototype = field_class(**kwargs)
+
+        # Create the class of the records before it's used by threads.
+        if values:
+            field_class.values_class()
+
+    def parse(self, data):
+        """Consume a record from data, a buffer or a filelike."""
+        field = self._prototype._clone()
+        if not self.values:
+            return field.consume(data)
+
+        # Fields without children (e.g. a CStringField) don't take values.
+        if isinstance(data, _BUFFER_TYPES):
+            return field._consume_values(data, 0)[0]
+        return field.consume(data).as_values()
+
+    def parse_from(self, buf, offset=0):
+        """
+        Consume a record from buf at offset, returns it and the offset just
+        after it.
+
+        """
+        field = self._prototype._clone()
+        if self.values:
+            return field._consume_values(buf, offset)
+        return field.consume_from(buf, offset)
+
+
+def _values_class(name, field_class, fieldnames):
+    """Create a sub-class of Values with fieldnames."""
+    fieldnames = tuple(fieldnames)
+    attrs = {'__slots__': (), '_fields': fieldnames,
+             '_field_class': field_class}
+    for index, fieldname in enumerate(fieldnames):
+        attrs[fieldname] = property(itemgetter(index))
+
+    return type(name, (Values,), attrs)
+
+
+# The kinds of steps of a Projection: jump over a number of bytes, skip a
+# field, unpack (part of) a run, consume a field or a projection of a child.
+_SKIP = 'skip'
+_SKIP_FIELD = 'skip_field'
+_RUN = 'run'
+_FIELD = 'field'
+_CHILD = 'child'
+
+
+def _project_run(step, selected, fields):
+    """
+    The run of the slots of step which are selected, the others are padding
+    (so it has the same size), or None if no slot is.
+
+    """
+    slots = []
+    formats = []
+    padding = 0
+    for slot, format_string in zip(step.slots, step.formats):
+        if isinstance(slot, tuple):
+            slot = tuple(bits for bits in slot if bits[0] in selected)
+        elif slot not in selected:
+            slot = None
+        if not slot:
+            padding += struct.calcsize(DEFAULT_ENDIAN + format_string)
+            continue
+
+        if padding:
+            format_string = b'%dx' % padding + format_string
+            padding = 0
+        slots.append(slot)
+        formats.append(format_string)
+
+    if not slots:
+        return None
+    if padding:
+        formats[-1] += b'%dx' % padding
+    return _StructRun(slots, formats, _unchecked_run(slots, fields))
+
+
+class Projection(object):
+    """
+    A selection of the fields of a Field class which are consumed, compiled
+    into steps (see BaseField.projection).
+
+    Consumed as values, the record only has the selected fields (see
+    values_class).
+
+    """
+
+    def __init__(self, field_class, only):
+        self.field_class = field_class
+        fields = field_class.base_fields
+
+        # The selected fields, with the names selected within children.
+        selected = {}
+        for name in only:
+            fieldname, _, child = name.partition('.')
+            if fieldname not in fields:
+                raise TypeError("Unknown field: %s" % fieldname)
+            if not child:
+                selected[fieldname] = None
+            elif not fields[fieldname].fields:
+                raise TypeError("%s has no fields" % fieldname)
+            elif fieldname not in selected or selected[fieldname] is not None:
+                selected.setdefault(fieldname, []).append(child)
+
+        self.names = tuple(fieldname for fieldname in fields
+                           if fieldname in selected)
+        self.values_class = _values_class(
+            field_class.__name__ + 'Projection', field_class, self.names)
+
+        self.children = dict(
+            (fieldname, fields[fieldname].projection(names))
+            for fieldname, names in selected.items() if names is not None)
+
+        # The siblings of fields depending on them must be consumed, so
+        # everything is.
+        self.steps = None
+        if field_class._skippable:
+            self.steps = self._compile(field_class._merged_plan, fields,
+                                       selected)
+
+    def _compile(self, plan, fields, selected):
+        steps = []
+
+        # The fixed number of bytes (and the names of the fields) to jump over
+        # next.
+        skipped = []
+        size = 0
+
+        for step in plan:
+            step_size = None
+            if step.__class__ is _StructRun:
+                run = _project_run(step, selected, fields)
+                if run is None:
+                    step_size = step.size
+            elif step not in selected:
+                step_size = fields[step]._static_size()
+
+            if step_size is not None:
+                skipped.extend(step.names if step.__class__ is _StructRun
+                               else [step])
+                size += step_size
+                continue
+
+            if size:
+                steps.append((_SKIP, size, tuple(skipped)))
+                skipped = []
+                size = 0
+
+            if step.__class__ is _StructRun:
+                steps.append((_RUN, run))
+            elif step not in selected:
+                steps.append((_SKIP_FIELD, step))
+            elif step in self.children:
+                steps.append((_CHILD, step, self.children[step]))
+            else:
+                steps.append((_FIELD, step))
+
+        if size:
+            steps.append((_SKIP, size, tuple(skipped)))
+        return steps
+
+    def _values_of(self, field):
+        """The record of the selected values of a consumed field."""
+        values = []
+        for fieldname in self.names:
+            child = getattr(field, fieldname)
+            if fieldname in self.children:
+                values.append(self.children[fieldname]._values_of(child))
+            else:
+                values.append(child.as_values())
+        return tuple.__new__(self.values_class, values)
+
+
+def _as_values(value):
+    """The value of a field with any fields in it converted into records."""
+    if isinstance(value, BaseField):
+        return value.as_values()
+    if isinstance(value, list):
+        return [_as_values(item) for item in value]
+    return value
+
+
+def set_validation(validation):
+    """
+    Set the validation policy (one of VALIDATIONS) of consumed values for all
+    the Field classes which don't set their own, returns the previous one.
+
+    """
+    if validation not in VALIDATIONS:
+        raise ValueError("Unknown validation policy: %s" % validation)
+
+    previous = BaseField.validation
+    BaseField.validation = validation
+    return previous
+
+
 class MetaField(type):
     """
     Metaclass that collects Fields declared on the base classes.
@@ -182,11 +1657,19 @@ class MetaField(type):
             if isinstance(value, BaseField):
                 current_fields.append((key, value))
         current_fields.sort(key=lambda x: x[1].creation_counter)
+        for fieldname, field in current_fields:
+            field._name = fieldname
         attrs['declared_fields'] = OrderedDict(current_fields)
 
         new_class = (super(MetaField, mcs)
             .__new__(mcs, name, bases, attrs))
 
+        # The attributes set by a new __init__ may be mutable.
+        if '_clone' in attrs:
+            new_class._shallow_clone = True
+        elif '__init__' in attrs and '_shallow_clone' not in attrs:
+            new_class._shallow_clone = False
+
         # Walk through the MRO.
         declared_fields = OrderedDict()
         for base in reversed(new_class.__mro__):
@@ -203,6 +1686,32 @@ class MetaField(type):
         new_class.base_fields = declared_fields
         new_class.declared_fields = declared_fields
 
+        # Compile the fields into a parse plan once, instead of per record.
+        # The merged plan is kept for the batch methods and projections, the
+        # plan followed field by field may be replaced (e.g. while profiling).
+        new_class._plan = new_class._merged_plan = _build_plan(declared_fields)
+        if declared_fields:
+            new_class._skippable = not any(
+                field._depends_on_parent for field in declared_fields.values())
+
+            # Fixed-size classes know their size up front, otherwise it can
+            # be memoized if it can be for all the fields.
+            new_class._fixed_size = _static_plan_size(
+                new_class._plan, declared_fields)
+            new_class._memoize_size = all(
+                field._memoize_size for field in declared_fields.values())
+
+        # Generate methods specialized for the plan, methods generated for the
+        # plan of a base class mustn't be inherited.
+        if new_class.generate_code:
+            from nibbles.fields.codegen import generate
+            generate(new_class)
+        else:
+            for name in ('consume', 'consume_from', 'emit_into', 'emit_to'):
+                generic = getattr(getattr(new_class, name), '_generic', None)
+                if generic is not None:
+                    setattr(new_class, name, generic)
+
         return new_class
 
 
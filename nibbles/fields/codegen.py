@@ -0,0 +1,280 @@
+"""
+Generate straight-line consume and emit methods specialized for a Field class.
+
+The generic methods of BaseField walk the parse plan for every record: each
+step looks the field up by name, checks the kind of step and goes through the
+value property. Classes which set generate_code = True get methods generated
+(with exec) from their plan instead, where the structs of each run of
+fixed-width fields, the field names and the sizes are inlined.
+
+The generated methods produce the same output (and raise the same errors) as
+the generic ones. Their source can be inspected with source(cls) and shows up
+in tracebacks.
+
+"""
+import linecache
+
+from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields.base import (_BUFFER_TYPES, _Segments, _StructRun,
+                                 _get_struct, BaseField, ENDIANS, VALIDATIONS)
+
+# The methods which are generated.
+METHODS = ('consume', 'consume_from', 'emit_into', 'emit_to')
+
+
+def _not_enough_data(step, got):
+    return ('raise NotEnoughDataException("Not enough data for %s, expected: '
+            '%d, got: %%d" %% (%s))' % (", ".join(step.names), step.size, got))
+
+
+def _values(step):
+    """The names of the locals holding the values of a run."""
+    return ['v%d' % i for i in range(len(step.slots))]
+
+
+def _assignments(cls, step):
+    """Assign the unpacked values of a run to the fields."""
+    from nibbles.fields.ctypes import BitField, StructField
+
+    values = []
+    for slot, value in zip(step.slots, _values(step)):
+        if isinstance(slot, tuple):
+            values += [(fieldname, '(%s >> %d) & %d' % (value, shift, mask))
+                       for fieldname, shift, mask in slot]
+        else:
+            values.append((slot, value))
+
+    lines = []
+    for fieldname, value in values:
+        # Inline the value setters of StructField and BitField, unless they're
+        # overridden.
+        field = cls.base_fields[fieldname]
+        setter = type(field).value
+        if setter is not StructField.value and setter is not BitField.value:
+            lines.append('self.%s.value = %s' % (fieldname, value))
+            continue
+
+        # The value is only checked under the validation policies which
+        # require it (masked BitFields never need to be).
+        unchecked = tuple(sorted(field._unchecked))
+        lines.append('f = self.%s' % fieldname)
+        if len(unchecked) == len(VALIDATIONS):
+            lines.append('f._value = %s' % value)
+        else:
+            lines.append('v = %s' % value)
+            if unchecked:
+                lines += [
+                    'if validation not in %r:' % (unchecked,),
+                    '    f._check_value(v)',
+                ]
+            else:
+                lines.append('f._check_value(v)')
+            lines.append('f._value = v')
+        lines += [
+            'if f._pending is not None:',
+            '    f._pending = None',
+        ]
+    return lines
+
+
+def _consume_source(cls, plan):
+    lines = [
+        'def consume(self, data, lazy=False, values=False, only=None):',
+        '    if isinstance(data, _BUFFER_TYPES):',
+        '        return self.consume_from(data, 0, lazy, values, only)[0]',
+        '    if lazy or values or only is not None:',
+        '        return _generic_consume(self, data, lazy, values, only)',
+        '    if self._span is not None:',
+        '        self._changed()',
+        '    endian = self.endian',
+        '    validation = self.validation',
+    ]
+
+    for i, step in enumerate(plan):
+        if step.__class__ is not _StructRun:
+            lines.append('    self.%s.consume(data)' % step)
+            continue
+
+        lines += [
+            '    raw = data.read(%d)' % step.size,
+            '    if len(raw) < %d:' % step.size,
+            '        ' + _not_enough_data(step, 'len(raw)'),
+            '    %s, = _structs%d[endian].unpack(raw)' % (
+                ', '.join(_values(step)), i),
+        ]
+        lines += ['    ' + line for line in _assignments(cls, step)]
+
+    lines.append('    return self')
+    return lines
+
+
+def _consume_from_source(cls, plan):
+    lines = [
+        'def consume_from(self, buf, offset=0, lazy=False, values=False,',
+        '                 only=None):',
+        '    if lazy or values or only is not None:',
+        '        return _generic_consume_from(self, buf, offset, lazy, values,',
+        '                                     only)',
+        '    if self._span is not None:',
+        '        self._changed()',
+        '    endian = self.endian',
+        '    validation = self.validation',
+    ]
+
+    for i, step in enumerate(plan):
+        if step.__class__ is not _StructRun:
+            lines.append(
+                '    offset = self.%s.consume_from(buf, offset)[1]' % step)
+            continue
+
+        lines += [
+            '    if len(buf) - offset < %d:' % step.size,
+            '        ' + _not_enough_data(step, 'len(buf) - offset'),
+            '    %s, = _structs%d[endian].unpack_from(buf, offset)' % (
+                ', '.join(_values(step)), i),
+        ]
+        lines += ['    ' + line for line in _assignments(cls, step)]
+        lines.append('    offset += %d' % step.size)
+
+    lines.append('    return self, offset')
+    return lines
+
+
+def _arguments(step):
+    arguments = []
+    for slot in step.slots:
+        # Combine the BitFields of a word.
+        if isinstance(slot, tuple):
+            arguments.append(' | '.join(
+                '((self.%s.value & %d) << %d)' % (fieldname, mask, shift)
+                for fieldname, shift, mask in slot))
+        else:
+            arguments.append('self.%s.value' % slot)
+    return ', '.join(arguments)
+
+
+def _emit_into_source(cls, plan):
+    lines = [
+        'def emit_into(self, buf, offset=0):',
+        '    if self._span is not None:',
+        '        return _generic_emit_into(self, buf, offset)',
+        '    endian = self.endian',
+    ]
+
+    for i, step in enumerate(plan):
+        if step.__class__ is not _StructRun:
+            lines.append('    offset = self.%s.emit_into(buf, offset)' % step)
+            continue
+
+        lines += [
+            '    if len(buf) - offset < %d:' % step.size,
+            '        raise ValueError("Not enough space in buffer for %s, '
+            'expected: %d, got: %%d" %% (len(buf) - offset))' % (
+                ", ".join(step.names), step.size),
+            '    _structs%d[endian].pack_into(buf, offset, %s)' % (
+                i, _arguments(step)),
+            '    offset += %d' % step.size,
+        ]
+
+    lines.append('    return offset')
+    return lines
+
+
+def _emit_to_source(cls, plan):
+    lines = [
+        'def emit_to(self, f):',
+        '    if self._span is not None:',
+        '        return _generic_emit_to(self, f)',
+    ]
+
+    # Large strings of runs are written as is by emit_segments.
+    if any(step.__class__ is _StructRun and step.strings for step in plan):
+        lines += [
+            '    if f.__class__ is _Segments:',
+            '        return _generic_emit_to(self, f)',
+        ]
+
+    lines += [
+        '    endian = self.endian',
+        '    write = f.write',
+    ]
+
+    for i, step in enumerate(plan):
+        if step.__class__ is not _StructRun:
+            lines.append('    self.%s.emit_to(f)' % step)
+            continue
+
+        lines.append('    write(_structs%d[endian].pack(%s))' % (
+            i, _arguments(step)))
+
+    return lines
+
+
+_SOURCES = {
+    'consume': _consume_source,
+    'consume_from': _consume_from_source,
+    'emit_into': _emit_into_source,
+    'emit_to': _emit_to_source,
+}
+
+
+def _generated(cls, name):
+    """
+    Whether the method name of cls is generic (or generated), i.e. it can be
+    generated.
+
+    """
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            func = base.__dict__[name]
+            return base is BaseField or hasattr(func, '_generic')
+    return False
+
+
+def generate(cls):
+    """
+    Generate and set the consume and emit methods of cls from its plan.
+
+    Methods which are overridden (by cls or one of its bases) are kept.
+
+    """
+    plan = cls._plan
+    namespace = {
+        '_BUFFER_TYPES': _BUFFER_TYPES,
+        '_Segments': _Segments,
+        'NotEnoughDataException': NotEnoughDataException,
+    }
+    for name in METHODS:
+        namespace['_generic_' + name] = BaseField.__dict__[name]
+
+    # The struct of each run for each Endianess.
+    for i, step in enumerate(plan):
+        if step.__class__ is _StructRun:
+            namespace['_structs%d' % i] = dict(
+                (endian, _get_struct(endian + step.format_string))
+                for endian in ENDIANS)
+
+    names = [name for name in METHODS if _generated(cls, name)]
+    source = '\n\n'.join('\n'.join(_SOURCES[name](cls, plan)) for name in names)
+    source += '\n'
+
+    # Register the source so it shows up in tracebacks.
+    filename = '<nibbles generated %s.%s-%d>' % (
+        cls.__module__, cls.__name__, id(cls))
+    linecache.cache[filename] = (
+        len(source), None, source.splitlines(True), filename)
+
+    exec(compile(source, filename, 'exec'), namespace)
+
+    for name in names:
+        func = namespace[name]
+        func._generic = BaseField.__dict__[name]
+        func.__doc__ = func._generic.__doc__
+        setattr(cls, name, func)
+
+    cls._generated_source = source
+
+
+def source(cls):
+    """The source of the methods generated for cls, or None."""
+    return cls.__dict__.get('_generated_source')
@@ -0,0 +1,324 @@
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields.base import (Field, _BUFFER_TYPES, _seekable, _tobytes,
+                                 _write)
+
+__all__ = ['CompressedField']
+
+# The amount of compressed data read and of data decompressed at once.
+_COMPRESSED_CHUNK_SIZE = 16 * 1024
+
+# The decompressor and compressor (given the compression level, or None for the
+# default) factories of each codec.
+_CODECS = {
+    'zlib': (
+        zlib.decompressobj,
+        lambda level: zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if level is None else level),
+    ),
+    'gzip': (
+        lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+        lambda level: zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+            zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    ),
+    'bz2': (
+        bz2.BZ2Decompressor,
+        lambda level: bz2.BZ2Compressor(9 if level is None else level),
+    ),
+}
+
+if lzma is not None:
+    _CODECS['lzma'] = (
+        lzma.LZMADecompressor,
+        lambda level: lzma.LZMACompressor(preset=level),
+    )
+
+
+def _at_eof(decompressor, output):
+    """
+    Whether decompressor reached the end of the compressed stream. Data
+    decompressed while finding out is appended to output (a bytearray).
+
+    """
+    eof = getattr(decompressor, 'eof', None)
+    if eof is not None:
+        return eof
+    if decompressor.unused_data:
+        return True
+
+    # On Python 2 the end of the stream is only noticed once more data is
+    # given: zlib moves it to unused_data and bz2 raises EOFError.
+    try:
+        probe = decompressor.copy()
+    except AttributeError:
+        try:
+            output += decompressor.decompress(b'')
+        except EOFError:
+            return True
+        return False
+
+    # Before the end the byte is (invalid) compressed data.
+    try:
+        probe.decompress(b'\x00')
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+class _BufferSource(object):
+    """Read compressed data from a buffer, starting at offset."""
+
+    # Data read past the end can be given back.
+    can_unread = True
+
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.offset = offset
+
+    def read(self, size):
+        start = self.offset
+        self.offset = min(start + size, len(self.buf))
+        return _tobytes(self.buf, start, self.offset)
+
+    def unread(self, size):
+        self.offset -= size
+
+
+class _StreamSource(object):
+    """
+    Read compressed data from a filelike. Data read past the end of the
+    compressed stream is given back by moving the position back, streams which
+    can't seek are read byte by byte instead.
+
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.can_unread = _seekable(f)
+
+    def read(self, size):
+        if not self.can_unread:
+            size = 1
+        return self.f.read(size)
+
+    def unread(self, size):
+        if size:
+            self.f.seek(-size, 1)
+
+
+class _Decompressed(object):
+    """
+    A filelike of the data decompressed from source, which is read and
+    decompressed in chunks as the data is needed.
+
+    """
+
+    def __init__(self, decompressor, source):
+        self.decompressor = decompressor
+        self.source = source
+        self.eof = False
+
+        # The decompressed data which hasn't been read.
+        self._buf = bytearray()
+        self._offset = 0
+
+    def _fill(self):
+        """Decompress some more data, returns False at the end of the data."""
+        if self.eof:
+            return False
+        d = self.decompressor
+
+        # Data left over when the output was limited is decompressed first.
+        data = getattr(d, 'unconsumed_tail', b'')
+        if not data:
+            # Nothing can be read past the end if it can't be given back.
+            if not self.source.can_unread and _at_eof(d, self._buf):
+                self.eof = True
+                return False
+            data = self.source.read(_COMPRESSED_CHUNK_SIZE)
+        if not data:
+            filled = len(self._buf)
+            if not _at_eof(d, self._buf):
+                if len(self._buf) > filled:
+                    return True
+                raise NotEnoughDataException(
+                    "End of compressed data not reached")
+            self.eof = True
+            return False
+
+        # The output can only be limited for zlib.
+        if hasattr(d, 'unconsumed_tail'):
+            self._buf += d.decompress(data, _COMPRESSED_CHUNK_SIZE)
+        else:
+            self._buf += d.decompress(data)
+
+        if d.unused_data or getattr(d, 'eof', False):
+            self.eof = True
+        return True
+
+    def peek(self, size=1):
+        if self._offset == len(self._buf):
+            self._fill()
+        return bytes(self._buf[self._offset:])
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) - self._offset < size:
+            if not self._fill():
+                break
+
+        end = len(self._buf)
+        if size >= 0:
+            end = min(self._offset + size, end)
+        data = bytes(self._buf[self._offset:end])
+        self._offset = end
+
+        # Drop the read data once in a while.
+        if self._offset > _COMPRESSED_CHUNK_SIZE:
+            del self._buf[:self._offset]
+            self._offset = 0
+
+        return data
+
+    def skip(self):
+        """
+        Skip to the end of the data, returns the number of bytes which weren't
+        read.
+
+        """
+        skipped = len(self._buf) - self._offset
+        del self._buf[:]
+        self._offset = 0
+
+        while self._fill():
+            skipped += len(self._buf)
+            del self._buf[:]
+
+        return skipped
+
+    def finish(self):
+        """
+        Give the data read past the end of the compressed stream back to the
+        source.
+
+        """
+        self.source.unread(len(self.decompressor.unused_data))
+
+
+class _Compressing(object):
+    """A filelike which compresses the written data into f."""
+
+    def __init__(self, compressor, f):
+        self.compressor = compressor
+        self.f = f
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.f.write(data)
+
+    def flush(self):
+        self.f.write(self.compressor.flush())
+
+
+class CompressedField(Field):
+    """
+    A compressed stream (e.g. zlib) of data which holds another field.
+
+    The data is decompressed in chunks as the inner field consumes it, so the
+    whole decompressed data never needs to be in memory (e.g. for a
+    RepeatedField of many records). Likewise the inner field is compressed as
+    it is emitted.
+
+    The compressed stream ends itself, so it doesn't need to be the last field.
+    To consume it from a stream which can't seek, the stream is read byte by
+    byte.
+
+    """
+
+    def __init__(self, inner, codec='zlib', level=None, *args, **kwargs):
+        """
+        inner is the field the decompressed data is made of, the value is a
+        copy of it.
+
+        codec is one of 'zlib', 'gzip', 'bz2' or 'lzma' (Python 3) and level the
+        compression level used to emit (by default the codec's default).
+
+        """
+        super(CompressedField, self).__init__(*args, **kwargs)
+
+        if codec not in _CODECS:
+            raise ValueError("Unknown codec: %s" % codec)
+        self.codec = codec
+        self.level = level
+
+        self.inner = inner
+        self.value = self._new_value()
+
+    # The compressed size can't be known without compressing the data.
+    _memoize_size = False
+
+    def _new_value(self):
+        field = self.inner._clone()
+        field.parent = self
+        return field
+
+    def _clone(self):
+        new = super(CompressedField, self)._clone()
+        new.value = self.value._clone()
+        new.value.parent = new
+        return new
+
+    def _static_size(self):
+        return None
+
+    def _decompress(self, source):
+        """Consume the value from the compressed data in source."""
+        decompressed = _Decompressed(_CODECS[self.codec][0](), source)
+
+        self.value = self._new_value()
+        self.value.consume(decompressed)
+
+        left = decompressed.skip()
+        if left:
+            raise ValueError("%d bytes of decompressed data were not consumed"
+                             % left)
+        decompressed.finish()
+
+    def consume(self, f):
+        if isinstance(f, _BUFFER_TYPES):
+            return self.consume_from(f)[0]
+
+        self._decompress(_StreamSource(f))
+        return self
+
+    def consume_from(self, buf, offset=0):
+        source = _BufferSource(buf, offset)
+        self._decompress(source)
+        return self, source.offset
+
+    def _skip(self, buf, offset=0):
+        # Decompress (without consuming) to find the end.
+        source = _BufferSource(buf, offset)
+        decompressed = _Decompressed(_CODECS[self.codec][0](), source)
+        decompressed.skip()
+        decompressed.finish()
+        return source.offset
+
+    def size(self):
+        return len(self.emit())
+
+    def emit_into(self, buf, offset=0):
+        return _write(buf, offset, self.emit())
+
+    def emit_to(self, f):
+        compressing = _Compressing(_CODECS[self.codec][1](self.level), f)
+        self.value.emit_to(compressing)
+        compressing.flush()
@@ -1,8 +1,26 @@
 import os
-import struct
 
 from nibbles.exceptions import NotEnoughDataException
-from nibbles.fields.base import Field, _filelike
+from nibbles.fields.base import (Field, _BUFFER_TYPES, _find, _get_struct,
+                                 _read_until, _tobytes, _write, DEFAULT_ENDIAN,
+                                 NO_VALIDATION, TRUSTED_VALIDATION,
+                                 VALIDATIONS)
+
+__all__ = [
+    'StructField', 'PadField', 'CharField', 'ByteField', 'UnsignedByteField',
+    'BoolField', 'ShortField', 'UnsignedShortField', 'IntegerField',
+    'UnsignedIntegerField', 'LongField', 'UnsignedLongField', 'LongLongField',
+    'UnsignedLongLongField', 'FloatField', 'DoubleField', 'StringField',
+    'VoidField', 'BitField', 'RepeatStructFieldMixin', 'TerminatedField',
+    'CStringField', 'PStringField',
+]
+
+
+def _defined(cls, name):
+    """The attribute name of cls as defined (by cls or one of its bases)."""
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            return base.__dict__[name]
 
 
 class StructField(Field):
@@ -15,24 +33,48 @@ class StructField(Field):
         valid_types
     """
 
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
     def __init__(self, value=None, *args, **kwargs):
         super(StructField, self).__init__(*args, **kwargs)
 
         # Build the format string.
-        self.format_string = b'%s' % self._format_string
+        self._set_format_string(b'%s' % self._format_string)
 
         # If a value was given, use the default.
         if value is None:
             value = self.default
         self.value = value
 
+        # Consumed values are stored without the value property if it isn't
+        # overridden, they needn't be checked if struct guarantees what is.
+        if _defined(type(self), 'value') is not StructField.__dict__['value']:
+            self._unchecked = frozenset()
+        elif self._struct_checked():
+            self._unchecked = frozenset([TRUSTED_VALIDATION, NO_VALIDATION])
+        else:
+            self._unchecked = frozenset([NO_VALIDATION])
+
     def _check_value(self, value):
         """Ensure the new value is of the proper type."""
         if not isinstance(value, self.valid_types):
             raise TypeError("Value is not a valid type: %s" % type(value))
 
+    def _struct_checked(self):
+        """
+        Whether the values unpacked by struct always pass _check_value (i.e.
+        the check of the type isn't overridden).
+
+        """
+        return _defined(type(self), '_check_value') in (
+            StructField.__dict__['_check_value'],
+            CharField.__dict__['_check_value'])
+
     @property
     def value(self):
+        if self._pending is not None:
+            self._resolve()
         return self._value
 
     @value.setter
@@ -41,6 +83,12 @@ class StructField(Field):
         self._check_value(value)
         self._value = value
 
+        if self._pending is not None:
+            self._pending = None
+        parent = self.parent
+        if parent is not None:
+            parent._changed()
+
     # The formatting to use for struct unpack/pack, only used if fixed_width is
     # True.
     @property
@@ -57,31 +105,116 @@ class StructField(Field):
     def valid_types(self):
         raise NotImplementedError
 
+    def _set_format_string(self, format_string):
+        self.format_string = format_string
+
+        # The size doesn't depend on the value, nor on the Endianess.
+        self._size = _get_struct(DEFAULT_ENDIAN + format_string).size
+
     def size(self):
-        # value is unused.
-        return struct.calcsize(self.format_string)
+        return self._size
+
+    def _static_size(self):
+        return self._size
+
+    def _skip(self, buf, offset=0):
+        size = self._size
+        if len(buf) - offset < size:
+            raise NotEnoughDataException(
+                "Not enough data, expected: %d, got: %d" %
+                (size, len(buf) - offset))
+        return offset + size
+
+    def _resolve(self):
+        buf, offset = self._pending
+        self._pending = None
+
+        value = _get_struct(self.endian + self.format_string).unpack_from(
+            buf, offset)[0]
+        if self.validation not in self._unchecked:
+            self._check_value(value)
+        self._value = value
+
+    def _store(self, value):
+        """
+        Store a consumed value, it's only checked if the validation policy
+        requires it.
+
+        """
+        if self.validation not in self._unchecked:
+            self.value = value
+            return
+
+        self._value = value
+        if self._pending is not None:
+            self._pending = None
+        parent = self.parent
+        if parent is not None:
+            parent._changed()
 
     def consume(self, f):
-        f = _filelike(f)
+        if isinstance(f, _BUFFER_TYPES):
+            return self.consume_from(f)[0]
 
         # Add the Endianess to the format string.
-        format_string = self.endian + self.format_string
-
-        # Calculate the number of necessary bytes.
-        num_bytes = self.size()
+        s = _get_struct(self.endian + self.format_string)
 
         # Unpack the data.
-        self.value = struct.unpack(format_string, f.read(num_bytes))[0]
+        raw = f.read(s.size)
+        if len(raw) < s.size:
+            raise NotEnoughDataException(
+                "Not enough data, expected: %d, got: %d" % (s.size, len(raw)))
+        self._store(s.unpack(raw)[0])
+
+        return self
+
+    def consume_from(self, buf, offset=0):
+        s = _get_struct(self.endian + self.format_string)
+
+        if len(buf) - offset < s.size:
+            raise NotEnoughDataException(
+                "Not enough data, expected: %d, got: %d" %
+                (s.size, len(buf) - offset))
+        self._store(s.unpack_from(buf, offset)[0])
+
+        return self, offset + s.size
 
     def emit(self):
-        format_string = self.endian + self.format_string
+        return _get_struct(self.endian + self.format_string).pack(self.value)
+
+    def emit_into(self, buf, offset=0):
+        s = _get_struct(self.endian + self.format_string)
+
+        if len(buf) - offset < s.size:
+            raise ValueError(
+                "Not enough space in buffer, expected: %d, got: %d" %
+                (s.size, len(buf) - offset))
+        s.pack_into(buf, offset, self.value)
+
+        return offset + s.size
+
+    def emit_to(self, f):
+        f.write(self.emit())
 
-        return struct.pack(format_string, self.value)
+    def _struct_format(self):
+        # A sub-class consuming or emitting its data itself can't be merged
+        # into a run, which would bypass it. The definitions are looked up on
+        # each call since they're replaced while profiling.
+        cls = type(self)
+        for name in _IO_METHODS:
+            if _defined(cls, name) not in (StructField.__dict__[name],
+                                           StringField.__dict__.get(name)):
+                return None
+        return self.format_string
 
     def __call__(self):
         return self.value
 
 
+# The methods reading and writing the data of a StructField.
+_IO_METHODS = ('consume', 'consume_from', 'emit', 'emit_into', 'emit_to')
+
+
 class PadField(StructField):
     _format_string = b'x'
     # TODO
@@ -107,6 +240,18 @@ class ByteField(StructField):
             raise ValueError("Value is out of range %d <= %d <= %d" %
                              (self.min_value, value, self.max_value))
 
+    def _struct_checked(self):
+        # The range of the format must be within the range of the field.
+        if _defined(type(self), '_check_value') is not ByteField.__dict__[
+                '_check_value']:
+            return False
+        bits = 8 * self._size
+        if self.format_string.islower():
+            low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+        else:
+            low, high = 0, (1 << bits) - 1
+        return self.min_value <= low and high <= self.max_value
+
     _format_string = b'b'
     valid_types = (int, long)
     default = 0
@@ -185,51 +330,174 @@ class StringField(StructField):
     default = b''
     valid_types = (str, bytes)
 
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
     def __init__(self, length=0, *args, **kwargs):
         super(StringField, self).__init__(*args, **kwargs)
 
         # Allow strings to be multiple characters.
-        self.format_string = b'%d%s' % (length, self._format_string)
+        self._set_format_string(b'%d%s' % (length, self._format_string))
+        self.length = length
+
+    def emit_to(self, f):
+        # A value of the full length is written as is, instead of a copy packed
+        # by struct (which pads or truncates other values).
+        if len(self.value) == self.length:
+            f.write(self.value)
+        else:
+            super(StringField, self).emit_to(f)
 
 
 class VoidField(StructField):
     _format_string = b'P'
 
 
+class BitField(Field):
+    """
+    An unsigned integer of a number of bits.
+
+    Consecutive BitFields declared on a Field are packed (most significant bit
+    first) into a word of 8, 16, 32 or 64 bits, with the Endianess of the
+    parent. The word is read and written at once, together with the
+    neighbouring fixed-width fields.
+    """
+
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
+    def __init__(self, bits=1, value=0, *args, **kwargs):
+        super(BitField, self).__init__(*args, **kwargs)
+
+        if not 1 <= bits <= 64:
+            raise ValueError("BitFields have 1 to 64 bits, got: %d" % bits)
+        self._bits = bits
+        self.max_value = (1 << bits) - 1
+        self.value = value
+
+        # The masked values are always in range, see StructField.
+        if _defined(type(self), 'value') is not BitField.__dict__['value']:
+            self._unchecked = frozenset()
+        elif (_defined(type(self), '_check_value') is
+                BitField.__dict__['_check_value']):
+            self._unchecked = frozenset(VALIDATIONS)
+        else:
+            self._unchecked = frozenset([NO_VALIDATION])
+
+    def _check_value(self, value):
+        if not isinstance(value, (int, long)):
+            raise TypeError("Value is not a valid type: %s" % type(value))
+        if value < 0 or self.max_value < value:
+            raise ValueError("Value is out of range 0 <= %d <= %d" %
+                             (value, self.max_value))
+
+    @property
+    def value(self):
+        if self._pending is not None:
+            self._resolve()
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        """Store a Python value for this field."""
+        self._check_value(value)
+        self._value = value
+
+        if self._pending is not None:
+            self._pending = None
+        parent = self.parent
+        if parent is not None:
+            parent._changed()
+
+    def _resolve(self):
+        buf, offset, format_string, shift, mask = self._pending
+        self._pending = None
+
+        word = _get_struct(self.parent.endian + format_string).unpack_from(
+            buf, offset)[0]
+        self._value = (word >> shift) & mask
+
+    def _standalone(self, *args, **kwargs):
+        raise TypeError("BitFields can only be used as part of a Field")
+
+    # A BitField on its own doesn't fill a whole number of bytes.
+    consume = consume_from = emit = emit_into = emit_to = size = _standalone
+
+    def __call__(self):
+        return self.value
+
+
 class RepeatStructFieldMixin(object):
     """A mixin to have a field be repeated multiple times."""
 
     # ff
 
 
-class CStringField(Field):
-    def __init__(self, value=b'', *args, **kwargs):
-        super(CStringField, self).__init__(*args, **kwargs)
+class TerminatedField(Field):
+    """A string which ends with a terminator (which isn't part of the value)."""
+
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
+    def __init__(self, value=b'', terminator=b'\x00', *args, **kwargs):
+        super(TerminatedField, self).__init__(*args, **kwargs)
 
         if not isinstance(value, (str, bytes)):
             raise TypeError("Value is not a string type: %s" % type(value))
+        if not terminator:
+            raise ValueError("The terminator must not be empty")
+        self.terminator = terminator
         self.value = value
 
     def size(self):
-        return len(self.value) + 1
+        return len(self.value) + len(self.terminator)
+
+    def _static_size(self):
+        return None
+
+    def _skip(self, buf, offset=0):
+        end = _find(buf, self.terminator, offset)
+        if end == -1:
+            raise NotEnoughDataException("End of string not reached")
+        return end + len(self.terminator)
 
     def consume(self, f):
-        f = _filelike(f)
+        if isinstance(f, _BUFFER_TYPES):
+            return self.consume_from(f)[0]
+
+        self.value = _read_until(f, self.terminator)
+
+        return self
 
-        raw = b''
-        # Read until a null-byte is hit.
-        char = f.read(1)
-        while char != b'\x00':
-            if char == b'':
-                raise NotEnoughDataException("End of C-string not reached")
+    def consume_from(self, buf, offset=0):
+        end = _find(buf, self.terminator, offset)
+        if end == -1:
+            raise NotEnoughDataException("End of string not reached")
 
-            raw += char
-            char = f.read(1)
+        self.value = _tobytes(buf, offset, end)
 
-        self.value = raw
+        return self, end + len(self.terminator)
 
     def emit(self):
-        return self.value + b'\x00'
+        return self.value + self.terminator
+
+    def emit_into(self, buf, offset=0):
+        offset = _write(buf, offset, self.value)
+        return _write(buf, offset, self.terminator)
+
+    def emit_to(self, f):
+        f.write(self.value)
+        f.write(self.terminator)
+
+
+class CStringField(TerminatedField):
+    """A null-terminated string."""
+
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
+    def __init__(self, value=b'', *args, **kwargs):
+        super(CStringField, self).__init__(value, b'\x00', *args, **kwargs)
 
 
 class PStringField(CStringField):
@@ -237,7 +505,8 @@ class PStringField(CStringField):
     own."""
 
     def consume(self, f):
-        f = _filelike(f)
+        if isinstance(f, _BUFFER_TYPES):
+            return self.consume_from(f)[0]
 
         # The length is the first byte
         length = f.read(1)
@@ -253,7 +522,37 @@ class PStringField(CStringField):
                 "Not enough data for P-string, expected: %d, got: %d" %
                 (length, len(self.value)))
 
+        return self
+
+    def _skip(self, buf, offset=0):
+        # The length is the first byte
+        if offset >= len(buf):
+            raise NotEnoughDataException("0-length string is invalid P-string")
+        length = _get_struct(b'!B').unpack_from(buf, offset)[0]
+        offset += 1
+
+        if len(buf) - offset < length:
+            raise NotEnoughDataException(
+                "Not enough data for P-string, expected: %d, got: %d" %
+                (length, len(buf) - offset))
+
+        return offset + length
+
+    def consume_from(self, buf, offset=0):
+        end = self._skip(buf, offset)
+        self.value = _tobytes(buf, offset + 1, end)
+
+        return self, end
+
     def emit(self):
         # Remember the size is total number of bytes, but P-strings just include
         # the number of bytes *after* the length byte.
         return chr(self.size() - 1) + self.value
+
+    def emit_to(self, f):
+        f.write(chr(self.size() - 1))
+        f.write(self.value)
+
+    def emit_into(self, buf, offset=0):
+        offset = _write(buf, offset, chr(self.size() - 1))
+        return _write(buf, offset, self.value)
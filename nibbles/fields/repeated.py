@@ -1,36 +1,334 @@
-from copy import deepcopy
+from collections import namedtuple, OrderedDict
+from copy import copy, deepcopy
+import mmap
+import threading
 
-from .base import _filelike, Field
+from nibbles.exceptions import NotEnoughDataException
+from . import arrays
+from .base import _BUFFER_TYPES, _iter_records, _tobytes, _write, Field
+
+__all__ = ['RepeatedField', 'CacheInfo', 'DependentField', 'ChoiceField']
 
 
 class RepeatedField(Field):
-    def __init__(self, repeated, args=(), kwargs={}, *_args, **_kwargs):
+    # The list of fields can be modified in place.
+    _memoize_size = False
+
+    def __init__(self, repeated, args=(), kwargs={}, as_array=False, *_args, **_kwargs):
+        """
+        repeated is the field to repeat until the end of the data.
+
+        If as_array is True, repeated must be a fixed-size field and the value
+        is decoded at once into a NumPy structured array (a view on the
+        consumed buffer) instead of a list of fields. This requires NumPy.
+
+        """
         super(RepeatedField, self).__init__(*_args, **_kwargs)
 
         # The field to repeat.
         self.repeated = repeated
         self.value = []
 
-    def consume(self, data):
-        data = _filelike(data)
+        self.as_array = as_array
+        if as_array:
+            # Ensure the field can be represented as an array.
+            arrays.dtype_for(repeated, self.endian)
+
+    def _dtype(self):
+        """The NumPy dtype of the repeated field, when used as an array."""
+        return arrays.dtype_for(self.repeated, self.endian)
+
+    def _clone(self):
+        new = super(RepeatedField, self)._clone()
+        if self.as_array:
+            new.value = copy(self.value)
+            return new
+
+        new.value = [field._clone() for field in self.value]
+        for field in new.value:
+            field.parent = new
+        return new
+
+    def consume(self, data, values=False):
+        """
+        If values is True, a list of compact records of the values of the
+        repeated field is returned instead (see Field.as_values).
+
+        """
+        if isinstance(data, _BUFFER_TYPES):
+            return self.consume_from(data, values=values)[0]
+
+        # The field is repeated until the end of the data.
+        if self.as_array:
+            return self.consume_from(data.read(), values=values)[0]
+
+        records = _iter_records(self.repeated, data, parent=self)
+        if values:
+            return [record.as_values() for record in records]
+        self.value = list(records)
+
+        return self
+
+    def consume_from(self, buf, offset=0, values=False):
+        if values:
+            return self._consume_values(buf, offset)
+        if self.as_array:
+            return self._consume_array(buf, offset)
+
+        self.value = []
 
         # While there's still data, then parse more objects.
-        while data.len < data.tell():
+        end = len(buf)
+        while offset < end:
             # Make a new copy of the field.
-            field = deepcopy(self.repeated)
+            field = self.repeated._clone()
+            field.parent = self
             # Parse data.
-            self.value.append(field.consume(data))
+            field, offset = field.consume_from(buf, offset)
+            self.value.append(field)
+
+        return self, offset
+
+    def _consume_values(self, buf, offset):
+        if self.as_array:
+            offset = self._consume_array(buf, offset)[1]
+            return self.value, offset
+
+        # A single copy of the field is consumed again for each record.
+        field = self.repeated._clone()
+        field.parent = self
+
+        records = []
+        end = len(buf)
+        while offset < end:
+            record, offset = field._consume_values(buf, offset)
+            records.append(record)
+
+        return records, offset
+
+    def _static_size(self):
+        return None
+
+    def _skip(self, buf, offset=0):
+        # The field is repeated until the end of the data.
+        if self.as_array:
+            self._array_count(buf, offset, self._dtype())
+        return len(buf)
+
+    def _array_count(self, buf, offset, dtype):
+        """The number of items of dtype in buf after offset."""
+        count, remainder = divmod(len(buf) - offset, dtype.itemsize)
+        if remainder:
+            raise NotEnoughDataException(
+                "Not enough data for the last item, expected: %d, got: %d" %
+                (dtype.itemsize, remainder))
+        return count
+
+    def _consume_array(self, buf, offset):
+        dtype = self._dtype()
+        count = self._array_count(buf, offset, dtype)
+
+        self.value = arrays.numpy.frombuffer(buf, dtype, count, offset)
+
+        # A view of a memory-mapped file would be invalid once it's closed
+        # (e.g. by RecordFile or in parallel_parse), the items are copied.
+        if isinstance(getattr(buf, 'obj', buf), mmap.mmap):
+            self.value = self.value.copy()
+
+        return self, offset + count * dtype.itemsize
+
+    def _array(self):
+        """The value as an array with the proper dtype (e.g. Endianess)."""
+        return arrays.numpy.asarray(self.value, self._dtype())
+
+    def size(self):
+        if self.as_array:
+            return self._array().nbytes
+
+        item_size = self.repeated._static_size()
+        if item_size is not None:
+            return len(self.value) * item_size
+        return sum(field.size() for field in self.value)
+
+    def emit(self):
+        if self.as_array:
+            return self._array().tobytes()
+        return b''.join(field.emit() for field in self.value)
+
+    def emit_into(self, buf, offset=0):
+        if self.as_array:
+            return _write(buf, offset, self._array().tobytes())
+
+        for field in self.value:
+            offset = field.emit_into(buf, offset)
+        return offset
+
+    def emit_to(self, f):
+        if self.as_array:
+            f.write(self._array().tobytes())
+            return
+
+        for field in self.value:
+            field.emit_to(f)
+
+
+# The statistics of the cache of a DependentField, like functools.lru_cache.
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class _LRUCache(object):
+    """
+    A mapping of at most maxsize items, the least recently used item is dropped
+    first. Counts the hits and misses of get.
+
+    It can be used by multiple threads (e.g. by the copies of a DependentField
+    consumed by a shared Parser).
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The item of key (which becomes the most recently used) or None."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._items[key] = value
+            return value
+
+    # Locks can't be pickled nor copied, a copy (e.g. of a field sent to
+    # another process) has a lock of its own.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._items))
+
+    def clear(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self._items.clear()
+
+
+class _CreatedField(Field):
+    """
+    A field whose value is another field, created from the values of its
+    siblings when data is consumed. Sub-classes implement _create.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_CreatedField, self).__init__(*args, **kwargs)
+
+        # The field once it is created.
+        self.value = None
+
+    _depends_on_parent = True
+
+    # The size of the created field isn't memoized by its parents.
+    _memoize_size = False
+
+    def _static_size(self):
+        return None
+
+    def _skip(self, buf, offset=0):
+        return self._create().consume_from(buf, offset)[1]
+
+    def _consume_lazy(self, buf, offset):
+        # The siblings are needed to create the field, which is done eagerly.
+        return self.consume_from(buf, offset)[1]
+
+    def _clone(self):
+        new = super(_CreatedField, self)._clone()
+        if self.value is not None:
+            new.value = self.value._clone()
+            new.value.parent = new
+        return new
+
+    def _sibling(self, attribute):
+        """
+        The value of attribute of the parent: the value of a field, otherwise
+        the attribute itself (e.g. a property).
+
+        """
+        field = getattr(self.parent, attribute)
+        if isinstance(field, Field):
+            return field()
+        # TODO Support callables?
+        return field
+
+    def _create(self):
+        """Create an instance of the field from the current parent."""
+        raise NotImplementedError
+
+    def consume(self, data):
+        # Finally create the class and consume data.
+        self.value = self._create()
+        self.value.consume(data)
 
         return self
 
+    def consume_from(self, buf, offset=0):
+        self.value = self._create()
+        offset = self.value.consume_from(buf, offset)[1]
+
+        return self, offset
+
+    # Until data is consumed there is no field, which is empty.
+    def size(self):
+        if self.value is None:
+            return 0
+        return self.value.size()
+
+    def emit(self):
+        if self.value is None:
+            return b''
+        return self.value.emit()
 
-class DependentField(Field):
+    def emit_into(self, buf, offset=0):
+        if self.value is None:
+            return offset
+        return self.value.emit_into(buf, offset)
+
+    def emit_to(self, f):
+        if self.value is not None:
+            self.value.emit_to(f)
+
+
+class DependentField(_CreatedField):
     """
     A field where one of the constructor arguments depends on the value of
     another field. Replaces itself with the constructed field.
     """
 
-    def __init__(self, field_class, args=(), kwargs={}, dep_kwargs={}, *_args, **_kwargs):
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
+    def __init__(self, field_class, args=(), kwargs={}, dep_kwargs={}, cache_size=128, *_args, **_kwargs):
         """
         args and kwargs get passed to the callable field_class directly,
         dep_kargs is a mapping of keyword to a string which is an attribute on
@@ -39,6 +337,12 @@ class DependentField(Field):
         The attribute can be a field (in which case the value of it is used) or
         a property which will be directly used.
 
+        The fields created for the last cache_size distinct values of the
+        attributes are cached and copied, instead of creating a new field for
+        every record. The cache is shared by the copies of this field (e.g. the
+        instances of the class it's declared on), set cache_size to 0 to
+        disable it.
+
         """
 
         super(DependentField, self).__init__(*_args, **_kwargs)
@@ -47,26 +351,147 @@ class DependentField(Field):
         self.args = args
         self.kwargs = kwargs
         self.dep_kwargs = dep_kwargs
+        self._cache = _LRUCache(cache_size) if cache_size else None
 
-        # The field once it is created.
-        self.value = None
+    def _references(self):
+        return list(self.dep_kwargs.values())
 
-    def consume(self, data):
-        # Create an instance of the field.
-        kwargs = deepcopy(self.kwargs)
-        for keyword, attribute in self.dep_kwargs.items():
-            field = getattr(self.parent, attribute)
-            if isinstance(field, Field):
-                value = field()
-            # TODO Support callables?
+    def _create(self):
+        dependencies = [(keyword, self._sibling(attribute))
+                        for keyword, attribute in self.dep_kwargs.items()]
+
+        # Copy the field created (once) for these values.
+        cache = self._cache
+        if cache is not None:
+            key = tuple(dependencies)
+            try:
+                prototype = cache.get(key)
+            except TypeError:
+                # Unhashable values aren't cached.
+                pass
             else:
-                value = field
+                if prototype is None:
+                    prototype = self._construct(dependencies)
+                    cache.set(key, prototype)
+                field = prototype._clone()
+                field.parent = self
+                return field
 
-            # Update kwargs.
-            kwargs[keyword] = value
+        field = self._construct(dependencies)
+        field.parent = self
+        return field
 
-        # Finally create the class and consume data.
-        self.value = self.field_class(*self.args, **kwargs)
-        self.value.consume(data)
+    def _construct(self, dependencies):
+        """Construct the field given the (keyword, value) of the attributes."""
+        kwargs = deepcopy(self.kwargs)
+        kwargs.update(dependencies)
+        return self.field_class(*self.args, **kwargs)
+
+    def cache_info(self):
+        """
+        The hits, misses, maximum and current size of the cache of the created
+        fields (shared by the copies of this field), or None if it's disabled.
+
+        """
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def cache_clear(self):
+        if self._cache is not None:
+            self._cache.clear()
+
+
+class _RawField(Field):
+    """The rest of the data, as bytes."""
+
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
+    def __init__(self, value=b'', *args, **kwargs):
+        super(_RawField, self).__init__(*args, **kwargs)
+        self.value = value
+
+    def _static_size(self):
+        return None
+
+    def _skip(self, buf, offset=0):
+        return len(buf)
+
+    def consume(self, f):
+        if isinstance(f, _BUFFER_TYPES):
+            return self.consume_from(f)[0]
 
+        self.value = f.read()
         return self
+
+    def consume_from(self, buf, offset=0):
+        self.value = _tobytes(buf, offset, len(buf))
+        return self, len(buf)
+
+    def size(self):
+        return len(self.value)
+
+    def emit(self):
+        return self.value
+
+    def emit_into(self, buf, offset=0):
+        return _write(buf, offset, self.value)
+
+    def emit_to(self, f):
+        f.write(self.value)
+
+
+def _prototype(field):
+    """A field given as a Field class is instantiated."""
+    if isinstance(field, type):
+        return field()
+    return field
+
+
+class ChoiceField(_CreatedField):
+    """
+    A field whose layout is chosen by the value of another field (e.g. a type
+    code) out of a mapping of values to fields, like a tagged union. Replaces
+    itself with a copy of the chosen field.
+    """
+
+    # The attributes set by __init__ are shared by the clones.
+    _shallow_clone = True
+
+    def __init__(self, selector, choices, default=None, *args, **kwargs):
+        """
+        selector is the name of an attribute on the parent (see DependentField)
+        and choices a mapping of its values to fields (or Field classes), which
+        are copied for each record.
+
+        Values without a choice use the default field, by default the rest of
+        the data is consumed as bytes.
+
+        """
+        super(ChoiceField, self).__init__(*args, **kwargs)
+
+        self.selector = selector
+        self.choices = dict((key, _prototype(field))
+                            for key, field in choices.items())
+        if default is None:
+            default = _RawField()
+        self.default = _prototype(default)
+
+    def _references(self):
+        return [self.selector]
+
+    def _create(self):
+        prototype = self.choices.get(self._sibling(self.selector), self.default)
+        field = prototype._clone()
+        field.parent = self
+        return field
+
+    def select(self):
+        """
+        Replace the value with a new copy of the field chosen by the current
+        value of the selector (e.g. to build a record), which is returned.
+
+        """
+        self.value = self._create()
+        return self.value
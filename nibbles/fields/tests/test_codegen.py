@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+
+from io import BytesIO
+from unittest import TestCase
+
+from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields import (ByteField, CStringField, Field, LITTLE_ENDIAN,
+                            ShortField, UnsignedIntegerField)
+from nibbles.fields.base import BaseField
+from nibbles.fields import codegen
+
+
+class Inner(Field):
+    code = ByteField()
+    description = CStringField()
+
+
+class Generic(Field):
+    a = ShortField()
+    b = UnsignedIntegerField()
+    inner = Inner()
+    c = ByteField()
+
+
+class Generated(Generic):
+    generate_code = True
+
+
+DATA = b'\x00\x01\x00\x00\x00\x02\x03abc\x00\x04'
+
+
+class TestGenerate(TestCase):
+    def test_source(self):
+        source = codegen.source(Generated)
+        self.assertIn('def consume_from(self, buf, offset=0, lazy=False, '
+                      'values=False,', source)
+        self.assertIn('self.inner.consume_from(buf, offset)', source)
+        self.assertIsNone(codegen.source(Generic))
+        self.assertIsNot(Generated.consume_from, Generic.consume_from)
+
+    def test_consume(self):
+        for data in (DATA, BytesIO(DATA)):
+            f = Generated().consume(data)
+            self.assertEqual((f.a(), f.b(), f.inner.description(), f.c()),
+                             (1, 2, b'abc', 4))
+
+        f, offset = Generated().consume_from(b'\x00' + DATA, 1)
+        self.assertEqual(offset, len(DATA) + 1)
+        self.assertEqual(f.c(), 4)
+
+    def test_identical(self):
+        """The generated methods give the same output as the generic ones."""
+        for endian in (None, LITTLE_ENDIAN):
+            generic = Generic(endian=endian).consume(DATA)
+            generated = Generated(endian=endian).consume(DATA)
+            self.assertEqual(generated.emit(), generic.emit())
+            self.assertEqual(generated.emit(), DATA)
+
+            buf = bytearray(len(DATA) + 2)
+            self.assertEqual(generated.emit_into(buf, 1), len(DATA) + 1)
+            self.assertEqual(bytes(buf[1:-1]), generic.emit())
+
+    def test_errors(self):
+        for data in (lambda: DATA[:3], lambda: BytesIO(DATA[:3])):
+            with self.assertRaises(NotEnoughDataException) as generic:
+                Generic().consume(data())
+            with self.assertRaises(NotEnoughDataException) as generated:
+                Generated().consume(data())
+            self.assertEqual(str(generated.exception),
+                             str(generic.exception))
+
+        self.assertRaises(ValueError, Generated().emit_into, bytearray(3))
+
+    def test_lazy(self):
+        f = Generated().consume(DATA, lazy=True)
+        self.assertEqual(f.inner.description(), b'abc')
+        f.a.value = 5
+        self.assertEqual(f.emit(), b'\x00\x05' + DATA[2:])
+
+    def test_inheritance(self):
+        """Sub-classes get methods generated for their own plan."""
+        class Extended(Generated):
+            d = ByteField()
+
+        class NotGenerated(Generated):
+            generate_code = False
+            d = ByteField()
+
+        for cls in (Extended, NotGenerated):
+            f = cls().consume(DATA + b'\x05')
+            self.assertEqual(f.d(), 5)
+            self.assertEqual(f.emit(), DATA + b'\x05')
+
+        self.assertIs(NotGenerated.__dict__['consume_from'],
+                      BaseField.__dict__['consume_from'])
+
+    def test_overridden(self):
+        """Methods which are overridden aren't generated."""
+        class Overridden(Field):
+            generate_code = True
+            a = ByteField()
+
+            def emit_to(self, f):
+                f.write(b'!')
+
+        self.assertEqual(Overridden().emit(), b'!')
+        self.assertIn('def consume(', codegen.source(Overridden))
+        self.assertNotIn('def emit_to(', codegen.source(Overridden))
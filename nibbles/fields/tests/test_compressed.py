@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+
+import bz2
+from io import BytesIO, RawIOBase
+from unittest import TestCase, skipIf
+import zlib
+
+from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields import (ByteField, CStringField, Field, RepeatedField,
+                            UnsignedShortField)
+from nibbles.fields import compressed
+from nibbles.fields.compressed import CompressedField
+
+
+class Record(Field):
+    code = ByteField()
+    name = CStringField()
+
+
+class Message(Field):
+    kind = ByteField()
+    records = CompressedField(RepeatedField(Record()))
+    trailer = UnsignedShortField()
+
+
+RECORDS = b''.join(Record(code=i % 100, name=b'record %d' % i).emit()
+                   for i in range(1000))
+DATA = b'\x01' + zlib.compress(RECORDS) + b'\x00\x02'
+
+
+class Unseekable(RawIOBase):
+    def __init__(self, data):
+        self.f = BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class TestCompressedField(TestCase):
+    def check(self, m):
+        self.assertEqual(m.kind(), 1)
+        records = m.records.value.value
+        self.assertEqual(len(records), 1000)
+        self.assertEqual(records[999].name(), b'record 999')
+        self.assertEqual(m.trailer(), 2)
+
+    def test_consume(self):
+        self.check(Message().consume(DATA))
+
+    def test_consume_from(self):
+        m, offset = Message().consume_from(b'\xff' + DATA + b'\xff', 1)
+        self.check(m)
+        self.assertEqual(offset, len(DATA) + 1)
+
+    def test_stream(self):
+        f = BytesIO(DATA + b'\xff')
+        self.check(Message().consume(f))
+        self.assertEqual(f.read(), b'\xff')
+
+    def test_unseekable(self):
+        f = Unseekable(DATA + b'\xff')
+        self.check(Message().consume(f))
+        self.assertEqual(f.read(), b'\xff')
+
+    def test_unseekable_bz2(self):
+        """No decompressed data is lost looking for the end of the stream."""
+        class Bz2Message(Message):
+            records = CompressedField(RepeatedField(Record()), codec='bz2')
+
+        data = b'\x01' + bz2.compress(RECORDS) + b'\x00\x02'
+        f = Unseekable(data + b'\xff')
+        self.check(Bz2Message().consume(f))
+        self.assertEqual(f.read(), b'\xff')
+
+        decompressed = compressed._Decompressed(
+            bz2.BZ2Decompressor(), compressed._StreamSource(
+                Unseekable(bz2.compress(RECORDS))))
+        self.assertEqual(decompressed.read(), RECORDS)
+
+    def test_emit(self):
+        m = Message().consume(DATA)
+        data = m.emit()
+        self.assertEqual(zlib.decompress(data[1:-2]), RECORDS)
+        self.check(Message().consume(data))
+        self.assertEqual(m.size(), len(data))
+
+        f = BytesIO()
+        m.emit_to(f)
+        self.assertEqual(f.getvalue(), data)
+
+    def test_construct(self):
+        f = CompressedField(Record(), codec='gzip')
+        f.value.code.value = 5
+        f.value.name.value = b'abc'
+        self.assertEqual(zlib.decompress(f.emit(), 16 + zlib.MAX_WBITS),
+                         b'\x05abc\x00')
+
+    def test_codecs(self):
+        data = b'\x05abc\x00'
+        for codec, compress in (('zlib', zlib.compress), ('bz2', bz2.compress)):
+            f = CompressedField(Record(), codec=codec).consume(
+                compress(data) + b'\xff')
+            self.assertEqual(f.value.name(), b'abc')
+            self.assertEqual(CompressedField(Record(), codec=codec).consume(
+                f.emit()).value.code(), 5)
+
+    @skipIf(compressed.lzma is None, "lzma is not available")
+    def test_lzma(self):
+        f = CompressedField(Record(), codec='lzma').consume(
+            compressed.lzma.compress(b'\x05abc\x00'))
+        self.assertEqual(f.value.name(), b'abc')
+
+    def test_errors(self):
+        self.assertRaises(ValueError, CompressedField, Record(), codec='zip')
+        self.assertRaises(NotEnoughDataException, Message().consume, DATA[:50])
+
+        # All of the decompressed data must be consumed.
+        self.assertRaises(ValueError, CompressedField(Record()).consume,
+                          zlib.compress(b'\x05abc\x00\x06'))
+
+    def test_skip(self):
+        self.assertEqual(Message()._skip(DATA + b'\xff'), len(DATA))
+
+    def test_lazy(self):
+        m = Message().consume(DATA, lazy=True)
+        self.assertEqual(m.trailer(), 2)
+        self.check(m)
+
+    def test_lazy_modified(self):
+        m = Message().consume(bytearray(DATA), lazy=True)
+        m.records.value.value[0].name.value = b'first'
+        data = m.emit()
+        self.assertEqual(Message().consume(data).records.value.value[0]
+                         .name(), b'first')
+
+    def test_bounded(self):
+        """The decompressed data isn't kept once consumed."""
+        buffered = []
+
+        class Tracked(compressed._Decompressed):
+            def read(self, size=-1):
+                buffered.append(len(self._buf))
+                return super(Tracked, self).read(size)
+
+        original = compressed._Decompressed
+        compressed._Decompressed = Tracked
+        try:
+            data = zlib.compress(RECORDS * 20)
+            f = CompressedField(RepeatedField(Record())).consume(data)
+        finally:
+            compressed._Decompressed = original
+
+        self.assertEqual(len(f.value.value), 20000)
+        self.assertLess(max(buffered), len(RECORDS * 20) // 2)
@@ -1,6 +1,12 @@
+import mmap
+from io import BufferedReader, BytesIO, RawIOBase
+from tempfile import TemporaryFile
 from unittest import TestCase
 
 from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields.base import (Field, LITTLE_ENDIAN, NO_VALIDATION,
+                                 STRICT_VALIDATION, TRUSTED_VALIDATION,
+                                 set_validation)
 from nibbles.fields.ctypes import *
 
 
@@ -69,6 +75,23 @@ class TestByteField(TestCase):
     def test_too_large(self):
         self.assertRaises(ValueError, self.FIELD, self.FIELD.max_value + 1)
 
+    def test_consume_from(self):
+        f, offset = self.f.consume_from(bytearray(b'\x00\x01\x02'), 1)
+        self.assertEqual(f(), 1)
+        self.assertEqual(offset, 2)
+
+    def test_consume_from_no_data(self):
+        self.assertRaises(NotEnoughDataException, self.f.consume_from, b'\x01', 1)
+
+    def test_emit_into(self):
+        self.f = self.FIELD(2)
+        buf = bytearray(3)
+        self.assertEqual(self.f.emit_into(buf, 1), 2)
+        self.assertEqual(buf, bytearray(b'\x00\x02\x00'))
+
+    def test_emit_into_too_small(self):
+        self.assertRaises(ValueError, self.f.emit_into, bytearray(1), 1)
+
 
 class TestUnsignedByteField(TestByteField):
     FIELD = UnsignedByteField
@@ -115,11 +138,44 @@ class TestPStringField(TestCase):
     def test_unicode(self):
         self.assertRaises(TypeError, PStringField, u'test')
 
+    def test_consume_from(self):
+        """Consume from an offset into a buffer."""
+        data = b'xx\x04testyy'
+        for buf in (data, bytearray(data), memoryview(data)):
+            f, offset = self.f.consume_from(buf, 2)
+            self.assertIs(f, self.f)
+            self.assertEqual(f(), b'test')
+            self.assertIsInstance(f(), bytes)
+            self.assertEqual(offset, 7)
+
+    def test_emit_into(self):
+        self.f = PStringField(b'test')
+        buf = bytearray(6)
+        self.assertEqual(self.f.emit_into(buf, 1), 6)
+        self.assertEqual(buf, bytearray(b'\x00\x04test'))
+
+    def test_emit_to(self):
+        f = BytesIO()
+        PStringField(b'test').emit_to(f)
+        self.assertEqual(f.getvalue(), b'\x04test')
+
+    def test_consume_from_no_end(self):
+        self.assertRaises(NotEnoughDataException, self.f.consume_from,
+                          b'xx\x05test', 2)
+        self.assertRaises(NotEnoughDataException, self.f.consume_from,
+                          b'xx', 2)
+
 
 class TestCStringField(TestCase):
     def setUp(self):
         self.f = CStringField()
 
+    def test_stream(self):
+        f = BytesIO(b'test\x00rest')
+        self.f.consume(f)
+        self.assertEqual(self.f(), b'test')
+        self.assertEqual(f.read(), b'rest')
+
     def test_str(self):
         """Test a basic string."""
         self.f.consume(b'test\x00')
@@ -156,3 +212,305 @@ class TestCStringField(TestCase):
 
     def test_unicode(self):
         self.assertRaises(TypeError, CStringField, u'test')
+
+    def test_consume_from(self):
+        """Consume from an offset into a buffer."""
+        data = b'xxtest\x00yy'
+        for buf in (data, bytearray(data), memoryview(data)):
+            f, offset = self.f.consume_from(buf, 2)
+            self.assertIs(f, self.f)
+            self.assertEqual(f(), b'test')
+            self.assertIsInstance(f(), bytes)
+            self.assertEqual(offset, 7)
+
+    def test_consume_from_mmap(self):
+        with TemporaryFile() as tmp:
+            tmp.write(b'xxtest\x00yy')
+            tmp.flush()
+            buf = mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                f, offset = self.f.consume_from(buf, 2)
+            finally:
+                buf.close()
+
+        self.assertEqual(f(), b'test')
+        self.assertEqual(offset, 7)
+
+    def test_consume_from_no_end(self):
+        self.assertRaises(NotEnoughDataException, self.f.consume_from,
+                          memoryview(b'xxtest'), 2)
+
+    def test_emit_into(self):
+        self.f = CStringField(b'test')
+        buf = bytearray(6)
+        self.assertEqual(self.f.emit_into(memoryview(buf), 1), 6)
+        self.assertEqual(buf, bytearray(b'\x00test\x00'))
+
+    def test_emit_into_too_small(self):
+        self.f = CStringField(b'test')
+        self.assertRaises(ValueError, self.f.emit_into, bytearray(5), 1)
+        self.assertRaises(ValueError, self.f.emit_into, bytearray(4))
+
+    def test_emit_to(self):
+        f = BytesIO()
+        CStringField(b'test').emit_to(f)
+        self.assertEqual(f.getvalue(), b'test\x00')
+
+
+class Unseekable(RawIOBase):
+    """A stream which can only be read."""
+    def __init__(self, data):
+        self.f = BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class TestTerminatedField(TestCase):
+    # The terminator straddles the chunks which are searched.
+    DATA = b'x' * 4095 + b'\r\nrest'
+
+    def streams(self, data):
+        yield BytesIO(data)
+        yield BufferedReader(Unseekable(data))
+        yield Unseekable(data)
+
+    def test_consume(self):
+        for f in self.streams(self.DATA):
+            field = TerminatedField(terminator=b'\r\n').consume(f)
+            self.assertEqual(field(), b'x' * 4095)
+            # Nothing past the terminator was consumed.
+            self.assertEqual(f.read(), b'rest')
+
+    def test_consume_from(self):
+        f, offset = TerminatedField(terminator=b'\r\n').consume_from(
+            memoryview(self.DATA))
+        self.assertEqual(f(), b'x' * 4095)
+        self.assertEqual(offset, 4097)
+
+    def test_no_end(self):
+        for f in self.streams(b'x' * 5000 + b'\r'):
+            self.assertRaises(NotEnoughDataException,
+                              TerminatedField(terminator=b'\r\n').consume, f)
+
+    def test_emit(self):
+        f = TerminatedField(b'test', terminator=b'\r\n')
+        self.assertEqual(f.size(), 6)
+        self.assertEqual(f.emit(), b'test\r\n')
+
+    def test_empty_terminator(self):
+        self.assertRaises(ValueError, TerminatedField, terminator=b'')
+
+
+class Fragment(Field):
+    version = BitField(4)
+    length = BitField(4)
+    code = ByteField()
+    flags = BitField(3)
+    offset = BitField(13)
+
+
+class TestBitField(TestCase):
+    DATA = b'\x45\x07\xa0\x10'
+
+    def test_plan(self):
+        """The BitFields are packed into words read by a single struct."""
+        self.assertEqual(len(Fragment._plan), 1)
+        self.assertEqual(Fragment._plan[0].format_string, b'BbH')
+        self.assertEqual(Fragment._plan[0].names,
+                         ('version', 'length', 'code', 'flags', 'offset'))
+
+    def test_consume(self):
+        f = Fragment().consume(self.DATA)
+        self.assertEqual((f.version(), f.length(), f.code(), f.flags(),
+                          f.offset()), (4, 5, 7, 5, 16))
+        self.assertEqual(f.size(), 4)
+
+        f = Fragment().consume(BytesIO(self.DATA))
+        self.assertEqual(f.offset(), 16)
+
+    def test_emit(self):
+        f = Fragment(version=4, length=5, code=7, flags=5, offset=16)
+        self.assertEqual(f.emit(), self.DATA)
+
+        buf = bytearray(4)
+        f.emit_into(buf)
+        self.assertEqual(bytes(buf), self.DATA)
+
+    def test_endian(self):
+        f = Fragment(endian=LITTLE_ENDIAN).consume(b'\x45\x07\x10\xa0')
+        self.assertEqual((f.flags(), f.offset()), (5, 16))
+        self.assertEqual(f.emit(), b'\x45\x07\x10\xa0')
+
+    def test_lazy(self):
+        f = Fragment().consume(self.DATA, lazy=True)
+        self.assertEqual(f.offset(), 16)
+        self.assertEqual(f.version(), 4)
+
+        f.flags.value = 1
+        self.assertEqual(f.emit(), b'\x45\x07\x20\x10')
+
+    def test_values(self):
+        f = BitField(3)
+        f.value = 7
+        self.assertRaises(ValueError, setattr, f, 'value', 8)
+        self.assertRaises(ValueError, setattr, f, 'value', -1)
+        self.assertRaises(TypeError, setattr, f, 'value', 1.0)
+        self.assertRaises(ValueError, BitField, 0)
+        self.assertRaises(TypeError, f.emit)
+
+    def test_words(self):
+        """BitFields must fill words."""
+        with self.assertRaises(TypeError):
+            class Partial(Field):
+                a = BitField(3)
+                b = ByteField()
+
+        class Wide(Field):
+            a = BitField(1)
+            b = BitField(62)
+            c = BitField(1)
+
+        self.assertEqual(Wide._plan[0].format_string, b'Q')
+        self.assertEqual(Wide(a=1, c=1).emit(), b'\x80' + b'\x00' * 6 + b'\x01')
+
+    def test_projection(self):
+        """Only the selected BitFields of a word are consumed."""
+        f = Fragment().consume(self.DATA, only=['flags', 'version'])
+        self.assertEqual((f.version(), f.flags(), f.offset()), (4, 5, 0))
+        self.assertEqual(Fragment().consume(self.DATA, only=['offset'],
+                                            values=True), (16,))
+
+    def test_generated(self):
+        class Generated(Fragment):
+            generate_code = True
+
+        f = Generated().consume(self.DATA)
+        self.assertEqual((f.version(), f.flags(), f.offset()), (4, 5, 16))
+        self.assertEqual(f.emit(), self.DATA)
+
+
+class PercentField(UnsignedByteField):
+    max_value = 100
+
+
+class Measurement(Field):
+    count = UnsignedShortField()
+    percent = PercentField()
+
+
+class TestValidation(TestCase):
+    DATA = b'\x00\x07\xc8'
+
+    def tearDown(self):
+        set_validation(TRUSTED_VALIDATION)
+
+    def reject(self, field):
+        """Make the checks of the value of field fail."""
+        def check(value):
+            raise ValueError("Checked")
+        field._check_value = check
+
+    def test_unchecked(self):
+        """Values are only trusted if struct guarantees the checks."""
+        both = set([TRUSTED_VALIDATION, NO_VALIDATION])
+        self.assertEqual(IntegerField()._unchecked, both)
+        self.assertEqual(UnsignedByteField()._unchecked, both)
+        self.assertEqual(CharField()._unchecked, both)
+        self.assertEqual(StringField(4)._unchecked, both)
+        self.assertEqual(PercentField()._unchecked, set([NO_VALIDATION]))
+
+        self.assertEqual(Measurement._plan[0].unchecked, set([NO_VALIDATION]))
+
+    def test_trusted(self):
+        """Values constrained by struct aren't checked by default."""
+        m = Measurement()
+        self.reject(m.count)
+        m.count.consume(b'\x00\x07')
+        self.assertEqual(m.count(), 7)
+
+        # The range of the PercentField isn't guaranteed by struct.
+        self.assertRaises(ValueError, m.consume, self.DATA)
+
+    def test_strict(self):
+        set_validation(STRICT_VALIDATION)
+        f = IntegerField()
+        self.reject(f)
+        self.assertRaises(ValueError, f.consume, b'\x00\x00\x00\x01')
+
+    def test_off(self):
+        set_validation(NO_VALIDATION)
+        m = Measurement().consume(self.DATA)
+        self.assertEqual(m.percent(), 200)
+
+        # Assigned values are still checked.
+        with self.assertRaises(ValueError):
+            m.percent.value = 200
+
+    def test_class(self):
+        """Field classes can set their own policy."""
+        class Strict(Measurement):
+            validation = STRICT_VALIDATION
+
+        m = Strict()
+        self.reject(m.count)
+        self.assertRaises(ValueError, m.consume, b'\x00\x07\x01')
+
+        class Trusting(Measurement):
+            validation = NO_VALIDATION
+
+        self.assertEqual(Trusting().consume(self.DATA).percent(), 200)
+
+    def test_generated(self):
+        class Generated(Measurement):
+            generate_code = True
+
+        self.assertRaises(ValueError, Generated().consume, self.DATA)
+
+        set_validation(NO_VALIDATION)
+        self.assertEqual(Generated().consume(self.DATA).percent(), 200)
+
+        set_validation(STRICT_VALIDATION)
+        m = Generated()
+        self.reject(m.count)
+        self.assertRaises(ValueError, m.consume, b'\x00\x07\x01')
+
+    def test_lazy(self):
+        m = Measurement().consume(self.DATA, lazy=True)
+        self.assertRaises(ValueError, lambda: m.percent.value)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, set_validation, 'sometimes')
+
+
+class Scaled(UnsignedShortField):
+    """Hundredths, also stored scaled when consumed."""
+    def consume_from(self, buf, offset=0):
+        result = super(Scaled, self).consume_from(buf, offset)
+        self.scaled = self.value / 100.0
+        return result
+
+
+class Reading(Field):
+    code = ByteField()
+    reading = Scaled()
+    flags = ByteField()
+
+
+class TestRuns(TestCase):
+    def test_overridden(self):
+        """Fields consuming their data themselves aren't merged into runs."""
+        self.assertIsNone(Scaled()._struct_format())
+        self.assertEqual(Reading._plan[1], 'reading')
+
+        f = Reading().consume(b'\x01\x00\x96\x02')
+        self.assertEqual(f.reading.scaled, 1.5)
+        self.assertEqual(f.flags(), 2)
+
+    def test_string(self):
+        self.assertEqual(StringField(4)._struct_format(), b'4s')
@@ -1,7 +1,10 @@
 from __future__ import absolute_import
 
+from io import BytesIO
 from unittest import TestCase
 
+from nibbles.fields import (ByteField, CStringField, UnsignedIntegerField,
+                            UnsignedLongLongField)
 from nibbles.fields.base import Field
 
 
@@ -47,6 +50,73 @@ class TestCompoundField(TestCase):
         self.assertEqual(f.foo, 1)
 
 
+class TestExports(TestCase):
+    def test_star(self):
+        """Only the fields and constants are exported, not the imports."""
+        namespace = {}
+        exec('from nibbles.fields import *', namespace)
+        for name in ('copy', 'deepcopy', 'zlib', 'bz2', 'os', 'struct'):
+            self.assertNotIn(name, namespace)
+        for name in ('Field', 'ByteField', 'DependentField', 'CompressedField',
+                     'LITTLE_ENDIAN', 'set_validation'):
+            self.assertIn(name, namespace)
+
+
+class TestConstruction(TestCase):
+    def test_nested_independent(self):
+        """Nested fields are copied from the prototypes for each instance."""
+        f = Outer()
+        f2 = Outer()
+
+        self.assertIsNot(f.inner, f2.inner)
+        self.assertIsNot(f.inner, Outer.inner)
+        self.assertIsNot(f.inner.code, f2.inner.code)
+        self.assertIs(f.inner.fields['code'], f.inner.code)
+
+        f.inner.code.value = 5
+        self.assertEqual(f2.inner.code(), 0)
+        self.assertEqual(Outer.inner.code(), 0)
+
+    def test_parents(self):
+        f = Outer()
+        self.assertIsNone(f.parent)
+        self.assertIs(f.a.parent, f)
+        self.assertIs(f.inner.parent, f)
+        self.assertIs(f.inner.code.parent, f.inner)
+
+    def test_endian(self):
+        """The Endianess is inherited from the new parents."""
+        from nibbles.fields import LITTLE_ENDIAN
+
+        f = Outer(endian=LITTLE_ENDIAN)
+        self.assertEqual(f.inner.code.endian, LITTLE_ENDIAN)
+        self.assertNotEqual(Outer().inner.code.endian, LITTLE_ENDIAN)
+
+    def test_mutable_attributes(self):
+        """Attributes set by the __init__ of a sub-class aren't shared."""
+        class Tracking(ByteField):
+            def __init__(self, *args, **kwargs):
+                super(Tracking, self).__init__(*args, **kwargs)
+                self.seen = []
+
+        class Tracked(Field):
+            a = Tracking()
+            b = ByteField()
+
+        f = Tracked()
+        f2 = Tracked()
+        f.a.seen.append(1)
+        self.assertEqual(f2.a.seen, [])
+        self.assertEqual(Tracked.a.seen, [])
+        self.assertIs(f.a.parent, f)
+        self.assertIsNot(f.b, f2.b)
+
+        # Fields without such attributes are cloned shallowly.
+        self.assertFalse(Tracking._shallow_clone)
+        self.assertTrue(Tracked._shallow_clone)
+        self.assertTrue(ByteField._shallow_clone)
+
+
 class TestComplexField(TestCase):
     def test_complex(self):
         """Ensure subfields of subfields can be reached."""
@@ -59,3 +129,561 @@ class TestComplexField(TestCase):
         self.assertIsInstance(c.c, CompoundField)
         self.assertIsInstance(c.c.a, Field)
         self.assertIsInstance(c.f, Field)
+
+
+class TestPlan(TestCase):
+    def test_fused(self):
+        """Consecutive fixed-width fields are merged into a single run."""
+        from nibbles.fields import ByteField, CStringField, ShortField
+
+        class Header(Field):
+            a = ByteField()
+            b = ShortField()
+            c = CStringField()
+            d = ByteField()
+
+        self.assertEqual(len(Header._plan), 3)
+        self.assertEqual(Header._plan[0].names, ('a', 'b'))
+        self.assertEqual(Header._plan[0].size, 3)
+        self.assertEqual(Header._plan[1], 'c')
+        self.assertEqual(Header._plan[2].names, ('d',))
+
+        data = b'\x01\x00\x02abc\x00\x03'
+        h = Header().consume(data)
+        self.assertEqual(h.a(), 1)
+        self.assertEqual(h.b(), 2)
+        self.assertEqual(h.c(), b'abc')
+        self.assertEqual(h.d(), 3)
+        self.assertEqual(h.emit(), data)
+
+    def test_endian(self):
+        """Fields with their own Endianess are not merged."""
+        from nibbles.fields import LITTLE_ENDIAN, ShortField
+
+        class Mixed(Field):
+            a = ShortField()
+            b = ShortField(endian=LITTLE_ENDIAN)
+
+        self.assertEqual(Mixed._plan[0].names, ('a',))
+        self.assertEqual(Mixed._plan[1], 'b')
+
+        m = Mixed().consume(b'\x00\x01\x01\x00')
+        self.assertEqual(m.a(), 1)
+        self.assertEqual(m.b(), 1)
+
+        m = Mixed(endian=LITTLE_ENDIAN).consume(b'\x01\x00\x01\x00')
+        self.assertEqual(m.a(), 1)
+        self.assertEqual(m.b(), 1)
+
+    def test_not_enough_data(self):
+        from nibbles.exceptions import NotEnoughDataException
+        from nibbles.fields import ByteField, ShortField
+
+        class Header(Field):
+            a = ByteField()
+            b = ShortField()
+
+        self.assertRaises(NotEnoughDataException, Header().consume, b'\x01\x00')
+
+
+class Inner(Field):
+    code = ByteField()
+    description = CStringField()
+
+
+class Outer(Field):
+    a = ByteField()
+    inner = Inner()
+    b = ByteField()
+
+
+class TestConsumeFrom(TestCase):
+    def test_nested(self):
+        """Nested models consume straight out of the buffer."""
+        data = b'\xff\x01\x01abc\x00\x11\xff'
+        for buf in (data, bytearray(data), memoryview(data)):
+            f, offset = Outer().consume_from(buf, 1)
+            self.assertEqual(offset, len(data) - 1)
+            self.assertEqual(f.a(), 1)
+            self.assertEqual(f.inner.code(), 1)
+            self.assertEqual(f.inner.description(), b'abc')
+            self.assertEqual(f.b(), 17)
+
+
+class TestEmit(TestCase):
+    DATA = b'\x01\x02abc\x00\x03'
+
+    def setUp(self):
+        self.f = Outer().consume(self.DATA)
+
+    def test_emit(self):
+        self.assertEqual(self.f.emit(), self.DATA)
+
+    def test_emit_into(self):
+        buf = bytearray(len(self.DATA) + 2)
+        self.assertEqual(self.f.emit_into(buf, 1), len(self.DATA) + 1)
+        self.assertEqual(buf, bytearray(b'\x00' + self.DATA + b'\x00'))
+
+    def test_emit_into_too_small(self):
+        self.assertRaises(ValueError, self.f.emit_into, bytearray(2))
+
+    def test_emit_to(self):
+        f = BytesIO()
+        self.f.emit_to(f)
+        self.assertEqual(f.getvalue(), self.DATA)
+
+
+class TestIterRecords(TestCase):
+    DATA = b'\x01\x02abc\x00\x03' b'\x04\x05\x00\x06'
+
+    def check(self, records):
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].inner.description(), b'abc')
+        self.assertEqual(records[1].a(), 4)
+        self.assertEqual(records[1].inner.description(), b'')
+        self.assertEqual(records[1].b(), 6)
+
+    def test_iter_records(self):
+        for chunk_size in (1, 3, 7, 1024):
+            records = list(Outer.iter_records(BytesIO(self.DATA), chunk_size))
+            self.check(records)
+
+    def test_lazy(self):
+        """Records are yielded before the whole stream is read."""
+        f = BytesIO(self.DATA)
+        records = Outer.iter_records(f, chunk_size=8)
+        next(records)
+        self.assertEqual(f.tell(), 8)
+
+    def test_bounded(self):
+        """The data of consumed records is not kept."""
+        class Reader(object):
+            def __init__(self, count):
+                self.count = count
+
+            def read(self, size):
+                if not self.count:
+                    return b''
+                self.count -= 1
+                return b'\x01\x02abc\x00\x03'
+
+        records = Outer.iter_records(Reader(1000), chunk_size=7)
+        self.assertEqual(sum(1 for record in records), 1000)
+
+    def test_empty(self):
+        self.assertEqual(list(Outer.iter_records(BytesIO(b''))), [])
+
+    def test_not_enough_data(self):
+        from nibbles.exceptions import NotEnoughDataException
+
+        records = Outer.iter_records(BytesIO(self.DATA[:-1]), chunk_size=4)
+        next(records)
+        self.assertRaises(NotEnoughDataException, next, records)
+
+    def test_kwargs(self):
+        """Keyword arguments are given to the constructor."""
+        from nibbles.fields import LITTLE_ENDIAN, ShortField
+
+        class Short(Field):
+            a = ShortField()
+
+        records = Short.iter_records(BytesIO(b'\x01\x00'), endian=LITTLE_ENDIAN)
+        self.assertEqual([r.a() for r in records], [1])
+
+
+class Point(Field):
+    x = ByteField()
+    y = ByteField()
+    z = ByteField()
+
+
+class TestBatch(TestCase):
+    DATA = b'\x01\x02\x03\x04\x05\x06'
+
+    def test_unpack_many(self):
+        self.assertEqual(Point.unpack_many(self.DATA), [(1, 2, 3), (4, 5, 6)])
+        self.assertEqual(Point.unpack_many(memoryview(self.DATA)[3:]),
+                         [(4, 5, 6)])
+        self.assertEqual(Point.unpack_many(b''), [])
+
+    def test_pack_many(self):
+        records = Point.unpack_many(self.DATA)
+        buf = Point.pack_many(iter(records))
+        self.assertIsInstance(buf, bytearray)
+        self.assertEqual(bytes(buf), self.DATA)
+
+        # The same as emitting each record.
+        self.assertEqual(bytes(buf), b''.join(
+            Point(x=x, y=y, z=z).emit() for x, y, z in records))
+
+    def test_endian(self):
+        from nibbles.fields import LITTLE_ENDIAN, ShortField
+
+        class Short(Field):
+            a = ShortField()
+
+        self.assertEqual(Short.unpack_many(b'\x01\x00', LITTLE_ENDIAN), [(1,)])
+        self.assertEqual(bytes(Short.pack_many([(1,)], LITTLE_ENDIAN)),
+                         b'\x01\x00')
+
+    def test_bits(self):
+        from nibbles.fields import BitField
+
+        class Bits(Field):
+            a = BitField(4)
+            b = BitField(4)
+            c = ByteField()
+
+        self.assertEqual(Bits.unpack_many(b'\x12\x03'), [(1, 2, 3)])
+        self.assertEqual(bytes(Bits.pack_many([(1, 2, 3)])), b'\x12\x03')
+
+    def test_errors(self):
+        self.assertRaises(ValueError, Point.unpack_many, self.DATA[:-1])
+        self.assertRaises(TypeError, Outer.unpack_many, b'')
+        self.assertRaises(TypeError, Outer.pack_many, [])
+
+
+class TestSize(TestCase):
+    def test_fixed(self):
+        """The size of fixed-size classes is computed once."""
+        self.assertEqual(Point._fixed_size, 3)
+        self.assertEqual(Point().size(), 3)
+        self.assertIsNone(Outer._fixed_size)
+
+    def test_memoized(self):
+        f = Outer()
+        self.assertEqual(f.size(), 4)
+        self.assertEqual(f._size_cache, 4)
+        self.assertEqual(f.inner._size_cache, 2)
+
+        # Changing a value below drops the memoized sizes up to the root.
+        f.inner.description.value = b'abc'
+        self.assertIsNone(f._size_cache)
+        self.assertIsNone(f.inner._size_cache)
+        self.assertEqual(f.size(), 7)
+
+        f.consume(b'\x01\x02a\x00\x03')
+        self.assertEqual(f.size(), 5)
+
+    def test_not_memoized(self):
+        """Sizes depending on lists which can be modified aren't memoized."""
+        from nibbles.fields import RepeatedField
+
+        class Items(Field):
+            items = RepeatedField(Inner())
+
+        f = Items()
+        self.assertEqual(f.size(), 0)
+        f.items.value.append(Inner())
+        self.assertEqual(f.size(), 2)
+
+
+class VarBytes(Field):
+    """A length byte and that many bytes, consumed by the leaf itself."""
+
+    def __init__(self, value=b'', *args, **kwargs):
+        super(VarBytes, self).__init__(*args, **kwargs)
+        self.value = value
+
+    def size(self):
+        return 1 + len(self.value)
+
+    def consume_from(self, buf, offset=0, lazy=False, values=False,
+                     only=None):
+        end = offset + 1 + bytearray(buf[offset:offset + 1])[0]
+        self.value = bytes(bytearray(buf[offset + 1:end]))
+        return self, end
+
+    def emit(self):
+        return bytes(bytearray([len(self.value)])) + self.value
+
+
+class WithVarBytes(Field):
+    a = ByteField()
+    v = VarBytes()
+    b = ByteField()
+
+
+class TestSkip(TestCase):
+    def test_skip(self):
+        """The boundaries are found without decoding the fields."""
+        data = b'\xff\x01\x02abc\x00\x03\xff'
+        f = Outer()
+        self.assertEqual(f._skip(data, 1), len(data) - 1)
+        self.assertEqual(f.inner.description(), b'')
+
+    def test_static_size(self):
+        from nibbles.fields import ShortField
+
+        class Fixed(Field):
+            a = ByteField()
+            b = ShortField()
+
+        class Nested(Field):
+            fixed = Fixed()
+            c = ByteField()
+
+        self.assertEqual(Fixed()._static_size(), 3)
+        self.assertEqual(Nested()._static_size(), 4)
+        self.assertIsNone(Outer()._static_size())
+
+    def test_custom_leaf(self):
+        """A leaf consuming its own data doesn't have a static size."""
+        self.assertIsNone(VarBytes()._static_size())
+        self.assertIsNone(WithVarBytes._fixed_size)
+        f = WithVarBytes().consume(b'\x01\x03abc\x02')
+        self.assertEqual(f.size(), 6)
+        self.assertEqual(f.v(), b'abc')
+        self.assertEqual(f.b(), 2)
+
+    def test_skip_custom_leaf(self):
+        """A leaf without its own _skip is consumed to be skipped."""
+        data = b'\x01\x03abc\x02'
+        self.assertEqual(WithVarBytes()._skip(data), 6)
+        self.assertEqual(WithVarBytes().consume(data, lazy=True).b(), 2)
+        self.assertEqual(WithVarBytes().consume(data, only=['b']).b(), 2)
+
+
+class TestLazy(TestCase):
+    DATA = b'\x01\x02abc\x00\x03'
+
+    def test_lazy(self):
+        """Values are decoded when they are accessed."""
+        f, offset = Outer().consume_from(self.DATA, lazy=True)
+        self.assertEqual(offset, len(self.DATA))
+        self.assertIsNotNone(f.a._pending)
+        self.assertIsNotNone(f.inner.description._pending)
+
+        self.assertEqual(f.inner.description(), b'abc')
+        self.assertIsNone(f.inner.description._pending)
+        self.assertIsNotNone(f.a._pending)
+
+        self.assertEqual(f.a(), 1)
+        self.assertEqual(f.inner.code(), 2)
+        self.assertEqual(f.b(), 3)
+        self.assertEqual(f.size(), len(self.DATA))
+
+    def test_original_data(self):
+        """Unmodified records emit the original data."""
+        from nibbles.fields import BoolField
+
+        class Flags(Field):
+            a = BoolField()
+            inner = Inner()
+
+        data = b'\x02\x01abc\x00'
+        f = Flags().consume(data, lazy=True)
+        self.assertIs(f.a(), True)
+        self.assertEqual(f.inner.description(), b'abc')
+        self.assertEqual(f.emit(), data)
+
+        buf = bytearray(len(data))
+        f.emit_into(buf)
+        self.assertEqual(buf, bytearray(data))
+
+        # Once modified, it is serialized again.
+        f.inner.description.value = b'abcd'
+        self.assertIsNone(f._span)
+        self.assertIsNone(f.inner._span)
+        self.assertEqual(f.emit(), b'\x01\x01abcd\x00')
+
+    def test_modified(self):
+        """Setting a value which hasn't been decoded replaces it."""
+        f = Outer().consume(self.DATA, lazy=True)
+        f.inner.code.value = 5
+        self.assertEqual(f.inner.code(), 5)
+        self.assertEqual(f.emit(), b'\x01\x05abc\x00\x03')
+
+    def test_consume_again(self):
+        """Consuming a child drops the original data of the parents."""
+        f = Outer().consume(self.DATA, lazy=True)
+        f.inner.consume(b'\x07de\x00')
+        self.assertEqual(f.emit(), b'\x01\x07de\x00\x03')
+
+        f = Outer().consume(self.DATA, lazy=True)
+        f.inner.consume_from(b'\x07de\x00', lazy=True)
+        self.assertEqual(f.emit(), b'\x01\x07de\x00\x03')
+
+    def test_not_enough_data(self):
+        from nibbles.exceptions import NotEnoughDataException
+
+        self.assertRaises(NotEnoughDataException, Outer().consume,
+                          self.DATA[:-1], lazy=True)
+        self.assertRaises(NotEnoughDataException, Outer().consume,
+                          self.DATA[:3], lazy=True)
+
+    def test_stream(self):
+        self.assertRaises(TypeError, Outer().consume, BytesIO(self.DATA),
+                          lazy=True)
+
+
+class TestValues(TestCase):
+    DATA = b'\x01\x02ab\x00\x03'
+
+    def check(self, values):
+        self.assertIsInstance(values, Outer.values_class())
+        self.assertEqual(values, (1, (2, b'ab'), 3))
+        self.assertEqual((values.a, values.inner.description, values.b),
+                         (1, b'ab', 3))
+
+    def test_consume(self):
+        self.check(Outer().consume(self.DATA, values=True))
+        self.check(Outer().consume(BytesIO(self.DATA), values=True))
+
+        values, offset = Outer().consume_from(self.DATA + b'x', values=True)
+        self.check(values)
+        self.assertEqual(offset, 6)
+
+    def test_as_values(self):
+        f = Outer().consume(self.DATA)
+        self.check(f.as_values())
+        self.assertEqual(f.inner.code.as_values(), 2)
+
+    def test_class(self):
+        """The records are compact, the names are shared by the class."""
+        cls = Outer.values_class()
+        self.assertIs(Outer.values_class(), cls)
+        self.assertEqual(cls._fields, ('a', 'inner', 'b'))
+        self.assertIs(cls._field_class, Outer)
+        self.assertFalse(hasattr(cls(), '__dict__'))
+        self.assertEqual(repr(Point.values_class()((1, 2, 3))),
+                         'PointValues(x=1, y=2, z=3)')
+
+    def test_generated(self):
+        class Generated(Outer):
+            generate_code = True
+
+        values = Generated().consume(self.DATA, values=True)
+        self.assertEqual(values, (1, (2, b'ab'), 3))
+        self.assertIsNot(Generated.values_class(), Outer.values_class())
+
+    def test_lazy(self):
+        self.assertRaises(TypeError, Outer().consume, self.DATA, lazy=True,
+                          values=True)
+
+
+class TestParser(TestCase):
+    DATA = TestValues.DATA
+
+    def test_parse(self):
+        parser = Outer.parser()
+        first = parser.parse(self.DATA)
+        second = parser.parse(BytesIO(self.DATA))
+        self.assertIsNot(first, second)
+        self.assertEqual(first.emit(), self.DATA)
+        self.assertEqual(second.inner.description(), b'ab')
+
+        f, offset = parser.parse_from(self.DATA + b'x')
+        self.assertEqual((f.b(), offset), (3, 6))
+
+    def test_values(self):
+        parser = Outer.parser(values=True)
+        self.assertEqual(parser.parse(self.DATA), (1, (2, b'ab'), 3))
+        self.assertEqual(parser.parse_from(self.DATA)[1], 6)
+
+    def test_values_leaf(self):
+        """Fields without children are parsed into their values too."""
+        parser = CStringField.parser(values=True)
+        self.assertEqual(parser.parse(b'ab\x00'), b'ab')
+        self.assertEqual(parser.parse(BytesIO(b'ab\x00')), b'ab')
+        self.assertEqual(parser.parse_from(b'ab\x00cd\x00', 3), (b'cd', 6))
+
+    def test_prototype(self):
+        """The prototype isn't modified, nor are instances created."""
+        parser = Outer.parser(a=9)
+        counter = Field.creation_counter
+        parser.parse(self.DATA)
+        self.assertEqual(Field.creation_counter, counter)
+        self.assertEqual(parser._prototype.a(), 9)
+
+    def test_threads(self):
+        import threading
+
+        parser = Outer.parser()
+        results = []
+
+        def parse(code):
+            data = b'\x01' + bytearray([code]) + b'ab\x00\x03'
+            for _ in range(200):
+                results.append((code, parser.parse(bytes(data)).inner.code()))
+
+        threads = [threading.Thread(target=parse, args=(code,))
+                   for code in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8 * 200)
+        self.assertTrue(all(code == parsed for code, parsed in results))
+
+
+class Wide(Field):
+    id = UnsignedIntegerField()
+    name = CStringField()
+    flags = ByteField()
+    inner = Inner()
+    count = UnsignedIntegerField()
+    timestamp = UnsignedLongLongField()
+
+
+class TestProjection(TestCase):
+    DATA = Wide(id=7, name=b'abc', flags=1, count=2, timestamp=99).emit()
+
+    def test_steps(self):
+        projection = Wide.projection(['timestamp', 'id'])
+        self.assertIs(Wide.projection(['id', 'timestamp']), projection)
+        self.assertEqual([step[0] for step in projection.steps],
+                         ['run', 'skip_field', 'skip', 'skip_field', 'run'])
+        self.assertEqual(projection.steps[4][1].format_string, b'4xQ')
+
+    def test_consume(self):
+        f, offset = Wide().consume_from(self.DATA + b'x',
+                                        only=['timestamp', 'id'])
+        self.assertEqual((f.id(), f.timestamp()), (7, 99))
+        self.assertEqual((f.name(), f.count()), (b'', 0))
+        self.assertEqual(offset, len(self.DATA))
+
+        f = Wide().consume(BytesIO(self.DATA), only=['timestamp'])
+        self.assertEqual(f.timestamp(), 99)
+
+    def test_values(self):
+        values = Wide().consume(self.DATA, only=['timestamp', 'name'],
+                                values=True)
+        self.assertEqual(values, (b'abc', 99))
+        self.assertEqual(values.timestamp, 99)
+        self.assertEqual(values._fields, ('name', 'timestamp'))
+
+        values = Wide().consume(BytesIO(self.DATA), only=['id'], values=True)
+        self.assertEqual(values, (7,))
+
+    def test_child(self):
+        values = Wide().consume(self.DATA, only=['inner.description', 'count'],
+                                values=True)
+        self.assertEqual(values, ((b'',), 2))
+
+        f = Wide().consume(self.DATA, only=['inner'])
+        self.assertEqual(f.inner.code(), 0)
+
+    def test_compiled(self):
+        projection = Wide.projection(['flags'])
+        self.assertEqual(Wide().consume(self.DATA, only=projection).flags(), 1)
+        self.assertRaises(TypeError, Outer().consume, self.DATA,
+                          only=projection)
+
+    def test_generated(self):
+        class Generated(Wide):
+            generate_code = True
+
+        self.assertEqual(
+            Generated().consume(self.DATA, only=['count'], values=True), (2,))
+
+    def test_errors(self):
+        from nibbles.exceptions import NotEnoughDataException
+
+        self.assertRaises(TypeError, Wide.projection, ['missing'])
+        self.assertRaises(TypeError, Wide.projection, ['id.value'])
+        self.assertRaises(TypeError, Wide().consume, self.DATA, lazy=True,
+                          only=['id'])
+        self.assertRaises(NotEnoughDataException, Wide().consume,
+                          self.DATA[:-1], only=['id'])
@@ -0,0 +1,313 @@
+from __future__ import absolute_import
+
+from io import BytesIO
+from unittest import TestCase, skipIf
+
+from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields import (ByteField, ChoiceField, CStringField,
+                            DependentField, Field, LITTLE_ENDIAN,
+                            NETWORK_ENDIAN, RepeatedField, ShortField,
+                            StringField, UnsignedIntegerField)
+from nibbles.fields import arrays
+
+
+class Entry(Field):
+    code = ByteField()
+    name = CStringField()
+
+
+class TypeLengthValue(Field):
+    type = ByteField()
+    length = ByteField()
+    value = DependentField(StringField, dep_kwargs={'length': 'length'})
+
+
+class TestRepeatedField(TestCase):
+    DATA = b'\x01a\x00\x02bc\x00'
+
+    def check(self, f):
+        self.assertEqual(len(f()), 2)
+        self.assertEqual(f()[0].code(), 1)
+        self.assertEqual(f()[0].name(), b'a')
+        self.assertEqual(f()[1].code(), 2)
+        self.assertEqual(f()[1].name(), b'bc')
+
+    def test_consume(self):
+        f = RepeatedField(Entry()).consume(self.DATA)
+        self.check(f)
+
+    def test_consume_stream(self):
+        f = RepeatedField(Entry()).consume(BytesIO(self.DATA))
+        self.check(f)
+        self.assertIs(f()[0].parent, f)
+
+    def test_consume_from(self):
+        buf = memoryview(b'xx' + self.DATA)
+        f, offset = RepeatedField(Entry()).consume_from(buf, 2)
+        self.check(f)
+        self.assertEqual(offset, len(buf))
+
+    def test_emit(self):
+        f = RepeatedField(Entry()).consume(self.DATA)
+        self.assertEqual(f.size(), len(self.DATA))
+        self.assertEqual(f.emit(), self.DATA)
+
+        buf = bytearray(len(self.DATA))
+        self.assertEqual(f.emit_into(buf), len(self.DATA))
+        self.assertEqual(buf, bytearray(self.DATA))
+
+    def test_clone(self):
+        """Copies of a consumed field don't share the repeated fields."""
+        f = RepeatedField(Entry()).consume(self.DATA)
+        f2 = f._clone()
+        self.check(f2)
+        self.assertIsNot(f(), f2())
+        self.assertIsNot(f()[0], f2()[0])
+        self.assertIs(f2()[0].parent, f2)
+
+    def test_consume_twice(self):
+        """Consuming again replaces the previous values."""
+        f = RepeatedField(Entry())
+        f.consume(self.DATA)
+        f.consume(self.DATA)
+        self.check(f)
+
+    def test_lazy_modified(self):
+        """Items modified (or added) after a lazy consume are emitted."""
+        class Listed(Field):
+            count = ByteField()
+            items = RepeatedField(ByteField())
+
+        f = Listed().consume(bytearray(b'\x01\x02\x03'), lazy=True)
+        f.items.value[0].value = 7
+        self.assertEqual(f.emit(), b'\x01\x07\x03')
+
+        f.items.value.append(ByteField(9))
+        self.assertEqual(f.emit(), b'\x01\x07\x03\x09')
+        self.assertEqual(f.size(), 4)
+
+
+class TestDependentField(TestCase):
+    DATA = b'\x00\x04test'
+
+    def test_consume(self):
+        f = TypeLengthValue().consume(self.DATA)
+        self.assertEqual(f.length(), 4)
+        self.assertEqual(f.value()(), b'test')
+
+    def test_consume_from(self):
+        f, offset = TypeLengthValue().consume_from(bytearray(self.DATA + b'x'))
+        self.assertEqual(f.value()(), b'test')
+        self.assertEqual(offset, 6)
+
+    def test_emit(self):
+        f = TypeLengthValue().consume(self.DATA)
+        self.assertEqual(f.size(), len(self.DATA))
+        self.assertEqual(f.emit(), self.DATA)
+
+    def test_skip(self):
+        """The dependent field is consumed to find its end."""
+        self.assertFalse(TypeLengthValue._skippable)
+        self.assertEqual(TypeLengthValue()._skip(self.DATA + b'x'), 6)
+
+    def test_skip_references(self):
+        """Only the siblings referenced by the dependent field are consumed."""
+        class Unconsumed(CStringField):
+            def consume_from(self, buf, offset=0):
+                raise AssertionError("Consumed")
+
+        class Tagged(Field):
+            type = ByteField()
+            tag = Unconsumed()
+            length = ByteField()
+            flags = ByteField()
+            value = DependentField(StringField,
+                                   dep_kwargs={'length': 'length'})
+            trailer = Unconsumed()
+
+        data = b'\x01ab\x00\x04\x07test\x00x'
+        prototype = Tagged()
+        self.assertEqual(prototype._skip(data), len(data) - 1)
+
+        # The prototype isn't modified.
+        self.assertIsNone(prototype.value.value)
+        self.assertEqual(prototype.length(), 0)
+        self.assertEqual(prototype.flags(), 0)
+
+        self.assertEqual(Message()._skip(b'\x01\x02ab\x00x'), 5)
+
+    def test_lazy(self):
+        f = TypeLengthValue().consume(self.DATA + b'x', lazy=True)
+        self.assertEqual(f.value()(), b'test')
+        self.assertEqual(f.size(), 6)
+        self.assertEqual(f.emit(), self.DATA)
+
+    def test_lazy_modified(self):
+        f = TypeLengthValue().consume(bytearray(self.DATA), lazy=True)
+        f.value.value.value = b'zz'
+        self.assertEqual(f.emit(), b'\x00\x04zz\x00\x00')
+
+    def test_emit_empty(self):
+        """Before consuming, the dependent field is empty."""
+        self.assertEqual(TypeLengthValue().emit(), b'\x00\x00')
+
+    def test_values(self):
+        values = TypeLengthValue().consume(self.DATA, values=True)
+        self.assertEqual(values, (0, 4, b'test'))
+
+        values = RepeatedField(TypeLengthValue()).consume(self.DATA * 2,
+                                                          values=True)
+        self.assertEqual(values, [(0, 4, b'test')] * 2)
+
+    def test_projection(self):
+        """The siblings of a DependentField are consumed anyway."""
+        self.assertIsNone(TypeLengthValue.projection(['value']).steps)
+        values = TypeLengthValue().consume(self.DATA, only=['value'],
+                                           values=True)
+        self.assertEqual(values, (b'test',))
+
+    def test_cache(self):
+        """The created fields are cached by the values they depend on."""
+        class Cached(TypeLengthValue):
+            value = DependentField(StringField, dep_kwargs={'length': 'length'},
+                                   cache_size=2)
+
+        first = Cached().consume(self.DATA)
+        second = Cached().consume(self.DATA)
+        self.assertEqual(second.value()(), b'test')
+        self.assertIsNot(first.value(), second.value())
+        self.assertIs(second.value().parent, second.value)
+        self.assertEqual(second.value.cache_info(), (1, 1, 2, 1))
+
+        # The least recently used field is dropped.
+        Cached().consume(b'\x00\x01a')
+        Cached().consume(b'\x00\x02ab')
+        self.assertEqual(Cached().consume(self.DATA).value()(), b'test')
+        self.assertEqual(Cached.value.cache_info(), (1, 4, 2, 2))
+
+        Cached.value.cache_clear()
+        self.assertEqual(Cached.value.cache_info(), (0, 0, 2, 0))
+
+    def test_no_cache(self):
+        f = DependentField(StringField, dep_kwargs={'length': 'length'},
+                           cache_size=0)
+        self.assertIsNone(f.cache_info())
+
+
+class Ping(Field):
+    sequence = ShortField()
+
+
+class Message(Field):
+    type = ByteField()
+    payload = ChoiceField('type', {0: Ping, 1: Entry()})
+
+
+class TestChoiceField(TestCase):
+    def test_consume(self):
+        f = Message().consume(b'\x00\x00\x07')
+        self.assertIsInstance(f.payload(), Ping)
+        self.assertEqual(f.payload().sequence(), 7)
+        self.assertIs(f.payload().parent, f.payload)
+
+        f, offset = Message().consume_from(bytearray(b'\x01\x02ab\x00x'))
+        self.assertEqual(f.payload().name(), b'ab')
+        self.assertEqual(offset, 5)
+
+    def test_default(self):
+        """Unknown values consume the rest of the data as bytes."""
+        f = Message().consume(b'\x05rest')
+        self.assertEqual(f.payload()(), b'rest')
+        self.assertEqual(f.emit(), b'\x05rest')
+
+        f = Message().consume(BytesIO(b'\x05rest'))
+        self.assertEqual(f.payload()(), b'rest')
+
+        class Strict(Message):
+            payload = ChoiceField('type', {0: Ping}, default=Entry)
+
+        f = Strict().consume(b'\x05\x01a\x00')
+        self.assertEqual(f.payload().name(), b'a')
+
+    def test_emit(self):
+        f = Message(type=1)
+        entry = f.payload.select()
+        entry.code.value = 3
+        entry.name.value = b'x'
+        self.assertEqual(f.emit(), b'\x01\x03x\x00')
+        self.assertEqual(f.size(), 4)
+        self.assertEqual(Message().consume(f.emit()).emit(), f.emit())
+
+    def test_repeated(self):
+        f = RepeatedField(Message()).consume(b'\x00\x00\x01\x01\x02b\x00')
+        self.assertEqual([type(m.payload()) for m in f()], [Ping, Entry])
+
+    def test_lazy(self):
+        f = Message().consume(b'\x00\x00\x07x', lazy=True)
+        self.assertEqual(f.payload().sequence(), 7)
+        self.assertEqual(f.emit(), b'\x00\x00\x07')
+
+
+class Sample(Field):
+    timestamp = UnsignedIntegerField()
+    channel = ByteField()
+    reading = ShortField(endian=LITTLE_ENDIAN)
+
+
+@skipIf(arrays.numpy is None, "NumPy is not installed")
+class TestRepeatedArray(TestCase):
+    DATA = b'\x00\x00\x00\x01\x02\x03\x00' b'\x00\x00\x00\x02\xfe\xff\xff'
+
+    def test_dtype(self):
+        dtype = arrays.dtype_for(Sample(), NETWORK_ENDIAN)
+        self.assertEqual(dtype.names, ('timestamp', 'channel', 'reading'))
+        self.assertEqual(dtype.itemsize, 7)
+        self.assertEqual(dtype['timestamp'].str, '>u4')
+        self.assertEqual(dtype['reading'].str, '<i2')
+
+    def test_nested_dtype(self):
+        class Frame(Field):
+            sample = Sample()
+            name = StringField(length=3)
+
+        dtype = arrays.dtype_for(Frame(), LITTLE_ENDIAN)
+        self.assertEqual(dtype.itemsize, 10)
+        self.assertEqual(dtype['sample']['timestamp'].str, '<u4')
+        self.assertEqual(dtype['name'].str, '|S3')
+
+    def test_variable_size(self):
+        self.assertRaises(TypeError, RepeatedField, Entry(), as_array=True)
+
+    def test_consume(self):
+        f = RepeatedField(Sample(), as_array=True).consume(self.DATA)
+        self.assertEqual(len(f()), 2)
+        self.assertEqual(f()['timestamp'].tolist(), [1, 2])
+        self.assertEqual(f()['channel'].tolist(), [2, -2])
+        self.assertEqual(f()['reading'].tolist(), [3, -1])
+
+    def test_consume_from(self):
+        f, offset = RepeatedField(Sample(), as_array=True).consume_from(
+            bytearray(b'x' + self.DATA), 1)
+        self.assertEqual(offset, 15)
+        self.assertEqual(f()['timestamp'].tolist(), [1, 2])
+
+    def test_not_enough_data(self):
+        f = RepeatedField(Sample(), as_array=True)
+        self.assertRaises(NotEnoughDataException, f.consume, self.DATA[:-1])
+
+    def test_emit(self):
+        f = RepeatedField(Sample(), as_array=True).consume(self.DATA)
+        self.assertEqual(f.size(), len(self.DATA))
+        self.assertEqual(f.emit(), self.DATA)
+
+        buf = bytearray(len(self.DATA))
+        self.assertEqual(f.emit_into(buf), len(self.DATA))
+        self.assertEqual(buf, bytearray(self.DATA))
+
+    def test_emit_list(self):
+        """Values can be given as a list of tuples."""
+        f = RepeatedField(Sample(), as_array=True)
+        self.assertEqual(f.emit(), b'')
+
+        f.value = [(1, 2, 3), (2, -2, -1)]
+        self.assertEqual(f.emit(), self.DATA)
@@ -0,0 +1,159 @@
+"""
+Random access to files made of records stored one after another.
+
+"""
+from array import array
+import mmap
+import os
+
+# The offsets of records are stored as unsigned 64-bit integers ('Q' is not
+# available on Python 2, where 'L' is 64-bit on 64-bit platforms).
+try:
+    _OFFSET_TYPECODE = 'Q'
+    array(_OFFSET_TYPECODE)
+except ValueError:
+    _OFFSET_TYPECODE = 'L'
+
+# The suffix of the index file saved beside a record file by default.
+INDEX_SUFFIX = '.idx'
+
+
+class RecordFile(object):
+    """
+    A read-only, memory-mapped file made of records of a Field class.
+
+    Records can be accessed by index (or sliced) in O(1), only the requested
+    records are decoded. For fixed-size Fields the offset of each record is
+    computed from its size, otherwise an index of the offsets of all records is
+    built once by scanning the boundaries of the records.
+
+    The index can be saved to and loaded from index_path (e.g. the path of the
+    file with INDEX_SUFFIX), it is rebuilt if it is out of date.
+
+    If lazy is True the records are consumed lazily, the values are only
+    decoded when they are accessed (see Field.consume_from).
+
+    kwargs are passed to the constructor of field_class.
+
+    """
+
+    def __init__(self, path, field_class, index_path=None, lazy=False,
+                 **kwargs):
+        self.path = path
+        self.index_path = index_path
+        self.lazy = lazy
+        self.prototype = field_class(**kwargs)
+
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size:
+            self._buf = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be memory-mapped.
+            self._buf = b''
+
+        self.record_size = self.prototype._static_size()
+        if self.record_size:
+            self.offsets = None
+            self._length, remainder = divmod(self._size, self.record_size)
+            if remainder:
+                raise ValueError(
+                    "%s is not made of %d byte records (%d bytes left)" %
+                    (path, self.record_size, remainder))
+        else:
+            self.offsets = self._load_index()
+            if self.offsets is None:
+                self.offsets = self._build_index()
+                if index_path is not None:
+                    self.save_index()
+            self._length = len(self.offsets)
+
+    def _build_index(self):
+        """Scan the file for the offsets of each record."""
+        offsets = array(_OFFSET_TYPECODE)
+        skip = self.prototype._skip
+        buf = self._buf
+        offset = 0
+        while offset < self._size:
+            offsets.append(offset)
+            end = skip(buf, offset)
+            if end == offset:
+                raise ValueError("Records must not be empty")
+            offset = end
+        return offsets
+
+    def _load_index(self):
+        """Load the index, if it exists and is up to date."""
+        if self.index_path is None or not os.path.exists(self.index_path):
+            return None
+        if os.path.getmtime(self.index_path) < os.path.getmtime(self.path):
+            return None
+
+        # The first item is the size of the indexed file.
+        offsets = array(_OFFSET_TYPECODE)
+        count, remainder = divmod(os.path.getsize(self.index_path),
+                                  offsets.itemsize)
+        if remainder:
+            return None
+        with open(self.index_path, 'rb') as f:
+            offsets.fromfile(f, count)
+
+        if not offsets or offsets[0] != self._size:
+            return None
+        return offsets[1:]
+
+    def save_index(self, index_path=None):
+        """Save the index of the record offsets to index_path."""
+        if index_path is None:
+            index_path = self.index_path
+        if self.offsets is None:
+            raise ValueError("Fixed-size records are not indexed")
+
+        offsets = array(_OFFSET_TYPECODE, [self._size])
+        offsets.extend(self.offsets)
+        with open(index_path, 'wb') as f:
+            offsets.tofile(f)
+
+    def offset(self, index):
+        """The offset of the record at index in the file."""
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Record index out of range")
+
+        if self.offsets is None:
+            return index * self.record_size
+        return self.offsets[index]
+
+    def _record(self, offset):
+        record = self.prototype._clone()
+        if self.lazy:
+            # Fields without children (e.g. a CStringField) don't take lazy.
+            record._consume_lazy(self._buf, offset)
+            return record
+        return record.consume_from(self._buf, offset)[0]
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._record(self.offset(i))
+                    for i in range(*index.indices(self._length))]
+        return self._record(self.offset(index))
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self[i]
+
+    def close(self):
+        if self._size:
+            self._buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,146 @@
+"""
+Parse large files of records on multiple processes, or many records on
+multiple threads.
+
+This uses concurrent.futures, on Python 2 the futures backport is needed unless
+an executor is given.
+
+"""
+import mmap
+import multiprocessing
+import os
+
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+
+from nibbles.fields.base import Parser
+from nibbles.files import RecordFile
+
+
+def _parse_chunk(path, field_class, kwargs, start, end, reduce):
+    """Parse the records of field_class between start and end of path."""
+    prototype = field_class(**kwargs)
+    records = []
+
+    # The map is kept open until the results are built, the records must not
+    # refer to it once they're returned (see RepeatedField).
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = start
+            while offset < end:
+                record, offset = prototype._clone().consume_from(buf, offset)
+                records.append(record)
+
+            if reduce is not None:
+                return reduce(records)
+            return records
+        finally:
+            buf.close()
+
+
+def parallel_parse(path, field_class, workers=None, reduce=None, chunks=None,
+                   executor=None, index_path=None, **kwargs):
+    """
+    Parse the records of field_class stored one after another in the file at
+    path, on multiple processes.
+
+    The file is split into chunks at record boundaries: for fixed-size Fields
+    at multiples of the size, otherwise the boundaries are found by a scan of
+    the file first (see RecordFile, which index_path is given to). The chunks
+    (by default 4 per worker) are parsed by executor, by default a
+    ProcessPoolExecutor with workers processes.
+
+    Returns the list of records in order. If reduce is given, it is called (in
+    the worker) with the list of records of each chunk and the list of the
+    results of each chunk is returned (in order) instead. field_class and
+    reduce must be picklable.
+
+    kwargs are passed to the constructor of field_class.
+
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    with RecordFile(path, field_class, index_path=index_path,
+                    **kwargs) as records:
+        count = len(records)
+        if not count:
+            return []
+
+        if chunks is None:
+            chunks = 4 * workers
+        chunks = max(1, min(chunks, count))
+
+        # The start of each chunk and the end of the last chunk.
+        boundaries = [records.offset(count * i // chunks)
+                      for i in range(chunks)]
+    boundaries.append(os.path.getsize(path))
+
+    tasks = list(zip(*[
+        (path, field_class, kwargs, boundaries[i], boundaries[i + 1], reduce)
+        for i in range(chunks)
+    ]))
+
+    if executor is not None:
+        results = list(executor.map(_parse_chunk, *tasks))
+    else:
+        if ProcessPoolExecutor is None:
+            raise ImportError(
+                "concurrent.futures is required to parse in parallel")
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_parse_chunk, *tasks))
+
+    if reduce is not None:
+        return results
+    return [record for result in results for record in result]
+
+
+def _parse_items(parser, items):
+    """Parse each of items (buffers or filelikes) with parser."""
+    parse = parser.parse
+    return [parse(data) for data in items]
+
+
+def parse_many(parser, items, workers=None, chunks=None, executor=None):
+    """
+    Parse each of items (e.g. the buffers of messages received from the
+    network) on multiple threads, returns the list of the records in order.
+
+    parser is a Parser (see Field.parser), which is shared by the threads, or
+    a Field class. The items are split into chunks (by default 4 per worker)
+    parsed by executor, by default a ThreadPoolExecutor with workers threads.
+
+    Threads parse concurrently on Python builds without a GIL, otherwise this
+    mostly overlaps parsing with I/O done by other threads.
+
+    """
+    if not isinstance(parser, Parser):
+        parser = Parser(parser)
+
+    items = list(items)
+    if not items:
+        return []
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if chunks is None:
+        chunks = 4 * workers
+    chunks = max(1, min(chunks, len(items)))
+
+    tasks = [items[len(items) * i // chunks:len(items) * (i + 1) // chunks]
+             for i in range(chunks)]
+    parsers = [parser] * chunks
+
+    if executor is not None:
+        results = list(executor.map(_parse_items, parsers, tasks))
+    else:
+        if ThreadPoolExecutor is None:
+            raise ImportError(
+                "concurrent.futures is required to parse in parallel")
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(_parse_items, parsers, tasks))
+
+    return [record for result in results for record in result]
@@ -0,0 +1,286 @@
+"""
+Measure the time spent consuming and emitting each field of each model.
+
+Profiling is enabled with the profile context manager:
+
+    with profiling.profile() as profiler:
+        Model().consume(data)
+    print(profiler.report())
+
+or for a whole program by setting the NIBBLES_PROFILE environment variable
+(to the sampling interval, e.g. 1 or "yes" to profile every record), the report
+is then printed to stderr at exit.
+
+The methods of the Field classes are only instrumented while profiling, so it
+costs nothing otherwise. Runs of fixed-width fields are not merged while
+profiling (so each field is measured), which makes profiled parsing slower.
+
+"""
+from __future__ import print_function
+
+import atexit
+from collections import namedtuple
+import os
+import sys
+from timeit import default_timer
+
+from nibbles.fields.base import _build_plan, _StructRun, BaseField, MetaField
+
+# The name of the environment variable enabling profiling.
+ENVIRONMENT_VARIABLE = 'NIBBLES_PROFILE'
+
+# The instrumented methods and the operation they are counted as.
+_OPERATIONS = {
+    'consume': 'consume',
+    'consume_from': 'consume',
+    'emit': 'emit',
+    'emit_into': 'emit',
+    'emit_to': 'emit',
+}
+
+
+def _offset(args, kwargs):
+    """The offset argument given to consume_from or emit_into."""
+    if len(args) > 1:
+        return args[1]
+    return kwargs.get('offset', 0)
+
+
+# Compute the number of bytes handled by a call from the field, the arguments
+# and the result of each method.
+_SIZES = {
+    'consume': lambda field, args, kwargs, result: field.size(),
+    'consume_from': lambda field, args, kwargs, result:
+        result[1] - _offset(args, kwargs),
+    'emit': lambda field, args, kwargs, result: len(result),
+    'emit_into': lambda field, args, kwargs, result:
+        result - _offset(args, kwargs),
+    'emit_to': lambda field, args, kwargs, result: field.size(),
+}
+
+
+# The measurements of a field: the number of calls, the cumulative time (in
+# seconds, including the children of the field) and the number of bytes.
+Stats = namedtuple('Stats', ['calls', 'seconds', 'bytes'])
+
+
+# The Profiler which is currently enabled.
+_active = None
+
+
+class Profiler(object):
+    """
+    Records the number of calls, the time and the number of bytes consumed or
+    emitted per (model class, field name).
+
+    Fields which aren't declared on a model (e.g. the items of a RepeatedField)
+    are named by their class. Records (fields without a parent) are counted
+    with a field name of None.
+
+    Only one of every sample records (top-level calls) is measured, which
+    reduces the overhead when profiling live traffic. Profiling isn't
+    thread-safe.
+
+    """
+
+    def __init__(self, sample=1):
+        if sample < 1:
+            raise ValueError("sample must be at least 1")
+        self.sample = sample
+
+        # (model class, field name, operation) to [calls, seconds, bytes].
+        self._stats = {}
+
+        # The fields currently being measured and the number of records seen.
+        self._stack = []
+        self._records = 0
+        self._sampling = True
+
+        # The original attributes of the instrumented classes.
+        self._patched = []
+
+    def enable(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError("Another Profiler is already enabled")
+        _active = self
+
+        classes = [BaseField]
+        while classes:
+            cls = classes.pop()
+            self._instrument(cls)
+            classes.extend(cls.__subclasses__())
+
+        # Classes created while profiling are instrumented too.
+        create = MetaField.__dict__['__new__']
+        profiler = self
+
+        def __new__(mcs, name, bases, attrs):
+            cls = create.__func__(mcs, name, bases, attrs)
+            profiler._instrument(cls)
+            return cls
+
+        self._patch(MetaField, '__new__', staticmethod(__new__))
+
+    def disable(self):
+        global _active
+        if _active is not self:
+            return
+        _active = None
+
+        for cls, name, value in reversed(self._patched):
+            setattr(cls, name, value)
+        self._patched = []
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def _patch(self, cls, name, value):
+        self._patched.append((cls, name, cls.__dict__[name]))
+        setattr(cls, name, value)
+
+    def _instrument(self, cls):
+        for name in _OPERATIONS:
+            if name in cls.__dict__:
+                # Generated methods don't follow the (unmerged) plan.
+                func = cls.__dict__[name]
+                func = getattr(func, '_generic', func)
+                self._patch(cls, name, self._wrap(func, name))
+
+        # Consume and emit each fixed-width field on its own (BitFields are
+        # still consumed a word at a time).
+        plan = cls.__dict__.get('_plan')
+        if plan and any(step.__class__ is _StructRun for step in plan):
+            self._patch(cls, '_plan',
+                        _build_plan(cls.declared_fields, merge=False))
+
+    def _wrap(self, func, name):
+        operation = _OPERATIONS[name]
+        size = _SIZES[name]
+        stack = self._stack
+
+        def wrapper(field, *args, **kwargs):
+            if not stack:
+                self._records += 1
+                self._sampling = (self._records - 1) % self.sample == 0
+
+            # Calls within a call of the same field (e.g. consume calling
+            # consume_from) are only counted once.
+            if not self._sampling or (stack and stack[-1] is field):
+                stack.append(field)
+                try:
+                    return func(field, *args, **kwargs)
+                finally:
+                    stack.pop()
+
+            stack.append(field)
+            start = default_timer()
+            try:
+                result = func(field, *args, **kwargs)
+            finally:
+                elapsed = default_timer() - start
+                stack.pop()
+
+            self._add(field, operation, elapsed,
+                      size(field, args, kwargs, result))
+            return result
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def _add(self, field, operation, seconds, size):
+        parent = field.parent
+        if parent is None:
+            key = (field.__class__, None, operation)
+        else:
+            key = (parent.__class__,
+                   field._name or field.__class__.__name__, operation)
+
+        try:
+            stats = self._stats[key]
+        except KeyError:
+            stats = self._stats[key] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += size
+
+    def stats(self):
+        """
+        The measurements as a dict of (model class, field name, operation) to
+        Stats.
+
+        """
+        return dict((key, Stats(*stats)) for key, stats in self._stats.items())
+
+    def report(self, limit=None):
+        """
+        Return a table of the measurements, the most time consuming first.
+
+        """
+        rows = sorted(self.stats().items(), key=lambda item: -item[1].seconds)
+        if limit is not None:
+            rows = rows[:limit]
+
+        lines = ['%-40s %-8s %10s %12s %14s %12s' % (
+            'field', 'op', 'calls', 'total (s)', 'per call (us)', 'bytes')]
+        for (model, fieldname, operation), stats in rows:
+            name = model.__name__
+            if fieldname is not None:
+                name += '.' + fieldname
+            lines.append('%-40s %-8s %10d %12.6f %14.3f %12d' % (
+                name, operation, stats.calls, stats.seconds,
+                stats.seconds / stats.calls * 1e6, stats.bytes))
+
+        return '\n'.join(lines)
+
+
+def profile(sample=1):
+    """
+    Return a Profiler, which is enabled while used as a context manager.
+
+    """
+    return Profiler(sample)
+
+
+def _sample_from_environment():
+    """
+    The sampling interval set by the environment variable, None if profiling
+    isn't enabled. Values other than numbers (e.g. "yes") enable profiling of
+    every record, numbers below 1 (e.g. "0") disable it.
+
+    """
+    sample = os.environ.get(ENVIRONMENT_VARIABLE, '').strip()
+    if not sample:
+        return None
+    try:
+        sample = int(sample)
+    except ValueError:
+        return 1
+    if sample < 1:
+        return None
+    return sample
+
+
+def _profile_from_environment():
+    """
+    Enable a Profiler if the environment variable is set, its report is printed
+    at exit.
+
+    """
+    sample = _sample_from_environment()
+    if sample is None or _active is not None:
+        return
+
+    profiler = Profiler(sample)
+    profiler.enable()
+
+    def report():
+        profiler.disable()
+        print(profiler.report(), file=sys.stderr)
+
+    atexit.register(report)
@@ -0,0 +1,149 @@
+"""
+Incremental (push-based) parsing of records, e.g. from a network connection,
+with an adapter for Twisted protocols.
+
+"""
+from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields.base import _find, _StructRun
+from nibbles.fields.codegen import _generated
+from nibbles.fields.ctypes import _defined, TerminatedField
+
+try:
+    from twisted.internet import protocol as twisted_protocol
+except ImportError:
+    twisted_protocol = None
+
+
+class PushParser(object):
+    """
+    Parse records of a Field class from data as it arrives.
+
+    Data is given to feed, which returns the records completed by it. A record
+    which isn't complete yet is kept and parsing resumes with the field (of the
+    record, or of a child of the record) it stopped at, instead of starting the
+    record over. The terminator of a TerminatedField (e.g. a CStringField) is
+    only searched for in the data fed since the last search.
+
+    Since the end of the data is unknown, fields repeated until the end of the
+    data (e.g. RepeatedField) consume everything fed so far.
+
+    kwargs are passed to the constructor of field_class.
+
+    """
+
+    def __init__(self, field_class, **kwargs):
+        self.prototype = field_class(**kwargs)
+
+        # The data which hasn't been consumed.
+        self._buf = bytearray()
+        self._offset = 0
+
+        # The record being consumed and, for the record and each of the
+        # children being consumed, a list of the field and the index of the
+        # next step of its plan.
+        self._record = None
+        self._stack = []
+
+        # The offset in the buffer up to which the terminator of the current
+        # TerminatedField wasn't found.
+        self._searched = 0
+
+    def feed(self, data):
+        """Add data to parse, returns a list of the completed records."""
+        # Drop the consumed data. A new buffer is used since records might
+        # still refer to the old one (e.g. a NumPy array).
+        if self._offset:
+            self._buf = self._buf[self._offset:]
+            self._searched = max(0, self._searched - self._offset)
+            self._offset = 0
+        self._buf += data
+
+        records = []
+        while self._offset < len(self._buf):
+            record = self._resume()
+            if record is None:
+                break
+            records.append(record)
+
+        return records
+
+    def _resume(self):
+        """Continue consuming the current record, return it once complete."""
+        if self._record is None:
+            self._record = self.prototype._clone()
+            self._stack = [[self._record, 0]]
+            self._searched = self._offset
+
+        stack = self._stack
+        try:
+            while stack:
+                position = stack[-1]
+                field, step = position
+                if not _resumable(field):
+                    # Fields which can't be resumed are consumed at once.
+                    self._consume(field)
+                elif step < len(field._plan):
+                    step = field._plan[step]
+                    if step.__class__ is _StructRun:
+                        self._offset = field._consume_step(
+                            step, self._buf, self._offset, field.endian)
+                        position[1] += 1
+                    else:
+                        stack.append([getattr(field, step), 0])
+                    continue
+
+                # The field is complete, continue with its parent.
+                stack.pop()
+                if stack:
+                    stack[-1][1] += 1
+        except NotEnoughDataException:
+            return None
+
+        record = self._record
+        self._record = None
+        return record
+
+    def _consume(self, field):
+        """Consume a field at once, from the current offset."""
+        if (_defined(type(field), 'consume_from') is
+                TerminatedField.__dict__['consume_from']):
+            # Only search the data which hasn't been searched yet.
+            start = max(self._offset, self._searched)
+            if _find(self._buf, field.terminator, start) == -1:
+                self._searched = max(
+                    start, len(self._buf) - len(field.terminator) + 1)
+                raise NotEnoughDataException("End of string not reached")
+
+        self._offset = field.consume_from(self._buf, self._offset)[1]
+        self._searched = self._offset
+
+
+def _resumable(field):
+    """
+    Whether field can be consumed step by step, following its plan (i.e. its
+    consume_from isn't overridden).
+
+    """
+    return bool(field.fields) and _generated(type(field), 'consume_from')
+
+
+if twisted_protocol is not None:
+    class TwistedProtocol(twisted_protocol.Protocol):
+        """
+        A Twisted protocol receiving records of field_class, which are given to
+        recordReceived.
+
+        """
+
+        field_class = None
+
+        def connectionMade(self):
+            self.parser = PushParser(self.field_class)
+
+        def dataReceived(self, data):
+            for record in self.parser.feed(data):
+                self.recordReceived(record)
+
+        def recordReceived(self, record):
+            """Called with each completed record."""
+            raise NotImplementedError
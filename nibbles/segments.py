@@ -0,0 +1,69 @@
+"""
+Write the segments returned by Field.emit_segments with a single system call
+(os.writev or socket.sendmsg) instead of joining them into a copy first:
+
+    segments.write_segments(fd, record.emit_segments())
+    segments.send_segments(sock, record.emit_segments())
+
+Where these calls aren't available (e.g. Python 2) the segments are written one
+after another.
+
+"""
+import os
+
+# The maximum number of segments written by a single call.
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
+
+
+def _write_all(write, segments):
+    """
+    Write all the segments with write, which is given a list of (at most
+    _IOV_MAX) memoryviews and returns the number of bytes written. Returns the
+    total number of bytes written.
+
+    """
+    views = [memoryview(segment) for segment in segments if len(segment)]
+    total = 0
+    i = 0
+    while i < len(views):
+        written = write(views[i:i + _IOV_MAX])
+        total += written
+
+        # Skip what was written, the rest of a segment is written next.
+        while written:
+            if written < len(views[i]):
+                views[i] = views[i][written:]
+                break
+            written -= len(views[i])
+            i += 1
+
+    return total
+
+
+def write_segments(fd, segments):
+    """
+    Write segments to the file descriptor fd (e.g. the fileno() of an
+    unbuffered file or of a pipe), returns the number of bytes written.
+
+    """
+    writev = getattr(os, 'writev', None)
+    if writev is None:
+        return _write_all(lambda views: os.write(fd, views[0]), segments)
+    return _write_all(lambda views: writev(fd, views), segments)
+
+
+def send_segments(sock, segments):
+    """
+    Send segments on the (connected, blocking) socket sock, returns the number
+    of bytes sent.
+
+    """
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        return _write_all(lambda views: sock.send(views[0]), segments)
+    return _write_all(sendmsg, segments)
@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+from nibbles.exceptions import NotEnoughDataException
+from nibbles.fields import (ByteField, CStringField, Field, RepeatedField,
+                            ShortField)
+from nibbles.fields import arrays
+from nibbles.files import INDEX_SUFFIX, RecordFile
+
+
+class Fixed(Field):
+    a = ByteField()
+    b = ShortField()
+
+
+class Variable(Field):
+    code = ByteField()
+    name = CStringField()
+
+
+class TestRecordFile(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'records')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, records):
+        with open(self.path, 'wb') as f:
+            for record in records:
+                record.emit_to(f)
+
+    def test_fixed(self):
+        self.write(Fixed(a=i, b=i * 2) for i in range(10))
+
+        with RecordFile(self.path, Fixed) as records:
+            self.assertIsNone(records.offsets)
+            self.assertEqual(len(records), 10)
+            self.assertEqual(records[3].b(), 6)
+            self.assertEqual(records[-1].a(), 9)
+            self.assertEqual(records.offset(4), 12)
+            self.assertEqual([r.a() for r in records[2:5]], [2, 3, 4])
+            self.assertRaises(IndexError, lambda: records[10])
+
+    def test_fixed_truncated(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00\x00')
+        self.assertRaises(ValueError, RecordFile, self.path, Fixed)
+
+    def test_variable(self):
+        self.write(Variable(code=i, name=b'x' * i) for i in range(10))
+
+        with RecordFile(self.path, Variable) as records:
+            self.assertEqual(len(records), 10)
+            self.assertEqual(list(records.offsets[:4]), [0, 2, 5, 9])
+            self.assertEqual(records[3].name(), b'xxx')
+            self.assertEqual([r.code() for r in records[-2:]], [8, 9])
+            self.assertEqual([r.code() for r in records], list(range(10)))
+
+    def test_lazy(self):
+        self.write(Variable(code=i, name=b'x' * i) for i in range(10))
+
+        with RecordFile(self.path, Variable, lazy=True) as records:
+            record = records[4]
+            self.assertIsNotNone(record.name._pending)
+            self.assertEqual(record.name(), b'xxxx')
+            self.assertEqual(record.emit(), b'\x04xxxx\x00')
+
+    def test_lazy_leaf(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'ab\x00cde\x00')
+
+        with RecordFile(self.path, CStringField, lazy=True) as records:
+            self.assertEqual([r() for r in records], [b'ab', b'cde'])
+
+    @skipIf(arrays.numpy is None, "NumPy is not installed")
+    def test_array_closed(self):
+        """Arrays of records are still valid once the file is closed."""
+        class Samples(Field):
+            count = ByteField()
+            items = RepeatedField(Fixed(), as_array=True)
+
+        with open(self.path, 'wb') as f:
+            f.write(b'\x02' + b'\x01\x00\x07' * 2)
+
+        with RecordFile(self.path, Samples) as records:
+            record = records[0]
+        self.assertEqual(record.items()['b'].tolist(), [7, 7])
+
+    def test_variable_truncated(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x01abc')
+        self.assertRaises(NotEnoughDataException, RecordFile, self.path,
+                          Variable)
+
+    def test_empty(self):
+        self.write([])
+        with RecordFile(self.path, Variable) as records:
+            self.assertEqual(len(records), 0)
+            self.assertEqual(list(records), [])
+
+    def test_index(self):
+        """The index is saved and loaded."""
+        self.write(Variable(code=i, name=b'x' * i) for i in range(10))
+        index_path = self.path + INDEX_SUFFIX
+
+        with RecordFile(self.path, Variable, index_path=index_path) as records:
+            offsets = records.offsets
+        self.assertTrue(os.path.exists(index_path))
+
+        # Use a modified index to know it was loaded.
+        records = RecordFile(self.path, Variable, index_path=index_path)
+        self.assertEqual(records.offsets, offsets)
+        records.offsets[1] = 1
+        records.save_index()
+        records.close()
+        with RecordFile(self.path, Variable, index_path=index_path) as records:
+            self.assertEqual(records.offsets[1], 1)
+
+    def test_stale_index(self):
+        """An index of a different file is rebuilt."""
+        self.write(Variable(code=i, name=b'x' * i) for i in range(10))
+        index_path = self.path + INDEX_SUFFIX
+        RecordFile(self.path, Variable, index_path=index_path).close()
+
+        self.write(Variable(code=i, name=b'y') for i in range(3))
+        with RecordFile(self.path, Variable, index_path=index_path) as records:
+            self.assertEqual(len(records), 3)
+            self.assertEqual(records[2].name(), b'y')
@@ -0,0 +1,167 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+from nibbles.fields import (ByteField, CStringField, DependentField, Field,
+                            RepeatedField, ShortField, StringField)
+from nibbles.fields import arrays
+from nibbles import parallel
+from nibbles.parallel import parallel_parse, parse_many
+
+
+class Fixed(Field):
+    a = ByteField()
+    b = ShortField()
+
+
+class Variable(Field):
+    code = ByteField()
+    name = CStringField()
+
+
+class Dependent(Field):
+    length = ByteField()
+    value = DependentField(StringField, dep_kwargs={'length': 'length'})
+
+
+class Item(Field):
+    value = ShortField()
+
+
+class Samples(Field):
+    count = ByteField()
+    items = RepeatedField(Item(), as_array=True)
+
+
+def count(records):
+    return len(records)
+
+
+class SerialExecutor(object):
+    """Run the tasks in this process."""
+    def map(self, func, *iterables):
+        return map(func, *iterables)
+
+
+class TestParallelParse(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'records')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, records):
+        with open(self.path, 'wb') as f:
+            for record in records:
+                record.emit_to(f)
+
+    def test_fixed(self):
+        self.write(Fixed(a=i % 100, b=i) for i in range(1000))
+
+        records = parallel_parse(self.path, Fixed, workers=2,
+                                 executor=SerialExecutor())
+        self.assertEqual([r.b() for r in records], list(range(1000)))
+
+    def test_variable(self):
+        self.write(Variable(code=i % 100, name=b'x' * (i % 7))
+                   for i in range(1000))
+
+        records = parallel_parse(self.path, Variable, chunks=7,
+                                 executor=SerialExecutor())
+        self.assertEqual([r.code() for r in records],
+                         [i % 100 for i in range(1000)])
+        self.assertEqual([len(r.name()) for r in records],
+                         [i % 7 for i in range(1000)])
+
+    def test_reduce(self):
+        self.write(Fixed(a=1, b=i) for i in range(10))
+
+        results = parallel_parse(self.path, Fixed, reduce=count, chunks=4,
+                                 executor=SerialExecutor())
+        self.assertEqual(results, [2, 3, 2, 3])
+
+    def test_empty(self):
+        self.write([])
+        self.assertEqual(parallel_parse(self.path, Variable), [])
+
+    def test_processes(self):
+        """The records are parsed on other processes."""
+        if parallel.ProcessPoolExecutor is None:
+            self.skipTest("concurrent.futures is not installed")
+
+        self.write(Variable(code=i % 100, name=b'x' * (i % 7))
+                   for i in range(100))
+        records = parallel_parse(self.path, Variable, workers=2)
+        self.assertEqual([r.code() for r in records],
+                         [i % 100 for i in range(100)])
+        self.assertEqual(records[-1].name(), b'x' * (99 % 7))
+
+    def test_processes_dependent(self):
+        """Records with the cache of a DependentField are sent back."""
+        if parallel.ProcessPoolExecutor is None:
+            self.skipTest("concurrent.futures is not installed")
+
+        with open(self.path, 'wb') as f:
+            for i in range(100):
+                f.write(bytes(bytearray([i % 7])) + b'x' * (i % 7))
+        records = parallel_parse(self.path, Dependent, workers=2)
+        self.assertEqual([r.value().value for r in records],
+                         [b'x' * (i % 7) for i in range(100)])
+
+
+    @skipIf(arrays.numpy is None, "NumPy is not installed")
+    def test_array(self):
+        """Records don't refer to the file once it's unmapped."""
+        with open(self.path, 'wb') as f:
+            f.write(b'\x01' + b'\x00\x07' * 4)
+
+        records = parallel_parse(self.path, Samples,
+                                 executor=SerialExecutor())
+        self.assertEqual(records[0].items()['value'].tolist(), [7] * 4)
+
+    @skipIf(arrays.numpy is None, "NumPy is not installed")
+    def test_processes_array(self):
+        """Records referring to arrays are sent back from other processes."""
+        if parallel.ProcessPoolExecutor is None:
+            self.skipTest("concurrent.futures is not installed")
+
+        with open(self.path, 'wb') as f:
+            f.write(b'\x01' + b'\x00\x07' * 4)
+
+        records = parallel_parse(self.path, Samples, workers=2)
+        self.assertEqual(records[0].items()['value'].tolist(), [7] * 4)
+
+
+class TestParseMany(TestCase):
+    ITEMS = [Variable(code=i % 100, name=b'x' * (i % 7)).emit()
+             for i in range(100)]
+
+    def check(self, records):
+        self.assertEqual([r.code() for r in records],
+                         [i % 100 for i in range(100)])
+        self.assertEqual(records[-1].name(), b'x' * (99 % 7))
+
+    def test_serial(self):
+        self.check(parse_many(Variable, self.ITEMS, chunks=7,
+                              executor=SerialExecutor()))
+
+    def test_values(self):
+        records = parse_many(Variable.parser(values=True), self.ITEMS,
+                             executor=SerialExecutor())
+        self.assertEqual(records[3], (3, b'xxx'))
+
+        names = parse_many(CStringField.parser(values=True),
+                           [b'ab\x00', b'c\x00'], executor=SerialExecutor())
+        self.assertEqual(names, [b'ab', b'c'])
+
+    def test_empty(self):
+        self.assertEqual(parse_many(Variable, []), [])
+
+    def test_threads(self):
+        if parallel.ThreadPoolExecutor is None:
+            self.skipTest("concurrent.futures is not installed")
+        self.check(parse_many(Variable.parser(), self.ITEMS, workers=4))
@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+
+from io import BytesIO
+import os
+from unittest import TestCase
+
+from nibbles.fields import (ByteField, CStringField, Field, RepeatedField,
+                            ShortField)
+from nibbles.fields.base import BaseField
+from nibbles import profiling
+
+
+class Inner(Field):
+    code = ByteField()
+    description = CStringField()
+
+
+class Outer(Field):
+    a = ByteField()
+    inner = Inner()
+    b = ByteField()
+
+
+DATA = b'\x01\x02abc\x00\x03'
+
+
+class TestProfiler(TestCase):
+    def test_consume(self):
+        with profiling.profile() as profiler:
+            f = Outer().consume(DATA)
+        self.assertEqual(f.inner.description(), b'abc')
+
+        stats = profiler.stats()
+        self.assertEqual(stats[(Outer, None, 'consume')].calls, 1)
+        self.assertEqual(stats[(Outer, None, 'consume')].bytes, len(DATA))
+        self.assertEqual(stats[(Outer, 'inner', 'consume')].bytes, 5)
+        self.assertEqual(stats[(Inner, 'description', 'consume')].bytes, 4)
+
+        # Fixed-width fields are measured separately.
+        self.assertEqual(stats[(Outer, 'a', 'consume')].calls, 1)
+        self.assertEqual(stats[(Inner, 'code', 'consume')].bytes, 1)
+
+        # Time includes the children.
+        self.assertGreaterEqual(stats[(Outer, None, 'consume')].seconds,
+                                stats[(Outer, 'inner', 'consume')].seconds)
+
+    def test_stream_and_emit(self):
+        with profiling.profile() as profiler:
+            f = Outer().consume(BytesIO(DATA))
+            self.assertEqual(f.emit(), DATA)
+
+        stats = profiler.stats()
+        self.assertEqual(stats[(Outer, None, 'consume')].bytes, len(DATA))
+        self.assertEqual(stats[(Outer, None, 'emit')].bytes, len(DATA))
+        self.assertEqual(stats[(Inner, 'description', 'emit')].calls, 1)
+
+    def test_unnamed(self):
+        """Fields which aren't declared are named by their class."""
+        with profiling.profile() as profiler:
+            RepeatedField(Inner()).consume(b'\x01a\x00\x02b\x00')
+
+        stats = profiler.stats()
+        self.assertEqual(stats[(RepeatedField, 'Inner', 'consume')].calls, 2)
+
+    def test_sample(self):
+        with profiling.profile(sample=3) as profiler:
+            for i in range(7):
+                Outer().consume(DATA)
+
+        stats = profiler.stats()
+        self.assertEqual(stats[(Outer, None, 'consume')].calls, 3)
+        self.assertEqual(stats[(Inner, 'code', 'consume')].calls, 3)
+
+    def test_disable(self):
+        """The original methods and plans are restored."""
+        consume_from = BaseField.__dict__['consume_from']
+        plan = Outer._plan
+
+        with profiling.profile() as profiler:
+            # Classes created while profiling are instrumented too.
+            class Created(Field):
+                a = ByteField()
+                b = ByteField()
+
+            self.assertIsNot(BaseField.__dict__['consume_from'], consume_from)
+            Created().consume(b'\x01\x02')
+
+        self.assertIs(BaseField.__dict__['consume_from'], consume_from)
+        self.assertIs(Outer._plan, plan)
+        self.assertEqual(len(Created._plan), 1)
+        self.assertEqual(profiler.stats()[(Created, 'b', 'consume')].calls, 1)
+
+        # Nothing is measured anymore.
+        Created().consume(b'\x01\x02')
+        self.assertEqual(profiler.stats()[(Created, 'b', 'consume')].calls, 1)
+
+    def test_report(self):
+        with profiling.profile() as profiler:
+            Outer().consume(DATA)
+
+        report = profiler.report().splitlines()
+        self.assertEqual(len(report), 1 + len(profiler.stats()))
+        self.assertIn('Outer.inner', profiler.report())
+        self.assertEqual(len(profiler.report(limit=2).splitlines()), 3)
+
+    def test_merged_plan(self):
+        """Batches and projections still use the merged runs."""
+        class Pair(Field):
+            x = ByteField()
+            y = ShortField()
+
+        with profiling.profile():
+            self.assertEqual(Pair.unpack_many(b'\x01\x00\x02'), [(1, 2)])
+            projection = Pair.projection(['y'])
+            self.assertEqual(
+                Pair().consume(b'\x01\x00\x02', only=['y']).y(), 2)
+            self.assertEqual(len(Pair._plan), 2)
+
+        self.assertEqual(len(projection.steps), 1)
+        self.assertIs(Pair.projection(['y']), projection)
+        self.assertEqual(len(Pair._plan), 1)
+
+    def test_environment(self):
+        previous = os.environ.get(profiling.ENVIRONMENT_VARIABLE)
+        try:
+            for value, sample in [('', None), ('3', 3), ('yes', 1),
+                                  ('0', None)]:
+                os.environ[profiling.ENVIRONMENT_VARIABLE] = value
+                self.assertEqual(profiling._sample_from_environment(), sample)
+        finally:
+            if previous is None:
+                del os.environ[profiling.ENVIRONMENT_VARIABLE]
+            else:
+                os.environ[profiling.ENVIRONMENT_VARIABLE] = previous
+
+    def test_nested_profilers(self):
+        with profiling.profile():
+            self.assertRaises(RuntimeError, profiling.profile().enable)
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+
+from unittest import TestCase, skipIf
+
+from nibbles.fields import ByteField, CStringField, Field, ShortField
+from nibbles import protocol
+from nibbles.protocol import PushParser
+
+
+class Message(Field):
+    code = ByteField()
+    length = ShortField()
+    name = CStringField()
+    trailer = ByteField()
+
+
+DATA = b'\x01\x00\x02abc\x00\x03' b'\x04\x00\x05\x00\x06'
+
+
+class TestPushParser(TestCase):
+    def test_feed(self):
+        parser = PushParser(Message)
+        records = parser.feed(DATA)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].name(), b'abc')
+        self.assertEqual(records[1].code(), 4)
+        self.assertEqual(records[1].trailer(), 6)
+
+    def test_partial(self):
+        """Records are completed as data arrives, one byte at a time."""
+        parser = PushParser(Message)
+        records = []
+        for i in range(len(DATA)):
+            completed = parser.feed(DATA[i:i + 1])
+            records.extend(completed)
+            if i == 7:
+                self.assertEqual(len(completed), 1)
+
+        self.assertEqual([r.code() for r in records], [1, 4])
+        self.assertEqual(records[0].name(), b'abc')
+
+    def test_resume(self):
+        """Completed fields of a partial record are not consumed again."""
+        parser = PushParser(Message)
+        self.assertEqual(parser.feed(DATA[:5]), [])
+        record = parser._record
+        self.assertEqual(record.code(), 1)
+        self.assertEqual(parser._stack, [[record, 1], [record.name, 0]])
+
+        # The consumed data is dropped.
+        parser.feed(b'')
+        self.assertEqual(len(parser._buf), 2)
+
+        records = parser.feed(DATA[5:])
+        self.assertEqual(len(records), 2)
+        self.assertIs(records[0], record)
+        self.assertEqual(record.name(), b'abc')
+
+    def test_nested(self):
+        """Parsing resumes within children, where it stopped."""
+        class Envelope(Field):
+            version = ByteField()
+            message = Message()
+
+        parser = PushParser(Envelope)
+        self.assertEqual(parser.feed(b'\x07' + DATA[:5]), [])
+        record = parser._record
+        self.assertEqual(parser._stack[1:],
+                         [[record.message, 1], [record.message.name, 0]])
+
+        self.assertEqual(parser.feed(DATA[5:8])[0].message.name(), b'abc')
+
+    def test_terminator(self):
+        """The terminator is only searched for in the new data."""
+        parser = PushParser(Message)
+        parser.feed(DATA[:5])
+        self.assertEqual(parser._searched, 5)
+
+        # The consumed data (the first run) is dropped.
+        parser.feed(b'c')
+        self.assertEqual(parser._searched, 3)
+
+        records = parser.feed(b'\x00\x03')
+        self.assertEqual(records[0].name(), b'abc')
+        self.assertEqual(records[0].trailer(), 3)
+
+    def test_leaf(self):
+        """Fields without children can be parsed too."""
+        parser = PushParser(CStringField)
+        self.assertEqual(parser.feed(b'ab'), [])
+        self.assertEqual([r() for r in parser.feed(b'\x00cd\x00')],
+                         [b'ab', b'cd'])
+
+
+@skipIf(protocol.twisted_protocol is None, "Twisted is not installed")
+class TestTwistedProtocol(TestCase):
+    def test_records(self):
+        received = []
+
+        class MessageProtocol(protocol.TwistedProtocol):
+            field_class = Message
+
+            def recordReceived(self, record):
+                received.append(record)
+
+        p = MessageProtocol()
+        p.connectionMade()
+        p.dataReceived(DATA[:4])
+        self.assertEqual(received, [])
+        p.dataReceived(DATA[4:])
+        self.assertEqual([r.code() for r in received], [1, 4])
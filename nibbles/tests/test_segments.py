@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+
+import socket
+import tempfile
+from unittest import TestCase
+
+from nibbles import segments
+from nibbles.fields import (ByteField, CStringField, DependentField, Field,
+                            StringField, UnsignedShortField)
+
+
+class Packet(Field):
+    code = ByteField()
+    name = CStringField()
+    length = UnsignedShortField()
+    payload = DependentField(StringField, dep_kwargs={'length': 'length'})
+
+
+class Header(Field):
+    code = ByteField()
+    name = CStringField()
+
+
+PAYLOAD = b'x' * 4000
+DATA = b'\x01ab\x00\x0f\xa0' + PAYLOAD
+
+
+class TestEmitSegments(TestCase):
+    def test_segments(self):
+        """Large values are segments of their own, without copies."""
+        f = Packet().consume(DATA)
+        parts = f.emit_segments()
+        self.assertEqual(
+            b''.join(bytes(bytearray(part)) for part in parts), DATA)
+        self.assertEqual(len(parts), 2)
+        self.assertIs(parts[1], f.payload().value)
+
+    def test_merged_string(self):
+        """Large strings merged with their neighbours aren't copied."""
+        class Declared(Field):
+            code = ByteField()
+            payload = StringField(length=len(PAYLOAD))
+            length = UnsignedShortField()
+
+        class Generated(Declared):
+            generate_code = True
+
+        class Single(Field):
+            payload = StringField(length=len(PAYLOAD))
+
+        for field_class in (Declared, Generated):
+            f = field_class(code=1, payload=PAYLOAD, length=2)
+            parts = f.emit_segments()
+            self.assertEqual(len(parts), 3)
+            self.assertIs(parts[1], f.payload.value)
+            self.assertEqual(
+                b''.join(bytes(bytearray(part)) for part in parts), f.emit())
+
+        f = Single(payload=PAYLOAD)
+        self.assertEqual(len(f.emit_segments()), 1)
+        self.assertIs(f.emit_segments()[0], f.payload.value)
+
+        # Shorter values are padded by struct.
+        parts = Single(payload=b'x').emit_segments()
+        self.assertEqual(bytes(bytearray(parts[0])),
+                         b'x' + b'\x00' * (len(PAYLOAD) - 1))
+
+    def test_threshold(self):
+        f = Packet().consume(DATA)
+        self.assertEqual(len(f.emit_segments(threshold=2)), 5)
+        self.assertEqual(len(f.emit_segments(threshold=len(DATA) + 1)), 1)
+
+    def test_lazy(self):
+        """A lazily consumed Field is a view of the consumed data."""
+        buf = bytearray(DATA[:4])
+        parts = Header().consume(buf, lazy=True).emit_segments()
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(bytes(bytearray(parts[0])), DATA[:4])
+
+        # Fields with dependent fields don't keep the consumed data.
+        parts = Packet().consume(bytearray(DATA), lazy=True).emit_segments()
+        self.assertEqual(
+            b''.join(bytes(bytearray(part)) for part in parts), DATA)
+
+
+class TestWriteSegments(TestCase):
+    def test_write(self):
+        parts = Packet().consume(DATA).emit_segments()
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(segments.write_segments(f.fileno(), parts),
+                             len(DATA))
+            f.seek(0)
+            self.assertEqual(f.read(), DATA)
+
+    def test_send(self):
+        a, b = socket.socketpair()
+        try:
+            parts = Packet().consume(DATA).emit_segments()
+            self.assertEqual(segments.send_segments(a, parts), len(DATA))
+            a.close()
+
+            received = b''
+            while True:
+                data = b.recv(65536)
+                if not data:
+                    break
+                received += data
+            self.assertEqual(received, DATA)
+        finally:
+            a.close()
+            b.close()
+
+    def test_partial(self):
+        """Partially written segments are continued."""
+        written = []
+
+        def write(views):
+            # Write at most 3 bytes of the first two segments at a time.
+            data = b''.join(bytes(bytearray(view)) for view in views[:2])[:3]
+            written.append(data)
+            return len(data)
+
+        total = segments._write_all(write, [b'abcd', b'', bytearray(b'ef'),
+                                            b'ghijk'])
+        self.assertEqual(total, 11)
+        self.assertEqual(b''.join(written), b'abcdefghijk')